@@ -9,7 +9,13 @@ import os
 import pydicom
 import json
 import shutil
+import glob
 import argparse
+try:
+    from .utils.metadata_index import format_value, get_metadata_index
+except ImportError:
+    # Run as a script from the dicom_converter folder
+    from utils.metadata_index import format_value, get_metadata_index
 
 
 def get_tag_from_json(json_path,tag):
@@ -33,6 +39,29 @@ def get_tag_from_json(json_path,tag):
     value=ds[tag].value
     return value
 
+def get_associated_png_files(json_path):
+    '''
+    Get the .png files of a .json file: /.../dicominfo.png, or the frames /.../dicominfo_0000.png,
+    /.../dicominfo_0001.png, ... of a multi-frame file (cf dicom_to_img.decompose_dicom)
+
+    Parameters
+    ----------
+    json_path : string
+        /.../dicominfo.json
+
+    Returns
+    -------
+    png_paths : list
+        Paths of the .png files.
+    '''
+    png_path = json_path[:-5] + '.png'
+    if os.path.exists(png_path):
+        return [png_path]
+    frame_paths = sorted(glob.glob(glob.escape(json_path[:-5]) + '_[0-9][0-9][0-9][0-9].png'))
+    if not frame_paths:
+        raise FileNotFoundError(png_path)
+    return frame_paths
+
 # Classer les fichiers en: Covid vs NON-Covid sur base du tag dans le .json
 def classify_in_labelled_folders(inputFolder, labelTag, outputDir):
     '''
@@ -50,23 +79,32 @@ def classify_in_labelled_folders(inputFolder, labelTag, outputDir):
     -------
     None.
     '''
+    # Labels of all the files read at once from the metadata index, if the folder has one. The index
+    # holds the values as text, as the names of the folders (cf format_value). The files whose label is
+    # absent or empty in the index are read from their .json file
+    index = get_metadata_index(inputFolder)
+    labels = index.get_values(labelTag) if index is not None and index.has_tag(labelTag) else {}
+    
     # lire uniquement les .json et classer en folders de types et labellisés 
     for file in os.listdir(inputFolder):
         if file.endswith(".json"):
             jsonFilePath = inputFolder + file
-            associatedPngFilePath = jsonFilePath[:-5] + '.png'
-            labelValue = get_tag_from_json(jsonFilePath[:-5], labelTag)
+            associatedPngFilePaths = get_associated_png_files(jsonFilePath)
+            labelValue = labels.get(file[:-5])
+            if not labelValue:
+                labelValue = format_value(get_tag_from_json(jsonFilePath[:-5], labelTag))
             
             
-            newPathJson = outputDir + '/METADATA/JSON-' + str(labelValue) + '/'
+            newPathJson = outputDir + '/METADATA/JSON-' + labelValue + '/'
             if not os.path.exists(newPathJson):
                 os.makedirs(newPathJson)                
-            newPathPng = outputDir + '/IMAGES/PNG-' + str(labelValue) + '/'
+            newPathPng = outputDir + '/IMAGES/PNG-' + labelValue + '/'
             if not os.path.exists(newPathPng):
                 os.makedirs(newPathPng)
             
             shutil.copy(jsonFilePath, newPathJson)
-            shutil.copy(associatedPngFilePath, newPathPng)
+            for associatedPngFilePath in associatedPngFilePaths:
+                shutil.copy(associatedPngFilePath, newPathPng)
 
 
 if __name__ == "__main__":
@@ -8,44 +8,351 @@ The function 'compress_to_png' calls executables from OpenJPEG (https://www.open
 """
 
 import os
+import sys
 import random
 import string
 import json
 import subprocess
+import tempfile
+import collections
+import concurrent.futures
 import cv2
 import pydicom
 import numpy as np
 import argparse
+import tqdm
+try:
+    from .shard_dataset import DEFAULT_SHARD_SIZE, ShardWriter
+    from .metadata_index import DEFAULT_INDEX_TAGS, INDEX_FILE, MetadataIndex, format_value, get_index_values
+except ImportError:
+    # Run as a script from the utils folder
+    from shard_dataset import DEFAULT_SHARD_SIZE, ShardWriter
+    from metadata_index import DEFAULT_INDEX_TAGS, INDEX_FILE, MetadataIndex, format_value, get_index_values
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+# The frames are read as by the anonymizer
+from dicom_pseudonymizer.utils import frame_io
 
-def img_from_dicom(ds):
+# Pixel data larger than this is not loaded when the file is read, the frames of multi-frame files are
+# then read one at a time
+DEFER_SIZE = 1024 * 1024
+
+# Number of files sent at once to a worker process by decompose_all_dicoms
+CHUNK_SIZE = 16
+
+# Number of chunks of files submitted to the worker processes and not converted yet, per process
+CHUNKS_IN_FLIGHT = 2
+
+# Size in bytes above which the images of a multi-frame file are not sent back by the worker processes
+# of a shard conversion, the main process then converts the file one frame at a time
+MAX_RESULT_SIZE = 16 * 1024 * 1024
+
+# Elements written to the index of a shard dataset (cf decompose_all_dicoms)
+SHARD_METADATA_KEYWORDS = ('PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'Modality')
+
+# Maximum number of lookup tables kept in memory by the VOI lookup table cache
+VOI_LUT_CACHE_SIZE = 64
+
+# Elements which define the VOI transformation of the pixel values (cf pydicom apply_voi_lut)
+VOI_KEYWORDS = ('PhotometricInterpretation', 'BitsStored', 'PixelRepresentation', 'WindowCenter', 'WindowWidth',
+                'VOILUTFunction', 'RescaleSlope', 'RescaleIntercept', 'VOILUTSequence', 'ModalityLUTSequence')
+
+# Output bit depths of the images
+BIT_DEPTHS = (8, 16)
+
+# Image formats which can hold 16 bits images
+FORMATS_16_BITS = ('png', 'tif', 'tiff')
+
+class LutCache:
+    '''
+    Least recently used cache of lookup tables.
+    
+    The windowed value of every possible pixel value is computed once per window (WindowCenter,
+    WindowWidth, VOILUTFunction, VOI LUT), rescale, bit depth and data type, so the slices of a series
+    share the same table. The tables are indexed with the unsigned view of the pixel values (cf lut_indices).
+    '''
+    
+    def __init__(self, max_size=VOI_LUT_CACHE_SIZE):
+        self.max_size = max_size
+        self.luts = collections.OrderedDict()
+    
+    def get(self, key, build):
+        '''
+        Return the table of key, built with build() if it is not in the cache.
+        '''
+        lut = self.luts.get(key)
+        if lut is not None:
+            self.luts.move_to_end(key)
+            return lut
+        lut = build()
+        self.luts[key] = lut
+        if len(self.luts) > self.max_size:
+            self.luts.popitem(last=False)
+        return lut
+
+# Lookup tables of the process
+lut_cache = LutCache()
+
+def hashable(value):
+    '''
+    Hashable version of an element value, used in the keys of the lookup tables.
+    '''
+    if isinstance(value, pydicom.sequence.Sequence):
+        return tuple(tuple((elem.tag, hashable(elem.value)) for elem in item) for item in value)
+    if isinstance(value, (list, pydicom.multival.MultiValue)):
+        return tuple(hashable(item) for item in value)
+    return value
+
+def lut_supported(data):
+    '''
+    Whether the pixel values can be transformed with a lookup table: single sample integers of 8 or 16 bits.
+    '''
+    return data.dtype.kind in 'iu' and data.dtype.itemsize <= 2 and data.ndim == 2
+
+def lut_indices(data):
+    '''
+    Unsigned view of the pixel values, used as indices of the lookup tables (no copy).
+    '''
+    return data.view('u{}'.format(data.dtype.itemsize))
+
+def get_voi_lut(ds, dtype):
+    '''
+    Return the windowed value of every possible pixel value of dtype, as computed by img_from_dicom
+    (apply_voi_lut if the header has window levels, else the pixel value itself).
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+    dtype : numpy.dtype
+        Integer data type of ds.pixel_array, of 8 or 16 bits
+
+    Returns
+    -------
+    key, lut, monotonic : tuple
+        Key of the table in lut_cache, array of the windowed values indexed by the unsigned view of the
+        pixel values (cf lut_indices), and whether the windowed values only increase or only decrease with
+        the pixel values.
+    '''
+    dtype = np.dtype(dtype)
+    windowed = 'WindowWidth' in ds
+    elements = tuple((keyword, hashable(ds.data_element(keyword).value)) for keyword in VOI_KEYWORDS
+                     if keyword in ds) if windowed else ()
+    key = ('voi', dtype.str, elements)
+    
+    def build():
+        values = np.arange(2 ** (8 * dtype.itemsize), dtype='u{}'.format(dtype.itemsize)).view(dtype)
+        if windowed:
+            # Copy of the VOI elements, which apply_voi_lut may modify
+            voi_ds = pydicom.Dataset()
+            for keyword in VOI_KEYWORDS:
+                if keyword in ds:
+                    elem = ds.data_element(keyword)
+                    voi_ds.add(pydicom.DataElement(elem.tag, elem.VR, elem.value))
+            values = pydicom.pixel_data_handlers.util.apply_voi_lut(values, voi_ds)
+        # Ordered by pixel value, the negative values come last in the unsigned order
+        steps = np.diff(np.roll(values, len(values) // 2) if dtype.kind == 'i' else values)
+        values.flags.writeable = False
+        return values, bool((steps >= 0).all() or (steps <= 0).all())
+    
+    lut, monotonic = lut_cache.get(key, build)
+    return key, lut, monotonic
+
+def get_windowed_range(lut, monotonic, data):
+    '''
+    Return the minimum and maximum of the windowed values of the image data, without windowing it.
+    '''
+    if monotonic:
+        # The extreme windowed values are those of the extreme pixel values
+        minimum, maximum = cv2.minMaxLoc(data)[:2]
+        ends = lut[lut_indices(np.array([minimum, maximum], dtype=data.dtype))]
+        return ends.min(), ends.max()
+    present = np.zeros(len(lut), dtype=bool)
+    present[lut_indices(data)] = True
+    return lut[present].min(), lut[present].max()
+
+def get_output_dtype(bit_depth):
+    if bit_depth not in BIT_DEPTHS:
+        raise ValueError('Unsupported bit depth {}, expected one of {}'.format(bit_depth, list(BIT_DEPTHS)))
+    return np.dtype('uint{}'.format(bit_depth))
+
+def img_from_dicom(ds, bit_depth=8):
     '''
     Extract array from dicom dataset 'dcm' with [0,256] pixel intensities.
+    
+    The window levels of the header are applied, then the intensities are normalized between their minimum
+    and maximum. For single sample images of 8 or 16 bits, both steps are done with a single lookup in a
+    table of all the pixel values (cf get_voi_lut), cached for the next images with the same window and
+    range, instead of being computed on the whole image.
 
     Parameters
     ----------
     dcm : FileDataset object of pydicom.dataset module
+    bit_depth : int, optional
+        8 for [0,255] intensities, 16 for [0,65535] intensities. The default is 8.
 
     Returns
     -------
     d : array
         Image array of the dicom dataset
     '''
-
+    
+    out_dtype = get_output_dtype(bit_depth)
+    max_value = 2 ** bit_depth - 1
     data=ds.pixel_array
     
+    if lut_supported(data):
+        key, lut, monotonic = get_voi_lut(ds, data.dtype)
+        minimum, maximum = get_windowed_range(lut, monotonic, data)
+        
+        def build():
+            # The values out of the range of the image are not used, once clipped cv2.normalize
+            # computes the same intensities as on the image
+            values = np.clip(lut, minimum, maximum).reshape(1, -1)
+            if bit_depth != 8:
+                values = values.astype('float64')
+            output_lut = np.round(cv2.normalize(values, None, 0, max_value, cv2.NORM_MINMAX)).astype(out_dtype).ravel()
+            output_lut.flags.writeable = False
+            return output_lut
+        
+        output_lut = lut_cache.get((key, float(minimum), float(maximum), bit_depth), build)
+        return output_lut[lut_indices(data)]
+    
     if 'WindowWidth' in ds:
     
         # Uses window levels written in dicom header    
         data = pydicom.pixel_data_handlers.util.apply_voi_lut(ds.pixel_array, ds)
-        
-    img = np.round(cv2.normalize(data,  None, 0, 255, cv2.NORM_MINMAX)).astype('uint8')
+    
+    if bit_depth != 8:
+        data = data.astype('float64')
+    img = np.round(cv2.normalize(data,  None, 0, max_value, cv2.NORM_MINMAX)).astype(out_dtype)
     
     return img
+
+def iter_frames(ds, file_path):
+    '''
+    Read the frames of a multi-frame dicom file one at a time, so that the memory used does not depend on
+    the number of frames (cf frame_io.iter_frames of the anonymizer). Native frames are read from the file
+    one by one, compressed frames are read fragment by fragment and decoded one by one. The pixel data
+    which cannot be read by frame (1 bit pixel data, frames spanning several fragments without basic
+    offset table) is read at once.
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+        Dataset of file_path, read with its pixel data deferred (defer_size) or without it
+    file_path : string
+        /.../filename.dcm
+
+    Returns
+    -------
+    frames : generator
+        Array of each frame, as ds.pixel_array[i]
+    '''
+    
+    with open(file_path, 'rb') as fp:
+        # pydicom rewinds the file to the start of the pixel data element when it stops
+        pydicom.dcmread(fp, force=True, stop_before_pixels=True)
+        pixel_data_offset = fp.tell()
+    
+    try:
+        frames = frame_io.iter_frames(file_path, ds, pixel_data_offset)
+        first_frame = next(frames)
+    except NotImplementedError:
+        pixels = ds.pixel_array
+        yield from (pixels if int(ds.get('NumberOfFrames', 1) or 1) > 1 else [pixels])
+        return
+    yield first_frame
+    yield from frames
+
+def imgs_from_dicom(ds, file_path, bit_depth=8):
+    '''
+    Extract the arrays of the frames of a multi-frame dicom file with [0,256] pixel intensities, one at a
+    time. As for img_from_dicom, the window levels of the header are applied and the intensities are
+    normalized with the minimum and maximum of all frames: the frames are read and decoded once, while
+    the range of the pixel values is computed, and kept in a temporary file until they are converted. For
+    single sample frames of 8 or 16 bits, the frames are converted with a lookup table (cf get_voi_lut).
+
+    Parameters
+    ----------
+    ds : FileDataset object of pydicom.dataset module
+        Dataset of file_path, read with its pixel data deferred (defer_size)
+    file_path : string
+        /.../filename.dcm
+    bit_depth : int, optional
+        8 for [0,255] intensities, 16 for [0,65535] intensities. The default is 8.
+
+    Returns
+    -------
+    imgs : generator
+        Image array of each frame
+    '''
+    
+    out_dtype = get_output_dtype(bit_depth)
+    max_value = 2 ** bit_depth - 1
     
-def decompose_dicom(file_path,output_path,img_format='bmp',removeImgInJson=False):
+    lut = None
+    minimum = None
+    maximum = None
+    nb_frames = 0
+    with tempfile.TemporaryFile() as frames_file:
+        for frame in iter_frames(ds, file_path):
+            if minimum is None and lut_supported(frame):
+                key, lut, monotonic = get_voi_lut(ds, frame.dtype)
+            if lut is not None:
+                frame_minimum, frame_maximum = get_windowed_range(lut, monotonic, frame)
+            else:
+                if 'WindowWidth' in ds:
+                    # Uses window levels written in dicom header
+                    frame = pydicom.pixel_data_handlers.util.apply_voi_lut(frame, ds)
+                frame_minimum, frame_maximum = frame.min(), frame.max()
+            minimum = frame_minimum if minimum is None else min(minimum, frame_minimum)
+            maximum = frame_maximum if maximum is None else max(maximum, frame_maximum)
+            frame = np.ascontiguousarray(frame)
+            frames_file.write(frame.tobytes())
+            shape, dtype = frame.shape, frame.dtype
+            nb_frames += 1
+        
+        scale = max_value / (float(maximum) - float(minimum)) if maximum > minimum else 0
+        if lut is not None:
+            # The values out of the range of the frames are not used
+            values = np.clip(lut.astype('float64'), float(minimum), float(maximum))
+            output_lut = np.round((values - float(minimum)) * scale).astype(out_dtype)
+        
+        frames_file.seek(0)
+        frame_size = int(np.prod(shape)) * dtype.itemsize
+        for i in range(nb_frames):
+            frame = np.frombuffer(frames_file.read(frame_size), dtype=dtype).reshape(shape)
+            if lut is not None:
+                yield output_lut[lut_indices(frame)]
+            else:
+                yield np.round((frame.astype('float64') - float(minimum)) * scale).astype(out_dtype)
+    
+def get_file_name(file_path):
+    '''
+    Name of the outputs of a dicom file: its file name without the .dcm extension.
+    '''
+    filename=file_path.rsplit("/")[-1]
+    if filename.endswith('.dcm'):
+        filename=filename[:-4]
+    return filename
+
+def iter_named_images(ds, file_path, bit_depth=8):
+    '''
+    Generate (name, image array) of the images of a dicom file: filename, or filename_0000,
+    filename_0001, ... for the frames of a multi-frame file, which are processed one at a time.
+    '''
+    filename=get_file_name(file_path)
+    if int(ds.get('NumberOfFrames', 1) or 1) > 1:
+        for i, img in enumerate(imgs_from_dicom(ds, file_path, bit_depth)):
+            yield filename+'_'+str(i).zfill(4), img
+    else:
+        yield filename, img_from_dicom(ds, bit_depth)
+
+def decompose_dicom(file_path,output_path,img_format='bmp',removeImgInJson=False,bit_depth=8,
+                    index_tags=()):
     '''
     Divides dicom file into a .json file with the dicom metadata and a 
-    .'img_format' file containing the image.
+    .'img_format' file containing the image. The frames of a multi-frame file are
+    written to filename_0000.'img_format', filename_0001.'img_format', ...
 
     Parameters
     ----------
@@ -57,31 +364,37 @@ def decompose_dicom(file_path,output_path,img_format='bmp',removeImgInJson=False
         Image file format : bmp, png, ... The default is 'bmp'.
     removeImgInJson : True/False, optional
         Removes PixelData from dicom metadata. The default is False.
+    bit_depth : int, optional
+        Bit depth of the images: 8, or 16 for png and tif files. The default is 8.
+    index_tags : list, optional
+        Tags whose values are returned for the metadata index (cf metadata_index.py). The default is ().
 
     Returns
     -------
-    None.
+    index_values : list
+        Values of index_tags.
     '''
     
-    filename=file_path.rsplit("/")[-1]
-    if filename.endswith('.dcm'):
-        filename=filename[:-4]
+    # Open DICOM, the pixel data is only read when needed
     
-    # Open DICOM
+    ds = pydicom.dcmread(file_path,force=True,defer_size=DEFER_SIZE)
     
-    ds = pydicom.dcmread(file_path,force=True)
+    for name, img in iter_named_images(ds, file_path, bit_depth):
+        cv2.imwrite(output_path+name+'.'+img_format, img)
     
-    img = img_from_dicom(ds)
+    filename=get_file_name(file_path)
     
     if removeImgInJson==True:
-        ds.PixelData=None
+        # Replaced as a whole, so that the deferred pixel data is not read
+        ds[0x7FE00010]=pydicom.DataElement(0x7FE00010,'OB' if ds.get('BitsAllocated',16)<=8 else 'OW',None)
     
     metadata=ds.to_json_dict()
     
-    cv2.imwrite(output_path+filename+'.'+img_format, img)
     with open(output_path+filename+'.json','w') as outfile:
         json.dump(metadata, outfile)
     
+    return get_index_values(ds,index_tags)
+    
 def dicom_from_img_or_json(file_path,output_folder,metadata_path=None,
                        randomizeName=False,verbose=False):
     '''
@@ -218,7 +531,133 @@ def get_tag_from_json(json_path,tag):
     
     return value
 
-def decompose_all_dicoms(folder_path,output_path,img_format='bmp',removeImgInJson=False):
+def init_decompose_worker():
+    '''
+    Initialize a worker process of decompose_all_dicoms: OpenCV uses a single thread, the processes
+    already use all the cores.
+    '''
+    cv2.setNumThreads(1)
+
+def decompose_dicom_or_error(file_path,output_path,img_format='bmp',removeImgInJson=False,bit_depth=8,
+                             index_tags=()):
+    '''
+    Call decompose_dicom and return its index values and the description of the error raised, or None
+    if the file has been converted.
+    '''
+    try:
+        index_values=decompose_dicom(file_path,output_path,img_format=img_format,removeImgInJson=removeImgInJson,
+                                     bit_depth=bit_depth,index_tags=index_tags)
+    except Exception as e:
+        return None,'{}: {}'.format(type(e).__name__, e)
+    return index_values,None
+
+def get_images_size(ds, bit_depth=8):
+    '''
+    Size in bytes of the images of a dicom file once converted (cf iter_named_images).
+    '''
+    nb_frames=int(ds.get('NumberOfFrames', 1) or 1)
+    return nb_frames*ds.Rows*ds.Columns*ds.get('SamplesPerPixel', 1)*bit_depth//8
+
+def dicom_to_images_or_error(file_path,bit_depth=8,label_tag=None,index_tags=()):
+    '''
+    Read the images of a dicom file for a shard dataset (cf decompose_all_dicoms).
+    
+    The images of a multi-frame file larger than MAX_RESULT_SIZE are not read, so that a worker process does
+    not send them back at once: images is then None, and the caller adds them to the shards one at a
+    time with iter_named_images.
+
+    Returns
+    -------
+    images, metadata, label, index_values, error : tuple
+        (name, image array) of the images (or None), values of the metadata columns, value of label_tag
+        (or ''), values of index_tags and the description of the error raised, or None if the file has
+        been converted.
+    '''
+    try:
+        ds = pydicom.dcmread(file_path,force=True,defer_size=DEFER_SIZE)
+        metadata={'file':file_path.rsplit("/")[-1]}
+        for keyword in SHARD_METADATA_KEYWORDS:
+            value=ds.get(keyword)
+            metadata[keyword]='' if value is None else str(value)
+        label=format_value(ds[label_tag].value) if label_tag is not None and label_tag in ds else ''
+        index_values=get_index_values(ds,index_tags)
+        images=None
+        if int(ds.get('NumberOfFrames', 1) or 1)<=1 or get_images_size(ds,bit_depth)<=MAX_RESULT_SIZE:
+            images=list(iter_named_images(ds,file_path,bit_depth))
+    except Exception as e:
+        return [],{},'',None,'{}: {}'.format(type(e).__name__, e)
+    return images,metadata,label,index_values,None
+
+def convert_files(function,file_paths,arguments):
+    '''
+    Call function(file_path,*arguments) on each file of a chunk, in a worker process, and return the
+    results.
+    '''
+    return [function(file_path,*arguments) for file_path in file_paths]
+
+def parse_tag(text):
+    '''
+    Parse a DICOM tag given as a keyword (e.g. PatientID) or as two numbers (e.g. [0x0014,0x2018]).
+    '''
+    if text.isidentifier():
+        tag=pydicom.datadict.tag_for_keyword(text)
+        if tag is None:
+            raise ValueError('Unknown DICOM keyword {}'.format(text))
+        return pydicom.tag.Tag(tag)
+    group,element=[int(number,0) for number in text.strip('[]() ').split(',')]
+    return pydicom.tag.Tag(group,element)
+
+def decompose_all_dicoms(folder_path,output_path,img_format='bmp',removeImgInJson=False,
+                         workers=1,chunk_size=CHUNK_SIZE,progress=True,bit_depth=8,
+                         shard_size=None,label_tag=None,index_tags=DEFAULT_INDEX_TAGS):
+    '''
+    Divides all the dicom files of a folder into .json and image files (cf decompose_dicom).
+    A file which cannot be converted is reported and does not stop the conversion of the others.
+    
+    With shard_size, the images are packed into the shards of a shard dataset instead (cf
+    shard_dataset.py), with one row per image in its index: the name of the dicom file, the elements of
+    SHARD_METADATA_KEYWORDS and the value of label_tag as label. No .json file is written.
+    
+    The values of index_tags are also written to a metadata index, metadata.db, with one row per
+    dicom file (cf metadata_index.py), from which classify_data.py reads the labels without parsing
+    the .json files.
+
+    Parameters
+    ----------
+    folder_path : string
+        /.../foldername/ containing the dicom files
+    output_path : string
+        /.../foldername/
+    img_format : string, optional
+        Image file format : bmp, png, ... The default is 'bmp'.
+    removeImgInJson : True/False, optional
+        Removes PixelData from dicom metadata. The default is False.
+    workers : int, optional
+        Number of processes converting the files in parallel. The default is 1.
+    chunk_size : int, optional
+        Number of files sent at once to a process. The default is CHUNK_SIZE.
+    progress : True/False, optional
+        Shows a progress bar. The default is True.
+    bit_depth : int, optional
+        Bit depth of the images: 8, or 16 for png and tif files. The default is 8.
+    shard_size : int, optional
+        Maximum size of a shard in bytes. The default is None: one file per image.
+    label_tag : tuple of two elements, optional
+        With shard_size, DICOM tag of the labels. ex: (0x0014,0x2018). The default is None.
+    index_tags : list, optional
+        Tags written to the metadata index, as keywords or as two numbers. The tags of an existing index
+        are kept. The default is DEFAULT_INDEX_TAGS, no index is written if empty.
+
+    Returns
+    -------
+    failures : list
+        (file path, error description) of the files which could not be converted.
+    '''
+    
+    get_output_dtype(bit_depth)
+    if shard_size is None and bit_depth!=8 and img_format.lower() not in FORMATS_16_BITS:
+        raise ValueError('{} bit images cannot be written to {} files, use one of {}'.format(
+            bit_depth,img_format,list(FORMATS_16_BITS)))
     
     if not output_path.endswith('/'):
         output_path+='/'
@@ -229,10 +668,75 @@ def decompose_all_dicoms(folder_path,output_path,img_format='bmp',removeImgInJso
     if not os.path.isdir(output_path):
         os.mkdir(output_path)
     
-    for filename in os.listdir(folder_path):
-        
-        decompose_dicom(folder_path+filename,output_path,img_format=img_format,
-                        removeImgInJson=removeImgInJson)
+    file_paths=[folder_path+filename for filename in sorted(os.listdir(folder_path))]
+    metadata_index=MetadataIndex(output_path+INDEX_FILE,index_tags,read_only=False) if index_tags else None
+    column_tags=metadata_index.column_tags if metadata_index is not None else []
+    if shard_size is not None:
+        function=dicom_to_images_or_error
+        arguments=(bit_depth,label_tag,column_tags)
+        shard_writer=ShardWriter(output_path,shard_size,['file']+list(SHARD_METADATA_KEYWORDS))
+    else:
+        function=decompose_dicom_or_error
+        arguments=(output_path,img_format,removeImgInJson,bit_depth,column_tags)
+        shard_writer=None
+    
+    failures=[]
+    progress_bar=tqdm.tqdm(total=len(file_paths),disable=not progress)
+    
+    def file_done(file_path,result):
+        if shard_writer is not None:
+            images,metadata,label,index_values,error=result
+            if images is None:
+                # Large multi-frame file, its frames are converted and added one at a time
+                try:
+                    ds=pydicom.dcmread(file_path,force=True,defer_size=DEFER_SIZE)
+                    images=iter_named_images(ds,file_path,bit_depth)
+                    for name,img in images:
+                        shard_writer.add(img,name,label,metadata=metadata)
+                except Exception as e:
+                    error='{}: {}'.format(type(e).__name__, e)
+            else:
+                for name,img in images:
+                    shard_writer.add(img,name,label,metadata=metadata)
+        else:
+            index_values,error=result
+        if metadata_index is not None and error is None:
+            metadata_index.add(get_file_name(file_path),file_path.rsplit("/")[-1],index_values)
+        if error is not None:
+            failures.append((file_path,error))
+            tqdm.tqdm.write('Cannot convert {}: {}'.format(file_path,error))
+        progress_bar.update(1)
+    
+    try:
+        if workers>1:
+            # The files are sent to the processes by chunks, the results are handled in order. At most
+            # CHUNKS_IN_FLIGHT chunks per process are waiting, so that their results do not pile up
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=init_decompose_worker) as executor:
+                in_flight=collections.deque()
+                for start in range(0,len(file_paths),chunk_size):
+                    chunk=file_paths[start:start+chunk_size]
+                    in_flight.append((chunk,executor.submit(convert_files,function,chunk,arguments)))
+                    if len(in_flight)>=CHUNKS_IN_FLIGHT*workers:
+                        chunk,future=in_flight.popleft()
+                        for file_path,result in zip(chunk,future.result()):
+                            file_done(file_path,result)
+                for chunk,future in in_flight:
+                    for file_path,result in zip(chunk,future.result()):
+                        file_done(file_path,result)
+        else:
+            for file_path in file_paths:
+                file_done(file_path,function(file_path,*arguments))
+    finally:
+        progress_bar.close()
+        if shard_writer is not None:
+            shard_writer.close()
+        if metadata_index is not None:
+            metadata_index.close()
+    
+    if failures:
+        print('{} files could not be converted'.format(len(failures)))
+    return failures
 
 def main(defined_action_map = {}):
     parser = argparse.ArgumentParser(add_help=True)
@@ -243,12 +747,26 @@ def main(defined_action_map = {}):
     parser.add_argument('--removeImgInJson', action='store_true', dest='removeImgInJson', help='If used, then image info will be removed from json')
     parser.set_defaults(removeImgInJson=False)
     parser.set_defaults(img_format='png')
+    parser.add_argument('--workers', action='store', type=int, default=1, help='Number of processes converting the files in parallel')
+    parser.add_argument('--chunkSize', action='store', type=int, default=CHUNK_SIZE, help='Number of files sent at once to a process')
+    parser.add_argument('--shards', action='store_true', dest='shards', help='If used, the images are packed into shards with an index instead of one image and one json file per dicom')
+    parser.add_argument('--shardSize', action='store', type=int, default=DEFAULT_SHARD_SIZE // (1024 * 1024), help='Maximum size of a shard in MB. Default is 256.')
+    parser.add_argument('--labelTag', action='store', help='With --shards, tag of the labels written to the index, e.g. [0x0014,0x2018]')
+    parser.set_defaults(shards=False)
+    parser.add_argument('--indexTags', action='store', nargs='*', default=[], help='Tags written to the metadata index in addition to the default ones, as keywords or as [group,element]')
+    parser.add_argument('--noIndex', action='store_true', dest='noIndex', help='If used, no metadata index is written')
+    parser.set_defaults(noIndex=False)
+    parser.add_argument('--bitDepth', action='store', type=int, choices=list(BIT_DEPTHS), default=8, help='Bit depth of the images, 16 for png and tif files or shards only')
     args = parser.parse_args()
     
     folder_path = args.input
     output_path = args.output 
     
-    decompose_all_dicoms(folder_path,output_path,img_format=args.img_format,removeImgInJson=args.removeImgInJson)
+    decompose_all_dicoms(folder_path,output_path,img_format=args.img_format,removeImgInJson=args.removeImgInJson,
+                         workers=args.workers,chunk_size=args.chunkSize,bit_depth=args.bitDepth,
+                         shard_size=args.shardSize * 1024 * 1024 if args.shards else None,
+                         label_tag=parse_tag(args.labelTag) if args.labelTag else None,
+                         index_tags=() if args.noIndex else list(DEFAULT_INDEX_TAGS)+[parse_tag(tag) for tag in args.indexTags])
    
 
 if __name__=='__main__':
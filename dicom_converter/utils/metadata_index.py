@@ -0,0 +1,190 @@
+'''
+Metadata index of a decomposed folder (cf dicom_to_img.decompose_all_dicoms): a SQLite database,
+metadata.db, with one row per DICOM file and one column per selected tag, so that the value of a tag
+for all the files is read with a single query instead of parsing one JSON file per image.
+
+The images of a multi-frame file share its row: the indexed tags are elements of the dataset, the same
+for all its frames, and the images are classified with their .json file (cf classify_data.py). The
+number of images of a row is its NumberOfFrames column (indexed by default), NULL for a single image.
+
+The table images has the columns name (name of the .json file without its extension, the primary key),
+file (name of the DICOM file) and one column per tag, named after its keyword (e.g. PatientID), or
+tag_GGGGEEEE for the tags without a keyword. The values are stored as text (cf format_value), or NULL
+when the element is absent. Sequences and binary values are not indexed.
+'''
+
+import functools
+import os
+import sqlite3
+import pydicom
+
+INDEX_FILE = 'metadata.db'
+
+# Tags indexed by default: identifiers, image description and the labels added by add_metadata.py
+DEFAULT_INDEX_TAGS = ('PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'Modality',
+                      'BodyPartExamined', 'ViewPosition', 'Rows', 'Columns', 'NumberOfFrames',
+                      'IndicationLabel', 'IndicationDescription')
+
+# Rows written at once
+BATCH_SIZE = 1000
+
+
+def get_column_name(tag):
+    '''
+    Name of the column of a tag, given as a keyword or as two numbers. ex: (0x10,0x20) -> PatientID
+    '''
+    if isinstance(tag, str) and tag.isidentifier():
+        if pydicom.datadict.tag_for_keyword(tag) is None:
+            raise ValueError('Unknown DICOM keyword {}'.format(tag))
+        return tag
+    tag = pydicom.tag.Tag(tag)
+    return pydicom.datadict.keyword_for_tag(tag) or 'tag_{:08X}'.format(int(tag))
+
+
+def get_column_tag(column):
+    '''
+    Tag of a column of the index.
+    '''
+    if column.startswith('tag_'):
+        return pydicom.tag.Tag(int(column[4:], 16))
+    return pydicom.tag.Tag(pydicom.datadict.tag_for_keyword(column))
+
+
+def format_value(value):
+    '''
+    Text of the value of an element, as stored in the index and used in the names of the folders of
+    classify_data.py, whether the value is read from a DICOM file or from a .json file: decimal strings
+    (DS) are written as numbers ('1.50' and 1.5 -> '1.5'), the values of a multi-valued element are
+    separated by backslashes, as in DICOM files, and an empty value is ''.
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+        return '\\'.join(format_value(item) for item in value)
+    if isinstance(value, float) or isinstance(value, pydicom.valuerep.DSdecimal):
+        return '{:.15g}'.format(float(value))
+    if isinstance(value, int):
+        return str(int(value))
+    return str(value)
+
+
+def get_index_value(ds, tag):
+    '''
+    Value of a tag as stored in the index: text of the value (cf format_value), or None if the element is
+    absent, is a sequence or has a binary value.
+    '''
+    if tag not in ds:
+        return None
+    elem = ds[tag]
+    if elem.VR == 'SQ' or isinstance(elem.value, (bytes, bytearray)):
+        return None
+    return format_value(elem.value)
+
+
+def get_index_values(ds, tags):
+    '''
+    Values of tags as stored in the index (cf get_index_value).
+    '''
+    return [get_index_value(ds, tag) for tag in tags]
+
+
+class MetadataIndex:
+    '''
+    Metadata index of a folder of .json files.
+
+    Parameters
+    ----------
+    path : string
+        /.../metadata.db
+    tags : list, optional
+        Tags of the columns of a new index, as keywords or as two numbers. The default is
+        DEFAULT_INDEX_TAGS.
+    read_only : True/False, optional
+        Opens an existing index without writing to it. The default is True.
+    '''
+
+    def __init__(self, path, tags=DEFAULT_INDEX_TAGS, read_only=True):
+        self.path = path
+        if read_only:
+            self.connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        else:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, file TEXT)')
+        self.columns = [row[1] for row in self.connection.execute('PRAGMA table_info(images)')]
+        if not read_only:
+            # The tags of a previous run are kept, new tags are added
+            for tag in tags:
+                column = get_column_name(tag)
+                if column not in self.columns:
+                    self.connection.execute('ALTER TABLE images ADD COLUMN "{}" TEXT'.format(column))
+                    self.columns.append(column)
+            self.connection.commit()
+        self.tag_columns = self.columns[2:]
+        self.column_tags = [get_column_tag(column) for column in self.tag_columns]
+        self.pending_rows = []
+
+    def add(self, name, file, values):
+        '''
+        Add the row of a DICOM file, replacing the row with the same name. It is saved at the next commit.
+
+        Parameters
+        ----------
+        name : string
+            Name of the .json file without its extension.
+        file : string
+            Name of the DICOM file.
+        values : list
+            Values of the tags of column_tags, cf get_index_values.
+
+        Returns
+        -------
+        None.
+        '''
+        self.pending_rows.append([name, file] + list(values))
+        if len(self.pending_rows) >= BATCH_SIZE:
+            self.commit()
+
+    def commit(self):
+        if self.pending_rows:
+            self.connection.executemany('INSERT OR REPLACE INTO images ({}) VALUES ({})'.format(
+                ', '.join('"{}"'.format(column) for column in self.columns), ', '.join('?' * len(self.columns))),
+                self.pending_rows)
+            self.pending_rows = []
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def has_tag(self, tag):
+        return get_column_name(tag) in self.tag_columns
+
+    def get_value(self, name, tag):
+        '''
+        Return the indexed value of a tag for the .json file name, or None if the element or the file is
+        absent.
+        '''
+        row = self.connection.execute('SELECT "{}" FROM images WHERE name = ?'.format(get_column_name(tag)),
+                                      (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_values(self, tag):
+        '''
+        Return the indexed values of a tag for all the files, as a dictionary name -> value.
+        '''
+        return dict(self.connection.execute('SELECT name, "{}" FROM images'.format(get_column_name(tag))))
+
+    def has_name(self, name):
+        return self.connection.execute('SELECT 1 FROM images WHERE name = ?', (name,)).fetchone() is not None
+
+
+@functools.lru_cache(maxsize=16)
+def get_metadata_index(folder_path):
+    '''
+    Return the metadata index of a folder of .json files, opened once, or None if it has none.
+    '''
+    path = os.path.join(folder_path, INDEX_FILE)
+    if not os.path.isfile(path):
+        return None
+    return MetadataIndex(path)
+
@@ -0,0 +1,196 @@
+'''
+Packed shard datasets: the images of a dataset are written to a few large files instead of one file per
+image, so that they are read without listing, opening and decoding millions of small files.
+
+A shard dataset is a folder with:
+
+- shard_00000.npy, shard_00001.npy, ... : one dimensional uint8 arrays (numpy .npy files, which can be
+  memory-mapped) holding the raw pixel values of the images, one after the other. A shard is closed once
+  it holds shard_size bytes.
+- index.csv : one row per image with its name, split (e.g. train or valid), label, shard number, offset
+  (in bytes) in the shard, rows, columns, channels and data type, followed by metadata columns.
+
+The channels of the color images are in RGB (or RGBA) order.
+
+The shards are read by federated_learning/client/dsail/shards.py.
+'''
+
+import csv
+import os
+import argparse
+import cv2
+import numpy as np
+
+INDEX_FILE = 'index.csv'
+SHARD_FILE = 'shard_{:05d}.npy'
+INDEX_COLUMNS = ['name', 'split', 'label', 'shard', 'offset', 'rows', 'columns', 'channels', 'dtype']
+
+# Maximum size of a shard in bytes
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.jpg', '.jpeg', '.tif', '.tiff')
+
+
+class ShardWriter:
+    '''
+    Write images to the shards of a dataset folder.
+
+    The images of a shard are kept in memory until it is full, then it is written under a temporary name
+    and renamed, and its rows are added to the index. The index is renamed to index.csv by close.
+
+    Parameters
+    ----------
+    output_path : string
+        Folder of the shard dataset.
+    shard_size : int, optional
+        Maximum size of a shard in bytes. An image larger than shard_size has its own shard.
+        The default is DEFAULT_SHARD_SIZE.
+    metadata_columns : list, optional
+        Names of the metadata columns of the index. The default is no column.
+    '''
+
+    def __init__(self, output_path, shard_size=DEFAULT_SHARD_SIZE, metadata_columns=()):
+        os.makedirs(output_path, exist_ok=True)
+        self.output_path = output_path
+        self.shard_size = shard_size
+        self.metadata_columns = list(metadata_columns)
+        self.index_path = os.path.join(output_path, INDEX_FILE)
+        self.index_file = open(self.index_path + '.tmp', 'w', newline='')
+        self.index_writer = csv.writer(self.index_file, lineterminator='\n')
+        self.index_writer.writerow(INDEX_COLUMNS + self.metadata_columns)
+        self.nb_shards = 0
+        self.nb_images = 0
+        # Images and index rows of the current shard
+        self.images = []
+        self.rows = []
+        self.size = 0
+
+    def add(self, img, name, label='', split='', metadata=None):
+        '''
+        Add an image to the current shard
+
+        Parameters
+        ----------
+        img : array
+            Image of 8 or 16 bits unsigned integers, with one (rows, columns) or several (rows, columns,
+            channels) channels.
+        name : string
+            Name of the image, e.g. its file name.
+        label : string, optional
+            Label of the image. The default is ''.
+        split : string, optional
+            Split of the image, e.g. 'train' or 'valid'. The default is ''.
+        metadata : dict, optional
+            Values of the metadata columns. The default is None.
+
+        Returns
+        -------
+        None.
+        '''
+        if img.dtype.kind != 'u' or img.dtype.itemsize > 2 or img.ndim not in (2, 3):
+            raise ValueError('Cannot add the {} image {} of {} to a shard'.format(img.shape, name, img.dtype))
+        img = np.ascontiguousarray(img)
+        metadata = metadata or {}
+        self.rows.append([name, split, label, self.nb_shards, self.size, img.shape[0], img.shape[1],
+                          img.shape[2] if img.ndim == 3 else 1, img.dtype.str]
+                         + [metadata.get(column, '') for column in self.metadata_columns])
+        self.images.append(img)
+        self.size += img.nbytes
+        self.nb_images += 1
+        if self.size >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the current shard and its index rows, and start a new shard.
+        '''
+        if not self.images:
+            return
+        shard_path = os.path.join(self.output_path, SHARD_FILE.format(self.nb_shards))
+        with open(shard_path + '.tmp', 'wb') as fp:
+            # The images are written one after the other, without being copied to a single array
+            np.lib.format.write_array_header_1_0(fp, {'descr': '|u1', 'fortran_order': False,
+                                                      'shape': (self.size,)})
+            for img in self.images:
+                fp.write(img.data)
+        os.replace(shard_path + '.tmp', shard_path)
+        self.index_writer.writerows(self.rows)
+        self.index_file.flush()
+        self.nb_shards += 1
+        self.images = []
+        self.rows = []
+        self.size = 0
+
+    def close(self):
+        '''
+        Write the last shard and the index.
+        '''
+        self.flush()
+        self.index_file.close()
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+
+def iter_image_folder(input_path):
+    '''
+    Generate (path, label, split) of the images of a dataset folder laid out as split/label/image (e.g.
+    train/0/image.png, cf cat_to_dataset.py), as read by the DataBlocks of the clients (parent_label and
+    GrandparentSplitter).
+    '''
+    for root, dirs, files in os.walk(input_path):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, filename)
+                folders = os.path.relpath(path, input_path).split(os.sep)[:-1]
+                label = folders[-1] if len(folders) >= 1 else ''
+                split = folders[-2] if len(folders) >= 2 else ''
+                yield path, label, split
+
+
+def pack_image_folder(input_path, output_path, shard_size=DEFAULT_SHARD_SIZE):
+    '''
+    Pack the images of a dataset folder into shards (cf iter_image_folder)
+
+    Parameters
+    ----------
+    input_path : string
+        /.../foldername/ laid out as split/label/image
+    output_path : string
+        /.../foldername/ of the shard dataset
+    shard_size : int, optional
+        Maximum size of a shard in bytes. The default is DEFAULT_SHARD_SIZE.
+
+    Returns
+    -------
+    nb_images : int
+        Number of images packed.
+    '''
+    writer = ShardWriter(output_path, shard_size, metadata_columns=['path'])
+    try:
+        for path, label, split in iter_image_folder(input_path):
+            img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            if img is None:
+                raise ValueError('Cannot read the image {}'.format(path))
+            if img.ndim == 3:
+                # OpenCV reads the channels in BGR order
+                img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA if img.shape[2] == 4 else cv2.COLOR_BGR2RGB)
+            writer.add(img, os.path.splitext(os.path.basename(path))[0], label, split,
+                       {'path': os.path.relpath(path, input_path)})
+    finally:
+        writer.close()
+    return writer.nb_images
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description='Pack the images of a dataset folder (split/label/image) into shards')
+    parser.add_argument('input', help='Path to the dataset folder, e.g. a hospital folder with train and valid folders')
+    parser.add_argument('output', help='Path to the output folder of the shards')
+    parser.add_argument('--shardSize', action='store', type=int, default=DEFAULT_SHARD_SIZE // (1024 * 1024), help='Maximum size of a shard in MB. Default is 256.')
+    args = parser.parse_args()
+
+    nb_images = pack_image_folder(args.input, args.output, args.shardSize * 1024 * 1024)
+    print('{} images packed'.format(nb_images))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,107 @@
 
 import argparse
 import ast
+import collections
+import concurrent.futures
+import hashlib
 import json
 import os
+import shutil
+import signal
 import sys
+import time
 import tqdm
 
+from utils import profiling
+from utils import simple_dicomanonymizer
 from utils.simple_dicomanonymizer import *
+from utils.lookup_store import open_lookup_store
+from utils.manifest import Manifest, STATUS_DONE, STATUS_FAILED, describe_error, get_file_state
+from utils.archive_stream import anonymize_archive
+from utils.worker_pool import anonymize_in_pool, start_worker_pool, warm_up_worker
+from utils.io_pipeline import DEFAULT_QUEUE_DEPTH, anonymize_pipelined
+from utils.sharding import parse_shard, select_shard_files
+from utils.pixel_redaction import load_redaction_profiles
+from utils.watch_folder import DEFAULT_BATCH_SIZE, DEFAULT_POLL_INTERVAL, DEFAULT_SETTLE_SECONDS, InboxScanner, \
+    get_relative_path, move_file
+
+# Number of files recorded in the manifest between two commits
+MANIFEST_COMMIT_INTERVAL = 100
+
+
+def open_run_lookup_store(lookup_path: str, lookup_backend: str):
+    '''
+    Open the lookup table once for the whole run, its rows are saved by batches.
+    '''
+    lookup_store = None
+    if lookup_path is not None:
+        lookup_store = open_lookup_store(lookup_path, lookup_backend)
+    simple_dicomanonymizer.lookup_store = lookup_store
+    return lookup_store
+
+
+def close_run_lookup_store(lookup_store, lookup_export_path: str) -> None:
+    '''
+    Save and close the lookup table at the end of the run, and export it to csv if requested.
+    '''
+    if lookup_store is not None:
+        if lookup_export_path is not None:
+            lookup_store.export_csv(lookup_export_path)
+        lookup_store.close()
+        simple_dicomanonymizer.lookup_store = None
+
+
+def close_run_profiler(profile_path: str) -> None:
+    '''
+    Write the timings recorded during the run to profile_path and disable profiling.
+    '''
+    if profile_path is not None and profiling.profiler is not None:
+        profiling.profiler.dump(profile_path)
+        profiling.disable_profiling()
+
+
+def anonymize_files(input_files_list: list, output_files_list: list, lookup_path: str, lookup_store,
+                    anonymization_plan, *, delete_private_tags: bool, rename_files: bool, workers: int,
+                    pixel_passthrough: bool, catch_errors: bool, file_done_callback, readers: int = 0,
+                    writers: int = 0, read_queue_depth: int = DEFAULT_QUEUE_DEPTH,
+                    write_queue_depth: int = DEFAULT_QUEUE_DEPTH, fan_out_levels: int = 0, executor=None) -> None:
+    '''
+    Anonymize a list of files with the worker processes, with the reader and writer threads or one at a time
+    (cf anonymize for the parameters, given by keyword after anonymization_plan). file_done_callback is called with the input file path and the error
+    description (or None) once per file, in input order. executor is a pool started by start_worker_pool,
+    used instead of starting one when workers > 1.
+    '''
+    if workers > 1:
+        anonymize_in_pool(input_files_list, output_files_list, lookup_store, anonymization_plan, delete_private_tags,
+                          rename_files, workers, pixel_passthrough, catch_errors, file_done_callback=file_done_callback,
+                          fan_out_levels=fan_out_levels, executor=executor)
+    elif readers > 0 or writers > 0:
+        anonymize_pipelined(input_files_list, output_files_list, lookup_path, anonymization_plan, delete_private_tags,
+                            rename_files, readers, writers, read_queue_depth, write_queue_depth, pixel_passthrough,
+                            catch_errors, file_done_callback=file_done_callback, fan_out_levels=fan_out_levels)
+    else:
+        for cpt in range(len(input_files_list)):
+            error = None
+            try:
+                anonymize_dicom_file(input_files_list[cpt], output_files_list[cpt], lookup_path, anonymization_plan, delete_private_tags, rename_files, pixel_passthrough, fan_out_levels)
+            except Exception as e:
+                if not catch_errors:
+                    raise
+                error = describe_error(e)
+            file_done_callback(input_files_list[cpt], error)
+
 
 def anonymize(input_path: str, output_path: str,  lookup_path: str, anonymization_actions: dict,
-                delete_private_tags: bool, rename_files: bool) -> None:
+                delete_private_tags: bool, rename_files: bool, *, workers: int = 1, lookup_backend: str = 'csv',
+                lookup_export_path: str = None, pixel_passthrough: bool = False, manifest_path: str = None,
+                use_content_hash: bool = False, quarantine_path: str = None, uid_secret: bytes = None,
+                profile_path: str = None, readers: int = 0, writers: int = 0,
+                read_queue_depth: int = DEFAULT_QUEUE_DEPTH, write_queue_depth: int = DEFAULT_QUEUE_DEPTH,
+                fan_out_levels: int = 0, shard: tuple = None, scrub_all_text: bool = False,
+                redaction_profiles: list = None) -> None:
     '''
     Read data from input path (folder or file) and launch the anonymization.
+    The run options, from workers on, are given by keyword.
 
     Parameters
     ----------
@@ -29,6 +119,47 @@ def anonymize(input_path: str, output_path: str,  lookup_path: str, anonymizatio
         Whether to delete private tags.
     rename_files : bool
         Whether to remane output files with pseudo.
+    workers : int
+        Number of worker processes. If greater than 1, files are anonymized in parallel.
+    lookup_backend : str
+        Backend of the lookup table: 'csv' or 'sqlite'. The default is 'csv'.
+    lookup_export_path : str
+        If set, the lookup table is exported to this csv file at the end of the run.
+    pixel_passthrough : bool
+        Whether to only read and anonymize the headers, the pixel data being copied unchanged.
+    manifest_path : str
+        If set, path to the manifest of the processed files (cf utils.manifest). Files already anonymized
+        with the same rules and unchanged since are skipped, and a file that cannot be anonymized does not
+        stop the run.
+    use_content_hash : bool
+        Whether to detect changed files with a hash of their content instead of their modification time.
+    quarantine_path : str
+        If set, files that cannot be anonymized are copied to this folder and do not stop the run.
+    uid_secret : bytes
+        If set, site secret from which the replaced UIDs are derived, so that a UID is always replaced
+        with the same value, whatever the run or the process.
+    profile_path : str
+        If set, the time spent in each stage and action and the latencies of the files are recorded
+        and written to this JSON file at the end of the run (cf utils.profiling).
+    readers : int
+        Number of threads reading the next files while a file is anonymized (cf utils.io_pipeline).
+        Only used with a single worker. The default is 0: files are read one at a time.
+    writers : int
+        Number of threads writing the anonymized files in the background. Only used with a single worker.
+        The default is 0: files are written one at a time.
+    read_queue_depth : int
+        Maximum number of files read ahead by the reader threads.
+    write_queue_depth : int
+        Maximum number of anonymized files waiting for the writer threads.
+    fan_out_levels : int
+        With rename_files, number of levels of hashed subfolders the output files are spread into.
+    shard : tuple
+        If set, (shard index, number of shards): only the files of the patients whose PatientID hashes
+        to this shard are anonymized (cf utils.sharding). Each shard should use its own lookup table.
+    scrub_all_text : bool
+        Whether to apply the regexp rules, in one pass, to every text element instead of their own tags.
+    redaction_profiles : list
+        RedactionProfile objects (cf utils.pixel_redaction) applied to the pixels of the matching files.
 
     Returns
     -------
@@ -47,8 +178,7 @@ def anonymize(input_path: str, output_path: str,  lookup_path: str, anonymizatio
             output_path = output_folder + os.path.basename(input_path)
 
     if input_folder != '' and output_folder == '':
-        print('Error, please set a correct output folder path')
-        sys.exit()
+        raise ValueError('Please set a correct output folder path: {} is not a folder'.format(output_path))
 
     # Generate list of input file if a folder has been set
     input_files_list = []
@@ -62,12 +192,302 @@ def anonymize(input_path: str, output_path: str,  lookup_path: str, anonymizatio
             input_files_list.append(input_folder + '/' + fileName)
             output_files_list.append(output_folder + '/' + fileName)
 
+    # Keep the patients of this node
+    if shard is not None:
+        input_files_list, output_files_list = select_shard_files(input_files_list, output_files_list, *shard)
+        print('Shard {}/{}: {} files'.format(shard[0], shard[1], len(input_files_list)))
+
+    # The anonymization rules are compiled once for the whole run
+    anonymization_plan = compile_anonymization_plan(anonymization_actions, scrub_all_text, redaction_profiles)
+    simple_dicomanonymizer.uid_secret = uid_secret
+
+    # Skip the files anonymized by a previous run with the same rules
+    manifest = None
+    file_states = {}
+    nb_skipped_files = 0
+    # A change of UID secret changes the profile, the secret itself is not stored
+    uid_secret_fingerprint = hmac_uid('profile') if uid_secret is not None else None
+    profile_hash = hashlib.sha256('{} {} {} {} {}'.format(anonymization_plan.fingerprint, delete_private_tags,
+                                                          rename_files, fan_out_levels,
+                                                          uid_secret_fingerprint).encode()).hexdigest()
+    if manifest_path is not None:
+        manifest = Manifest(manifest_path)
+        files_to_anonymize = []
+        for in_file, out_file in zip(input_files_list, output_files_list):
+            state = get_file_state(in_file, use_content_hash)
+            if manifest.is_up_to_date(in_file, state, profile_hash):
+                nb_skipped_files += 1
+            else:
+                file_states[in_file] = state
+                files_to_anonymize.append((in_file, out_file))
+        input_files_list = [in_file for in_file, out_file in files_to_anonymize]
+        output_files_list = [out_file for in_file, out_file in files_to_anonymize]
+
+    catch_errors = manifest is not None or quarantine_path is not None
+    if quarantine_path is not None:
+        os.makedirs(quarantine_path, exist_ok=True)
+    failed_files = []
+
+    lookup_store = open_run_lookup_store(lookup_path, lookup_backend)
+    if profile_path is not None:
+        profiling.enable_profiling()
+
     progress_bar = tqdm.tqdm(total=len(input_files_list))
-    for cpt in range(len(input_files_list)):
-        anonymize_dicom_file(input_files_list[cpt], output_files_list[cpt], lookup_path, anonymization_actions, delete_private_tags, rename_files)
+
+    def file_done(in_file, error):
+        if error is not None:
+            failed_files.append(in_file)
+            tqdm.tqdm.write('Cannot anonymize {}: {}'.format(in_file, error))
+            if quarantine_path is not None:
+                try:
+                    shutil.copy2(in_file, quarantine_path)
+                except OSError as e:
+                    tqdm.tqdm.write('Cannot copy {} to quarantine: {}'.format(in_file, e))
+        if manifest is not None:
+            manifest.record(in_file, file_states[in_file], profile_hash,
+                            STATUS_DONE if error is None else STATUS_FAILED, error)
+            if manifest.nb_pending_records >= MANIFEST_COMMIT_INTERVAL:
+                # Lookup rows are saved before the files using them are recorded as done
+                if lookup_store is not None:
+                    lookup_store.commit()
+                manifest.commit()
+        progress_bar.update(1)
+
+    try:
+        anonymize_files(input_files_list, output_files_list, lookup_path, lookup_store, anonymization_plan,
+                        delete_private_tags=delete_private_tags, rename_files=rename_files, workers=workers,
+                        pixel_passthrough=pixel_passthrough, catch_errors=catch_errors, file_done_callback=file_done,
+                        readers=readers, writers=writers, read_queue_depth=read_queue_depth,
+                        write_queue_depth=write_queue_depth, fan_out_levels=fan_out_levels)
+    finally:
+        progress_bar.close()
+        close_run_lookup_store(lookup_store, lookup_export_path)
+        if manifest is not None:
+            manifest.close()
+        close_run_profiler(profile_path)
+
+    if nb_skipped_files > 0:
+        print('{} files skipped, already anonymized'.format(nb_skipped_files))
+    if failed_files:
+        print('{} files could not be anonymized'.format(len(failed_files)))
+
+
+def anonymize_from_archive(input_path: str, output_path: str, lookup_path: str, anonymization_actions: dict,
+                           delete_private_tags: bool, rename_files: bool, *, lookup_backend: str = 'csv',
+                           lookup_export_path: str = None, pixel_passthrough: bool = False,
+                           quarantine_path: str = None, uid_secret: bytes = None, profile_path: str = None,
+                           fan_out_levels: int = 0, scrub_all_text: bool = False,
+                           redaction_profiles: list = None) -> None:
+    '''
+    Read DICOM files from a zip or tar archive and write them anonymized to a tar archive, in a single
+    pass and without temporary files (cf utils.archive_stream).
+
+    Parameters
+    ----------
+    input_path : str
+        Path to the input zip or tar archive, or '-' to read a tar archive from the standard input.
+    output_path : str
+        Path to the output tar archive (gzip compressed if it ends with .gz or .tgz), or '-' to write it
+        to the standard output.
+    lookup_path : str
+        Path to lookup table.
+    anonymization_actions : dict
+        List of actions that will be applied on tags.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to remane output files with pseudo.
+    lookup_backend : str
+        Backend of the lookup table: 'csv' or 'sqlite'. The default is 'csv'.
+    lookup_export_path : str
+        If set, the lookup table is exported to this csv file at the end of the run.
+    pixel_passthrough : bool
+        Whether to only parse and anonymize the headers, the pixel data bytes being copied unchanged.
+    quarantine_path : str
+        If set, files that cannot be anonymized are written to this folder and do not stop the run.
+    uid_secret : bytes
+        If set, site secret from which the replaced UIDs are derived.
+    profile_path : str
+        If set, the timings of the anonymization are written to this JSON file at the end of the run.
+    fan_out_levels : int
+        With rename_files, number of levels of hashed subfolders the output members are spread into.
+    scrub_all_text : bool
+        Whether to apply the regexp rules, in one pass, to every text element instead of their own tags.
+    redaction_profiles : list
+        RedactionProfile objects (cf utils.pixel_redaction) applied to the pixels of the matching files.
+
+    Returns
+    -------
+    None.
+    '''
+    anonymization_plan = compile_anonymization_plan(anonymization_actions, scrub_all_text, redaction_profiles)
+    simple_dicomanonymizer.uid_secret = uid_secret
+    if quarantine_path is not None:
+        os.makedirs(quarantine_path, exist_ok=True)
+    failed_files = []
+
+    lookup_store = open_run_lookup_store(lookup_path, lookup_backend)
+    if profile_path is not None:
+        profiling.enable_profiling()
+    progress_bar = tqdm.tqdm()
+
+    def member_done(name, error):
+        if error is not None:
+            failed_files.append(name)
+            tqdm.tqdm.write('Cannot anonymize {}: {}'.format(name, error))
         progress_bar.update(1)
 
-    progress_bar.close()
+    try:
+        anonymize_archive(input_path, output_path, lookup_path, anonymization_plan, delete_private_tags,
+                          rename_files, pixel_passthrough, quarantine_path, member_done_callback=member_done,
+                          fan_out_levels=fan_out_levels)
+    finally:
+        progress_bar.close()
+        close_run_lookup_store(lookup_store, lookup_export_path)
+        close_run_profiler(profile_path)
+
+    if failed_files:
+        print('{} files could not be anonymized'.format(len(failed_files)), file=sys.stderr)
+
+
+def watch(input_path: str, output_path: str, lookup_path: str, anonymization_actions: dict,
+          delete_private_tags: bool, rename_files: bool, done_path: str, failed_path: str, *, workers: int = 1,
+          lookup_backend: str = 'csv', lookup_export_path: str = None, pixel_passthrough: bool = False,
+          uid_secret: bytes = None, profile_path: str = None, readers: int = 0, writers: int = 0,
+          fan_out_levels: int = 0, scrub_all_text: bool = False, redaction_profiles: list = None,
+          poll_interval: float = DEFAULT_POLL_INTERVAL, settle_seconds: float = DEFAULT_SETTLE_SECONDS,
+          batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+    '''
+    Watch an inbox folder and anonymize its new files by micro-batches until the process is interrupted
+    (Ctrl+C or SIGTERM), cf utils.watch_folder.
+
+    The anonymization rules are compiled and the worker processes are started once, so a new file is
+    anonymized within seconds of being complete. The anonymized files are written to output_path, and each
+    input file is then moved to done_path or, if it cannot be anonymized, to failed_path along with a
+    .error file describing the error. The lookup rows of a batch are saved before its files are moved.
+
+    Parameters
+    ----------
+    input_path : str
+        Inbox folder, subfolders included.
+    output_path : str
+        Folder of the anonymized files. The subfolders of the inbox are kept, unless rename_files is set.
+    done_path : str
+        Folder the anonymized input files are moved to.
+    failed_path : str
+        Folder the input files which cannot be anonymized are moved to.
+    poll_interval : float
+        Time in seconds between two scans of the inbox when it holds no complete file.
+    settle_seconds : float
+        Minimum time in seconds since the last modification of a file before it is picked up.
+    batch_size : int
+        Maximum number of files anonymized in a batch.
+
+    The other parameters are those of anonymize.
+
+    Returns
+    -------
+    None.
+    '''
+    if not os.path.isdir(input_path):
+        raise ValueError('The inbox {} is not a folder'.format(input_path))
+    inbox = os.path.abspath(input_path)
+    for folder in (output_path, done_path, failed_path):
+        if os.path.abspath(folder) == inbox or os.path.abspath(folder).startswith(inbox + os.sep):
+            raise ValueError('The folder {} must not be in the inbox'.format(folder))
+        os.makedirs(folder, exist_ok=True)
+
+    anonymization_plan = compile_anonymization_plan(anonymization_actions, scrub_all_text, redaction_profiles)
+    simple_dicomanonymizer.uid_secret = uid_secret
+    lookup_store = open_run_lookup_store(lookup_path, lookup_backend)
+    if profile_path is not None:
+        profiling.enable_profiling()
+
+    executor = None
+    if workers > 1:
+        executor = start_worker_pool(lookup_store, anonymization_plan, workers)
+        # The workers are started (imports, anonymization plan) before the first files arrive
+        for future in [executor.submit(warm_up_worker) for _ in range(workers)]:
+            future.result()
+
+    # Number of batches each file was in when a worker process died
+    nb_crashes = collections.Counter()
+
+    def log(message):
+        print('{} {}'.format(time.strftime('%Y-%m-%d %H:%M:%S'), message), flush=True)
+
+    def anonymize_batch(input_files_list):
+        nonlocal executor
+        start = time.perf_counter()
+        if rename_files:
+            # The names of the subfolders of the inbox may identify the patients
+            output_files_list = [os.path.join(output_path, os.path.basename(in_file)) for in_file in input_files_list]
+        else:
+            output_files_list = [get_relative_path(in_file, input_path, output_path) for in_file in input_files_list]
+            for out_file in output_files_list:
+                os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        errors = {}
+
+        def file_done(in_file, error):
+            errors[in_file] = error
+
+        try:
+            anonymize_files(input_files_list, output_files_list, lookup_path, lookup_store, anonymization_plan,
+                            delete_private_tags=delete_private_tags, rename_files=rename_files, workers=workers,
+                            pixel_passthrough=pixel_passthrough, catch_errors=True, file_done_callback=file_done,
+                            readers=readers, writers=writers, fan_out_levels=fan_out_levels, executor=executor)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            # A worker died (e.g. in a pixel data decoder): the pool is started again and the files not done
+            # are retried with the next batch, unless they were already in a batch which broke the pool
+            log('A worker process died, restarting the workers')
+            executor.shutdown(wait=True)
+            executor = start_worker_pool(lookup_store, anonymization_plan, workers)
+            for in_file in input_files_list:
+                if in_file not in errors:
+                    nb_crashes[in_file] += 1
+                    if nb_crashes[in_file] > 1:
+                        errors[in_file] = describe_error(e)
+
+        # Lookup rows are saved before the files using them are moved to the done folder
+        if lookup_store is not None:
+            lookup_store.commit()
+        nb_failed_files = 0
+        for in_file, error in errors.items():
+            nb_crashes.pop(in_file, None)
+            if error is None:
+                move_file(in_file, input_path, done_path)
+                continue
+            nb_failed_files += 1
+            log('Cannot anonymize {}: {}'.format(in_file, error))
+            failed_file = move_file(in_file, input_path, failed_path)
+            with open(failed_file + '.error', 'w') as error_file:
+                error_file.write(error + '\n')
+        log('{} files anonymized, {} failed in {:.1f} s'.format(len(errors) - nb_failed_files, nb_failed_files,
+                                                                time.perf_counter() - start))
+
+    stop_signals = []
+    previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: stop_signals.append(signum))
+    scanner = InboxScanner(input_path, settle_seconds)
+    log('Watching {}'.format(input_path))
+    try:
+        while not stop_signals:
+            ready_files = scanner.scan()
+            if not ready_files:
+                time.sleep(poll_interval)
+                continue
+            for start in range(0, len(ready_files), batch_size):
+                anonymize_batch(ready_files[start:start + batch_size])
+                if stop_signals:
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        close_run_lookup_store(lookup_store, lookup_export_path)
+        close_run_profiler(profile_path)
+        log('Stopped watching {}'.format(input_path))
 
 
 def generate_actions_dictionary(map_action_tag, defined_action_map = {}) -> dict:
@@ -96,7 +516,7 @@ def generate_actions_dictionary(map_action_tag, defined_action_map = {}) -> dict
         if callable(action):
             action_function = action
         else:
-            action_function = defined_action_map[action] if action in defined_action_map else eval(action)
+            action_function = get_action(action, defined_action_map)
 
         # Generate the map
         if cpt == 0:
@@ -108,6 +528,53 @@ def generate_actions_dictionary(map_action_tag, defined_action_map = {}) -> dict
     return generated_map
 
 
+def read_actions_dictionary(dictionary_path: str, defined_action_map: dict = {}) -> dict:
+    '''
+    Read the actions of a dictionary file (--dictionary), which maps tags to action names or, for the
+    regexp action, to {"action": "regexp", "find": ..., "replace": ...}
+
+    Parameters
+    ----------
+    dictionary_path : str
+        Path to the JSON dictionary.
+    defined_action_map : dict
+        Link action name to action function
+
+    Returns
+    -------
+    anonymization_actions : dict
+        The map of actions.
+    '''
+    anonymization_actions = {}
+    with open(dictionary_path) as json_file:
+        data = json.load(json_file)
+        for key, value in data.items():
+            action_name = value
+            options = None
+            if type(value) is dict:
+                action_name = value['action']
+                options = {
+                    "find": value['find'],
+                    "replace" : value['replace']
+                }
+
+            l = [ast.literal_eval(key)]
+            action = get_action(action_name, defined_action_map)
+            add_actions(anonymization_actions, generate_actions(l, action, options))
+    return anonymization_actions
+
+
+def read_uid_secret(secret_path: str) -> bytes:
+    '''
+    Read the site secret from which the replaced UIDs are derived.
+    '''
+    with open(secret_path, 'rb') as secret_file:
+        uid_secret = secret_file.read().strip()
+    if not uid_secret:
+        raise ValueError('The UID secret file {} is empty'.format(secret_path))
+    return uid_secret
+
+
 def main(defined_action_map = {}):
     parser = argparse.ArgumentParser(add_help=True)
     parser.add_argument('input', help='Path to the input dicom file or input directory which contains dicom files')
@@ -115,13 +582,43 @@ def main(defined_action_map = {}):
     parser.add_argument('-t', action='append', nargs='*', help='tags action : Defines a new action to apply on the tag.'\
     '\'regexp\' action takes two arguments: '\
         '1. regexp to find substring '\
-        '2. the string that will replace the previous found string')
+        '2. the string that will replace the previous found string. '\
+        'The regexp actions of the same tag are applied together, in one pass')
     parser.add_argument('--lookup', action='store', help='Path to the lookup table to be written after pseudonymization')
+    parser.add_argument('--lookupBackend', action='store', choices=['csv', 'sqlite'], default='csv', help='Storage of the lookup table: csv file or SQLite database')
+    parser.add_argument('--exportLookup', action='store', help='Path to a csv file where the lookup table is exported at the end of the run')
     parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that can be added to the original one')
+    parser.add_argument('--scrubAllText', action='store_true', dest='scrubAllText', help='If used, all the regexp rules are applied in one pass to every text element (AE, CS, LO, LT, PN, SH, ST, UC, UR, UT), including in sequences, instead of each rule to its own tag')
+    parser.set_defaults(scrubAllText=False)
+    parser.add_argument('--redactionProfiles', action='store', help='JSON file of the regions of the pixels to redact (set to zero) per modality, manufacturer and geometry. The pixel data of the files matching no profile is copied unchanged')
     parser.add_argument('--keepPrivateTags', action='store_true', dest='keepPrivateTags', help='If used, then private tags won\'t be deleted')
     parser.set_defaults(keepPrivateTags=False)
-    parser.add_argument('--renameFiles', action='store_true', dest='renameFiles', help="If used, rename output files using PaitentID + AccessionNumber")
+    parser.add_argument('--renameFiles', action='store_true', dest='renameFiles', help="If used, rename output files using PaitentID + AccessionNumber + a hash of the SOPInstanceUID")
     parser.set_defaults(renameFiles=False)
+    parser.add_argument('--shard', action='store', help='Shard of this node, as index/count (e.g. 0/4): only the files of the patients whose PatientID hashes to this shard are anonymized. Use one lookup table per shard and merge them with merge_lookup.py')
+    parser.add_argument('--fanOut', action='store', type=int, default=0, help='With --renameFiles, number of levels of subfolders (named from a hash) the output files are spread into')
+    parser.add_argument('--pixelPassthrough', action='store_true', dest='pixelPassthrough', help='If used, only the header is read and anonymized, the pixel data is copied unchanged')
+    parser.set_defaults(pixelPassthrough=False)
+    parser.add_argument('--manifest', action='store', help='Path to the manifest of processed files, used to skip the files already anonymized by a previous run')
+    parser.add_argument('--contentHash', action='store_true', dest='contentHash', help='If used, changed files are detected with a hash of their content instead of their modification time')
+    parser.set_defaults(contentHash=False)
+    parser.add_argument('--quarantine', action='store', help='Folder where the files that cannot be anonymized are copied, instead of stopping the run')
+    parser.add_argument('--uidSecretFile', action='store', help='File containing the site secret from which replaced UIDs are derived. If used, a UID is replaced with the same value in every run')
+    parser.add_argument('--archive', action='store_true', dest='archive', help='If used, the input is a zip or tar archive (or - for a tar archive on the standard input) and the output a tar archive (or - for the standard output)')
+    parser.set_defaults(archive=False)
+    parser.add_argument('--profile', action='store', help='Path to a JSON file where the time spent in each stage and action, and the latencies of the files, are written at the end of the run')
+    parser.add_argument('--workers', action='store', type=int, default=1, help='Number of processes used to anonymize files in parallel')
+    parser.add_argument('--readers', action='store', type=int, default=0, help='Number of threads reading the next files while a file is anonymized, when a single process is used')
+    parser.add_argument('--writers', action='store', type=int, default=0, help='Number of threads writing the anonymized files in the background, when a single process is used')
+    parser.add_argument('--readQueue', action='store', type=int, default=DEFAULT_QUEUE_DEPTH, help='Maximum number of files read ahead by the reader threads')
+    parser.add_argument('--writeQueue', action='store', type=int, default=DEFAULT_QUEUE_DEPTH, help='Maximum number of anonymized files waiting for the writer threads')
+    parser.add_argument('--watch', action='store_true', dest='watch', help='If used, the input folder is an inbox watched until the process is stopped: its new files are anonymized by batches and moved to --doneFolder or --failedFolder')
+    parser.set_defaults(watch=False)
+    parser.add_argument('--doneFolder', action='store', help='With --watch, folder the anonymized input files are moved to')
+    parser.add_argument('--failedFolder', action='store', help='With --watch, folder the input files which cannot be anonymized are moved to, with a .error file')
+    parser.add_argument('--pollInterval', action='store', type=float, default=DEFAULT_POLL_INTERVAL, help='With --watch, seconds between two scans of the inbox')
+    parser.add_argument('--settleTime', action='store', type=float, default=DEFAULT_SETTLE_SECONDS, help='With --watch, seconds without modification after which a file is complete')
+    parser.add_argument('--batchSize', action='store', type=int, default=DEFAULT_BATCH_SIZE, help='With --watch, maximum number of files anonymized in a batch')
     args = parser.parse_args()
 
     input_path = args.input
@@ -129,7 +626,6 @@ def main(defined_action_map = {}):
 
     # Create a new actions' dictionary from parameters
     new_anonymization_actions = {}
-    cpt = 0
     if args.t:
         number_of_new_tags_actions = len(args.t)
         if number_of_new_tags_actions > 0:
@@ -152,42 +648,67 @@ def main(defined_action_map = {}):
 
                 tags_list = [ast.literal_eval(current_tag_parameters[0])]
 
-                action = eval(action_name)
-                # When generate_actions is called and we have options, we don't want use regexp
-                # as an action but we want to call it to generate a new method
-                if options is not None:
-                    action = action_name
+                action = get_action(action_name, defined_action_map)
 
-                if cpt == 0:
-                    new_anonymization_actions = generate_actions(tags_list, action, options)
-                else:
-                    new_anonymization_actions.update(generate_actions(tags_list, action, options))
-                cpt += 1
+                # The regexp rules of the same tag are applied together
+                add_actions(new_anonymization_actions, generate_actions(tags_list, action, options))
 
     # Read an existing dictionary
     if args.dictionary:
-        with open(args.dictionary) as json_file:
-            data = json.load(json_file)
-            for key, value in data.items():
-                action_name = value
-                options = None
-                if type(value) is dict:
-                    action_name = value['action']
-                    options = {
-                        "find": value['find'],
-                        "replace" : value['replace']
-                    }
+        add_actions(new_anonymization_actions, read_actions_dictionary(args.dictionary, defined_action_map))
+
+    uid_secret = None
+    if args.uidSecretFile:
+        uid_secret = read_uid_secret(args.uidSecretFile)
 
-                l = [ast.literal_eval(key)]
-                action = defined_action_map[action_name] if action_name in defined_action_map else eval(action_name)
-                if cpt == 0:
-                    new_anonymization_actions = generate_actions(l, action, options)
-                else:
-                    new_anonymization_actions.update(generate_actions(l, action, options))
-                cpt += 1
+    redaction_profiles = None
+    if args.redactionProfiles:
+        redaction_profiles = load_redaction_profiles(args.redactionProfiles)
 
     # Launch the anonymization
-    anonymize(input_path, output_path, args.lookup, new_anonymization_actions, not args.keepPrivateTags, args.renameFiles)
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.watch:
+        if args.doneFolder is None or args.failedFolder is None:
+            parser.error('--doneFolder and --failedFolder are required with --watch')
+        for option, value in (('--archive', args.archive), ('--shard', shard), ('--manifest', args.manifest),
+                              ('--quarantine', args.quarantine)):
+            if value:
+                parser.error('{} cannot be used with --watch'.format(option))
+        watch(input_path, output_path, args.lookup, new_anonymization_actions, not args.keepPrivateTags,
+              args.renameFiles, args.doneFolder, args.failedFolder, workers=args.workers,
+              lookup_backend=args.lookupBackend, lookup_export_path=args.exportLookup,
+              pixel_passthrough=args.pixelPassthrough, uid_secret=uid_secret, profile_path=args.profile,
+              readers=args.readers, writers=args.writers, fan_out_levels=args.fanOut,
+              scrub_all_text=args.scrubAllText, redaction_profiles=redaction_profiles,
+              poll_interval=args.pollInterval, settle_seconds=args.settleTime, batch_size=args.batchSize)
+        return
+
+    if args.archive:
+        if shard is not None:
+            parser.error('--shard cannot be used with --archive')
+        if args.manifest:
+            parser.error('--manifest cannot be used with --archive')
+        anonymize_from_archive(input_path, output_path, args.lookup, new_anonymization_actions, not args.keepPrivateTags,
+                               args.renameFiles, lookup_backend=args.lookupBackend,
+                               lookup_export_path=args.exportLookup, pixel_passthrough=args.pixelPassthrough,
+                               quarantine_path=args.quarantine, uid_secret=uid_secret, profile_path=args.profile,
+                               fan_out_levels=args.fanOut, scrub_all_text=args.scrubAllText,
+                               redaction_profiles=redaction_profiles)
+        return
+
+    anonymize(input_path, output_path, args.lookup, new_anonymization_actions, not args.keepPrivateTags, args.renameFiles,
+              workers=args.workers, lookup_backend=args.lookupBackend, lookup_export_path=args.exportLookup,
+              pixel_passthrough=args.pixelPassthrough, manifest_path=args.manifest, use_content_hash=args.contentHash,
+              quarantine_path=args.quarantine, uid_secret=uid_secret, profile_path=args.profile,
+              readers=args.readers, writers=args.writers, read_queue_depth=args.readQueue,
+              write_queue_depth=args.writeQueue, fan_out_levels=args.fanOut, shard=shard,
+              scrub_all_text=args.scrubAllText, redaction_profiles=redaction_profiles)
 
 if __name__ == "__main__":
     main()
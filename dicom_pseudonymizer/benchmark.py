@@ -0,0 +1,204 @@
+'''
+Benchmark of the anonymizer on a synthetic DICOM corpus (cf utils.synthetic_corpus).
+
+The anonymization of the corpus is timed per stage (reading, anonymization rules, writing) on a single
+process, then end to end with anonymizer.anonymize for each requested configuration. The throughputs
+(files/s and MB/s of input) are printed and written to a JSON file so that runs can be compared.
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import pydicom
+
+import anonymizer
+from utils import simple_dicomanonymizer
+from utils.dicom_io import read_dicom_file, write_dicom_file
+from utils.lookup_store import MemoryLookupStore
+from utils.synthetic_corpus import generate_corpus
+
+# Stages timed by benchmark_stages, in processing order
+STAGES = ['read', 'rules', 'write']
+
+
+def throughput(seconds: float, nb_files: int, nb_bytes: int) -> dict:
+    '''
+    Describe the processing of nb_files files (nb_bytes bytes) in seconds.
+    '''
+    return {
+        "seconds": seconds,
+        "files_per_second": nb_files / seconds if seconds > 0 else None,
+        "mb_per_second": nb_bytes / 1e6 / seconds if seconds > 0 else None,
+        "ms_per_file": 1000 * seconds / nb_files if nb_files > 0 else None
+    }
+
+
+def benchmark_stages(input_files: list, nb_bytes: int, output_folder: str, pixel_passthrough: bool = False) -> dict:
+    '''
+    Time the reading, the anonymization rules and the writing of the files on the current process
+
+    Parameters
+    ----------
+    input_files : list
+        Paths to the files of the corpus.
+    nb_bytes : int
+        Total size of the files.
+    output_folder : str
+        Folder where the anonymized files are written.
+    pixel_passthrough : bool
+        Whether to only read and anonymize the headers.
+
+    Returns
+    -------
+    stages : dict
+        Throughput of each stage.
+    '''
+    anonymization_plan = simple_dicomanonymizer.compile_anonymization_plan()
+    # Pseudonyms are kept in memory, so that the lookup table does not weigh on the rules stage
+    lookup_path = os.path.join(output_folder, 'lookup.csv')
+    simple_dicomanonymizer.lookup_path = lookup_path
+    simple_dicomanonymizer.lookup_store = MemoryLookupStore(lookup_path)
+
+    durations = dict.fromkeys(STAGES, 0.0)
+    try:
+        for in_file in input_files:
+            start = time.perf_counter()
+            dataset, pixel_data_offset = read_dicom_file(in_file, pixel_passthrough)
+            read_end = time.perf_counter()
+            simple_dicomanonymizer.anonymize_dataset(dataset, anonymization_plan)
+            rules_end = time.perf_counter()
+            write_dicom_file(dataset, os.path.join(output_folder, os.path.basename(in_file)), in_file,
+                             pixel_data_offset)
+            write_end = time.perf_counter()
+            durations['read'] += read_end - start
+            durations['rules'] += rules_end - read_end
+            durations['write'] += write_end - rules_end
+    finally:
+        simple_dicomanonymizer.lookup_store = None
+        simple_dicomanonymizer.lookup_path = None
+
+    stages = {stage: throughput(durations[stage], len(input_files), nb_bytes) for stage in STAGES}
+    stages['total'] = throughput(sum(durations.values()), len(input_files), nb_bytes)
+    return stages
+
+
+def benchmark_end_to_end(corpus_folder: str, nb_files: int, nb_bytes: int, work_folder: str, workers: int,
+                         pixel_passthrough: bool, lookup_backend: str) -> dict:
+    '''
+    Time anonymizer.anonymize on the corpus folder with the default profile and a new lookup table.
+    '''
+    output_folder = os.path.join(work_folder, 'output')
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    lookup_path = os.path.join(work_folder, 'lookup.' + ('db' if lookup_backend == 'sqlite' else 'csv'))
+    if os.path.exists(lookup_path):
+        os.remove(lookup_path)
+
+    start = time.perf_counter()
+    anonymizer.anonymize(corpus_folder, output_folder, lookup_path, {}, True, False, workers=workers,
+                         lookup_backend=lookup_backend, pixel_passthrough=pixel_passthrough)
+    return throughput(time.perf_counter() - start, nb_files, nb_bytes)
+
+
+def get_environment() -> dict:
+    '''
+    Describe the machine and the versions the benchmark runs with.
+    '''
+    return {
+        "python": platform.python_version(),
+        "pydicom": pydicom.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description='Benchmark the anonymizer on a synthetic DICOM corpus')
+    parser.add_argument('output', help='Path to the JSON file where the results are written')
+    parser.add_argument('--corpus', action='store', help='Folder of the corpus. It is generated if it does not exist or is empty, otherwise its files are used as is. By default, a temporary corpus is generated')
+    parser.add_argument('--files', action='store', type=int, default=200, help='Number of files of the generated corpus')
+    parser.add_argument('--patients', action='store', type=int, default=50, help='Number of distinct patients of the generated corpus')
+    parser.add_argument('--studiesPerPatient', action='store', type=int, default=2, help='Number of studies of each patient')
+    parser.add_argument('--rows', action='store', type=int, default=256, help='Number of rows of the generated images')
+    parser.add_argument('--columns', action='store', type=int, default=256, help='Number of columns of the generated images')
+    parser.add_argument('--frames', action='store', type=int, default=8, help='Number of frames of the multi-frame files')
+    parser.add_argument('--multiFrameInterval', action='store', type=int, default=4, help='One file out of multiFrameInterval is a multi-frame file')
+    parser.add_argument('--sequenceDepth', action='store', type=int, default=2, help='Depth of the nested sequences')
+    parser.add_argument('--privateTags', action='store', type=int, default=4, help='Number of private tags of each file')
+    parser.add_argument('--curves', action='store', type=int, default=2, help='Number of curve groups of each file')
+    parser.add_argument('--overlays', action='store', type=int, default=1, help='Number of overlay groups of each file')
+    parser.add_argument('--workers', action='store', type=int, nargs='+', default=[1], help='Numbers of processes of the end to end runs')
+    parser.add_argument('--lookupBackend', action='store', choices=['csv', 'sqlite'], default='csv', help='Storage of the lookup table of the end to end runs')
+    parser.add_argument('--pixelPassthrough', action='store_true', dest='pixelPassthrough', help='If used, every run is also timed in pixel passthrough mode')
+    parser.set_defaults(pixelPassthrough=False)
+    parser.add_argument('--repeat', action='store', type=int, default=1, help='Number of times each run is repeated, the fastest one is reported')
+    args = parser.parse_args()
+
+    work_folder = tempfile.mkdtemp(prefix='anonymizer_benchmark_')
+    try:
+        corpus_folder = args.corpus if args.corpus is not None else os.path.join(work_folder, 'corpus')
+        corpus = {
+            "folder": os.path.abspath(corpus_folder),
+            "generated": False
+        }
+        if not os.path.isdir(corpus_folder) or not os.listdir(corpus_folder):
+            print('Generating {} files in {}'.format(args.files, corpus_folder))
+            generate_corpus(corpus_folder, args.files, frames=args.frames, multi_frame_interval=args.multiFrameInterval,
+                            nb_patients=args.patients, studies_per_patient=args.studiesPerPatient, rows=args.rows,
+                            columns=args.columns, sequence_depth=args.sequenceDepth, nb_private_tags=args.privateTags,
+                            nb_curves=args.curves, nb_overlays=args.overlays)
+            corpus["generated"] = True
+            corpus["parameters"] = {key: value for key, value in vars(args).items()
+                                    if key not in ['output', 'corpus', 'workers', 'lookupBackend', 'pixelPassthrough', 'repeat']}
+
+        input_files = sorted(os.path.join(corpus_folder, file_name) for file_name in os.listdir(corpus_folder))
+        nb_bytes = sum(os.path.getsize(in_file) for in_file in input_files)
+        corpus["files"] = len(input_files)
+        corpus["bytes"] = nb_bytes
+
+        pixel_passthrough_modes = [False, True] if args.pixelPassthrough else [False]
+        runs = []
+        for pixel_passthrough in pixel_passthrough_modes:
+            stage_runs = []
+            for repeat in range(args.repeat):
+                stage_folder = os.path.join(work_folder, 'stages')
+                shutil.rmtree(stage_folder, ignore_errors=True)
+                os.makedirs(stage_folder)
+                stage_runs.append(benchmark_stages(input_files, nb_bytes, stage_folder, pixel_passthrough))
+            stages = min(stage_runs, key=lambda stage_run: stage_run['total']['seconds'])
+            runs.append({"kind": "stages", "workers": 1, "pixel_passthrough": pixel_passthrough, **stages})
+            print('Stages{}: {}'.format(' (pixel passthrough)' if pixel_passthrough else '',
+                                        ', '.join('{} {:.2f} ms/file'.format(stage, stages[stage]['ms_per_file'])
+                                                  for stage in STAGES)))
+
+            for workers in args.workers:
+                end_to_end = min((benchmark_end_to_end(corpus_folder, len(input_files), nb_bytes, work_folder, workers,
+                                                       pixel_passthrough, args.lookupBackend)
+                                  for repeat in range(args.repeat)), key=lambda result: result['seconds'])
+                runs.append({"kind": "end_to_end", "workers": workers, "pixel_passthrough": pixel_passthrough,
+                             "lookup_backend": args.lookupBackend, **end_to_end})
+                print('End to end, {} workers{}: {:.1f} files/s, {:.1f} MB/s'.format(
+                    workers, ', pixel passthrough' if pixel_passthrough else '',
+                    end_to_end['files_per_second'], end_to_end['mb_per_second']))
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    results = {
+        "date": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "environment": get_environment(),
+        "corpus": corpus,
+        "runs": runs
+    }
+    with open(args.output, 'w') as results_file:
+        json.dump(results, results_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
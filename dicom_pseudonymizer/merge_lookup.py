@@ -0,0 +1,74 @@
+'''
+Merge the lookup tables written by the nodes of a sharded run (anonymizer.py --shard) into one table,
+and report the conflicting mappings (cf utils.sharding.merge_lookup_shards).
+'''
+
+import argparse
+import os
+import sys
+
+from utils.lookup_store import open_lookup_store
+from utils.sharding import merge_lookup_shards
+
+
+def merge_lookup(shard_paths: list, output_path: str = None, lookup_backend: str = 'csv',
+                 output_backend: str = None) -> list:
+    '''
+    Merge the shards of a lookup table
+
+    Parameters
+    ----------
+    shard_paths : list
+        Paths to the lookup tables of the shards.
+    output_path : str
+        Path to the merged lookup table. It must not exist. If None, the shards are only checked.
+    lookup_backend : str
+        Backend of the lookup tables of the shards: 'csv' or 'sqlite'.
+    output_backend : str
+        Backend of the merged lookup table. The default is lookup_backend.
+
+    Returns
+    -------
+    conflicts : list
+        List of (shard path, row, description of the conflict).
+    '''
+    if output_path is not None and os.path.exists(output_path):
+        raise ValueError('The merged lookup table {} already exists'.format(output_path))
+
+    shard_stores = [open_lookup_store(shard_path, lookup_backend, read_only=True) for shard_path in shard_paths]
+    output_store = None
+    try:
+        if output_path is not None:
+            output_store = open_lookup_store(output_path, output_backend or lookup_backend)
+        conflicts = merge_lookup_shards(shard_stores, output_store)
+    finally:
+        for store in shard_stores:
+            store.close()
+        if output_store is not None:
+            output_store.close()
+    return [(shard_paths[shard_index], row, conflict) for shard_index, row, conflict in conflicts]
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description='Merge the lookup tables of the shards of a sharded run')
+    parser.add_argument('shards', nargs='+', help='Paths to the lookup tables of the shards')
+    parser.add_argument('--output', action='store', help='Path to the merged lookup table')
+    parser.add_argument('--verify', action='store_true', dest='verify', help='If used, the shards are only checked and no table is written')
+    parser.set_defaults(verify=False)
+    parser.add_argument('--lookupBackend', action='store', choices=['csv', 'sqlite'], default='csv', help='Storage of the lookup tables of the shards')
+    parser.add_argument('--outputBackend', action='store', choices=['csv', 'sqlite'], help='Storage of the merged lookup table. By default, the same as the shards')
+    args = parser.parse_args()
+
+    if not args.verify and args.output is None:
+        parser.error('--output is required, unless --verify is used')
+
+    conflicts = merge_lookup(args.shards, None if args.verify else args.output, args.lookupBackend, args.outputBackend)
+    for shard_path, row, conflict in conflicts:
+        print('Conflict in {}: {}: {}'.format(shard_path, ','.join(row), conflict))
+    print('{} conflicting rows'.format(len(conflicts)))
+    if conflicts:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+'''
+Re-identification of pseudonymized PatientIDs and AccessionNumbers with the lookup table of the
+anonymizer (cf utils.reidentification), e.g. to link the outputs of a model back to the patients.
+
+Pseudonyms are read from a text file (one per line) or from a column of a csv file, and the results
+are written to a csv file. With --serve, the table is opened once and the pseudonyms read on the
+standard input are answered one line at a time on the standard output.
+'''
+
+import argparse
+import csv
+import os
+import sys
+import time
+
+from utils.lookup_store import open_lookup_store
+from utils.reidentification import KINDS, RESULT_COLUMNS, Reidentifier, reidentify_csv, reidentify_lines, serve
+
+
+def open_reidentifier(lookup_path: str, lookup_backend: str = 'csv', kind: str = 'auto') -> Reidentifier:
+    '''
+    Open the lookup table for reverse lookups
+
+    Parameters
+    ----------
+    lookup_path : str
+        Path to the lookup table written by the anonymizer.
+    lookup_backend : str
+        Backend of the lookup table: 'csv' or 'sqlite'.
+    kind : str
+        Kind of the pseudonyms: 'patient', 'accession' or 'auto'.
+
+    Returns
+    -------
+    reidentifier : Reidentifier
+        The reverse lookups in the table. Its store must be closed by the caller.
+    '''
+    if not os.path.exists(lookup_path):
+        raise ValueError('The lookup table {} does not exist'.format(lookup_path))
+    # The table is opened with write access so that the indexes of the new values are added to the SQLite
+    # databases written before they existed. No row is added.
+    store = open_lookup_store(lookup_path, lookup_backend)
+    return Reidentifier(store, kind)
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description='Find the original PatientIDs and AccessionNumbers of pseudonymized ones')
+    parser.add_argument('lookup', help='Path to the lookup table of the anonymizer')
+    parser.add_argument('--lookupBackend', action='store', choices=['csv', 'sqlite'], default='csv', help='Storage of the lookup table: csv file or SQLite database')
+    parser.add_argument('--input', action='store', help='Text file with one pseudonym per line, or csv file with a header if --column is used')
+    parser.add_argument('--output', action='store', help='Csv file where the results are written')
+    parser.add_argument('--column', action='store', help='Column of the pseudonyms in the csv input file. The original values are added to each row')
+    parser.add_argument('--kind', action='store', choices=KINDS, default='auto', help='Kind of the pseudonyms. With auto, they are looked up as PatientIDs, then as AccessionNumbers')
+    parser.add_argument('--serve', action='store_true', dest='serve', help='If used, pseudonyms are read on the standard input and answered on the standard output, one line at a time')
+    parser.set_defaults(serve=False)
+    args = parser.parse_args()
+
+    if not args.serve and (args.input is None or args.output is None):
+        parser.error('--input and --output are required, unless --serve is used')
+
+    reidentifier = open_reidentifier(args.lookup, args.lookupBackend, args.kind)
+    try:
+        if args.serve:
+            serve(reidentifier, sys.stdin, sys.stdout)
+            return
+        start = time.perf_counter()
+        with open(args.input, 'r', newline='') as input_file, open(args.output, 'w', newline='') as output_file:
+            if args.column is not None:
+                reidentify_csv(reidentifier, input_file, output_file, args.column)
+            else:
+                writer = csv.writer(output_file, lineterminator='\n')
+                writer.writerow(RESULT_COLUMNS)
+                writer.writerows(reidentify_lines(reidentifier, input_file))
+        seconds = time.perf_counter() - start
+    finally:
+        reidentifier.store.close()
+    print('{} pseudonyms looked up in {:.1f} s, {} unknown'.format(reidentifier.nb_queries, seconds,
+                                                                  reidentifier.nb_unknown))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+'''
+DICOM storage SCP (C-STORE) which anonymizes the instances on receipt and only writes the anonymized
+files (cf utils.storage_scp). The anonymization options are those of the anonymizer.
+'''
+
+import argparse
+import signal
+
+from anonymizer import open_run_lookup_store, close_run_lookup_store, read_actions_dictionary, read_uid_secret
+from utils import simple_dicomanonymizer
+from utils.pixel_redaction import load_redaction_profiles
+from utils.simple_dicomanonymizer import compile_anonymization_plan
+from utils.storage_scp import DEFAULT_AE_TITLE, DEFAULT_PORT, DEFAULT_QUEUE_TIMEOUT, AnonymizingStorageSCP
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description='Receive DICOM instances (C-STORE) and write them anonymized')
+    parser.add_argument('output', help='Path to the folder where the anonymized instances are written')
+    parser.add_argument('--port', action='store', type=int, default=DEFAULT_PORT, help='TCP port to listen on')
+    parser.add_argument('--host', action='store', default='', help='Address to listen on. By default, all the interfaces')
+    parser.add_argument('--aeTitle', action='store', default=DEFAULT_AE_TITLE, help='AE title of the SCP')
+    parser.add_argument('--maxAssociations', action='store', type=int, default=10, help='Maximum number of simultaneous associations')
+    parser.add_argument('--workers', action='store', type=int, default=2, help='Number of processes anonymizing the instances')
+    parser.add_argument('--maxInFlight', action='store', type=int, help='Maximum number of instances anonymized at once. By default, twice the number of workers')
+    parser.add_argument('--queueTimeout', action='store', type=float, default=DEFAULT_QUEUE_TIMEOUT, help='Seconds an instance waits for a free worker before it is refused with the status Out of Resources')
+    parser.add_argument('--lookup', action='store', required=True, help='Path to the lookup table to be written after pseudonymization. Required, the PatientIDs and AccessionNumbers of the instances are pseudonymized')
+    parser.add_argument('--lookupBackend', action='store', choices=['csv', 'sqlite'], default='csv', help='Storage of the lookup table: csv file or SQLite database')
+    parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that can be added to the original one')
+    parser.add_argument('--scrubAllText', action='store_true', dest='scrubAllText', help='If used, all the regexp rules are applied in one pass to every text element, as for the anonymizer')
+    parser.set_defaults(scrubAllText=False)
+    parser.add_argument('--redactionProfiles', action='store', help='JSON file of the regions of the pixels to redact, as for the anonymizer')
+    parser.add_argument('--keepPrivateTags', action='store_true', dest='keepPrivateTags', help='If used, then private tags won\'t be deleted')
+    parser.set_defaults(keepPrivateTags=False)
+    parser.add_argument('--renameFiles', action='store_true', dest='renameFiles', help='If used, name the files using PatientID + AccessionNumber + a hash of the SOPInstanceUID instead of the SOPInstanceUID')
+    parser.set_defaults(renameFiles=False)
+    parser.add_argument('--fanOut', action='store', type=int, default=0, help='With --renameFiles, number of levels of subfolders (named from a hash) the files are spread into')
+    parser.add_argument('--uidSecretFile', action='store', help='File containing the site secret from which replaced UIDs are derived')
+    args = parser.parse_args()
+
+    anonymization_actions = {}
+    if args.dictionary:
+        anonymization_actions = read_actions_dictionary(args.dictionary)
+    redaction_profiles = None
+    if args.redactionProfiles:
+        redaction_profiles = load_redaction_profiles(args.redactionProfiles)
+    if args.uidSecretFile:
+        simple_dicomanonymizer.uid_secret = read_uid_secret(args.uidSecretFile)
+    anonymization_plan = compile_anonymization_plan(anonymization_actions, args.scrubAllText, redaction_profiles)
+
+    lookup_store = open_run_lookup_store(args.lookup, args.lookupBackend)
+    try:
+        scp = AnonymizingStorageSCP(args.output, lookup_store, anonymization_plan, not args.keepPrivateTags,
+                                    args.renameFiles, args.workers, args.maxInFlight, args.queueTimeout, args.fanOut)
+        signal.signal(signal.SIGTERM, lambda signum, frame: scp.stop())
+        scp.serve(args.host, args.port, args.aeTitle, args.maxAssociations)
+    finally:
+        close_run_lookup_store(lookup_store, None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+'''
+Inventory of the tags, VRs and private creators of an archive, read from the headers of the files
+(cf utils.tag_census). The summary is written to a JSON file.
+'''
+
+import argparse
+import json
+import os
+
+import tqdm
+
+from anonymizer import read_actions_dictionary
+from utils.simple_dicomanonymizer import compile_anonymization_plan
+from utils.tag_census import run_census
+
+
+def list_files(input_path: str) -> list:
+    '''
+    List the files of a folder and its subfolders, or the file itself.
+    '''
+    if os.path.isfile(input_path):
+        return [input_path]
+    paths = []
+    for folder, subfolders, file_names in os.walk(input_path):
+        subfolders.sort()
+        paths.extend(os.path.join(folder, file_name) for file_name in sorted(file_names))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description='Count the tags, VRs and private creators of DICOM files, and check them against the anonymization rules')
+    parser.add_argument('input', help='Path to the input dicom file or input directory which contains dicom files (subdirectories included)')
+    parser.add_argument('output', help='Path to the JSON file where the summary is written')
+    parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that can be added to the original one, as for the anonymizer')
+    parser.add_argument('--keepPrivateTags', action='store_true', dest='keepPrivateTags', help='If used, private tags without rule are reported as uncovered, as they would not be deleted')
+    parser.set_defaults(keepPrivateTags=False)
+    parser.add_argument('--samples', action='store', type=int, default=5, help='Number of distinct sample values kept per tag, 0 to keep none')
+    parser.add_argument('--workers', action='store', type=int, default=1, help='Number of processes reading the files in parallel')
+    args = parser.parse_args()
+
+    anonymization_actions = {}
+    if args.dictionary:
+        anonymization_actions = read_actions_dictionary(args.dictionary)
+    anonymization_plan = compile_anonymization_plan(anonymization_actions)
+
+    paths = list_files(args.input)
+    progress_bar = tqdm.tqdm(total=len(paths))
+    census = run_census(paths, anonymization_plan, args.samples, args.workers, chunk_done_callback=progress_bar.update)
+    progress_bar.close()
+
+    summary = census.to_dict(not args.keepPrivateTags)
+    with open(args.output, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=4)
+
+    print('{} files, {} unreadable, {} tags, {} private creators'.format(
+        summary["files"], len(summary["unreadable_files"]), len(summary["tags"]), len(summary["private_creators"])))
+    print('{} tags not covered by a rule: {}'.format(len(summary["uncovered_tags"]), ', '.join(summary["uncovered_tags"])))
+    for key, unsupported in summary["unsupported_tags"].items():
+        print('{} {}: {} elements with VR {} would raise NotImplementedError'.format(
+            key, unsupported["rule"], unsupported["count"], '/'.join(unsupported["vrs"])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import os
+import sys
+
+# The modules are imported as the scripts of this folder import them (from utils import ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from utils.synthetic_corpus import make_synthetic_dataset
+
+
+@pytest.fixture
+def write_corpus():
+    '''
+    Return a function writing small synthetic files to a folder, one per patient, with the given
+    AccessionNumber (None to keep the synthetic one).
+    '''
+    def _write_corpus(folder, nb_files, accession_number=None, **kwargs):
+        os.makedirs(folder, exist_ok=True)
+        paths = []
+        for file_index in range(nb_files):
+            kwargs.setdefault('rows', 16)
+            kwargs.setdefault('columns', 16)
+            dataset = make_synthetic_dataset(file_index, nb_patients=nb_files, **kwargs)
+            if accession_number is not None:
+                dataset.AccessionNumber = accession_number
+            path = os.path.join(folder, 'file_{:03d}.dcm'.format(file_index))
+            dataset.save_as(path, write_like_original=False)
+            paths.append(path)
+        return paths
+    return _write_corpus
@@ -0,0 +1,16 @@
+import pytest
+
+from anonymizer import anonymize
+
+
+def test_folder_input_needs_an_output_folder(tmp_path, write_corpus):
+    write_corpus(str(tmp_path / 'input'), 1)
+    with pytest.raises(ValueError):
+        anonymize(str(tmp_path / 'input'), str(tmp_path / 'missing'), str(tmp_path / 'lookup.csv'), {}, True, False)
+
+
+def test_run_options_are_keyword_only(tmp_path, write_corpus):
+    write_corpus(str(tmp_path / 'input'), 1)
+    (tmp_path / 'output').mkdir()
+    with pytest.raises(TypeError):
+        anonymize(str(tmp_path / 'input'), str(tmp_path / 'output'), str(tmp_path / 'lookup.csv'), {}, True, False, 2)
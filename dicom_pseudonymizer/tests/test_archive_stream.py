@@ -0,0 +1,38 @@
+import io
+import sys
+import tarfile
+
+from anonymizer import anonymize_from_archive
+
+
+def write_tar(path, members):
+    with tarfile.open(path, 'w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def print_action(dataset, tag):
+    # As the messages of anonymize_dataset
+    print('Cannot get element from tag: ', tag)
+
+
+def test_archive_to_stdout_without_folder_names(tmp_path, write_corpus, monkeypatch):
+    paths = write_corpus(str(tmp_path / 'input'), 3)
+    members = [('DOE_JOHN/IM{}'.format(index), open(path, 'rb').read()) for index, path in enumerate(paths[:2])]
+    members.append(('SMITH_JANE/IM0', open(paths[2], 'rb').read()))
+    input_path = str(tmp_path / 'input.tar')
+    write_tar(input_path, members)
+
+    stdout = io.TextIOWrapper(io.BytesIO())
+    stderr = io.StringIO()
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    monkeypatch.setattr(sys, 'stderr', stderr)
+    anonymize_from_archive(input_path, '-', str(tmp_path / 'lookup.csv'), {(0x0008, 0x0080): print_action}, True, False)
+    stdout.flush()
+
+    with tarfile.open(fileobj=io.BytesIO(stdout.buffer.getvalue())) as tar:
+        names = tar.getnames()
+    assert names == ['000001/IM0', '000001/IM1', '000002/IM0']
+    assert stderr.getvalue().count('Cannot get element from tag') == 3
@@ -0,0 +1,53 @@
+import os
+
+import pydicom
+import pytest
+
+from utils import dicom_io
+from utils.dicom_io import copy_file_range, read_dicom_file, write_dicom_file
+
+
+def write_passthrough(in_path, out_path):
+    dataset, pixel_data_offset = read_dicom_file(in_path, pixel_passthrough=True)
+    assert pixel_data_offset is not None
+    dataset.PatientName = 'Anonymized'
+    write_dicom_file(dataset, out_path, in_path, pixel_data_offset)
+
+
+def test_passthrough_copies_the_pixel_data_bytes(tmp_path, write_corpus):
+    in_path = write_corpus(str(tmp_path / 'input'), 1, frames=3)[0]
+    out_path = str(tmp_path / 'output.dcm')
+    write_passthrough(in_path, out_path)
+    written = pydicom.dcmread(out_path)
+    assert written.PatientName == 'Anonymized'
+    assert written.PixelData == pydicom.dcmread(in_path).PixelData
+
+
+def test_copy_falls_back_when_the_kernel_copies_nothing(tmp_path, write_corpus, monkeypatch):
+    in_path = write_corpus(str(tmp_path / 'input'), 1)[0]
+    out_path = str(tmp_path / 'output.dcm')
+    monkeypatch.setattr(os, 'copy_file_range', lambda source, destination, count: 0, raising=False)
+    write_passthrough(in_path, out_path)
+    assert pydicom.dcmread(out_path).PixelData == pydicom.dcmread(in_path).PixelData
+
+
+def test_copy_of_a_truncated_file_raises(tmp_path):
+    in_path = str(tmp_path / 'input.bin')
+    with open(in_path, 'wb') as fp:
+        fp.write(bytes(range(100)))
+    out_path = str(tmp_path / 'output.bin')
+    with pytest.raises(ValueError):
+        copy_file_range(in_path, 10, 1000, out_path)
+    with open(out_path, 'rb') as fp:
+        assert fp.read() == bytes(range(10, 100))
+
+
+def test_copy_in_chunks(tmp_path, monkeypatch):
+    in_path = str(tmp_path / 'input.bin')
+    with open(in_path, 'wb') as fp:
+        fp.write(bytes(range(256)) * 4)
+    out_path = str(tmp_path / 'output.bin')
+    monkeypatch.setattr(dicom_io, 'COPY_CHUNK_SIZE', 100)
+    copy_file_range(in_path, 24, 1000, out_path)
+    with open(out_path, 'rb') as fp:
+        assert fp.read() == (bytes(range(256)) * 4)[24:]
@@ -0,0 +1,105 @@
+import numpy as np
+import pydicom
+import pytest
+from pydicom.pixel_data_handlers.numpy_handler import pack_bits
+from pydicom.pixel_data_handlers.util import convert_color_space
+
+from utils.dicom_io import read_dicom_file, write_dicom_file
+from utils.frame_io import iter_frames, set_native_encoding, write_frames
+from utils.pixel_redaction import RedactionProfile, redact_pixels
+from utils.synthetic_corpus import make_synthetic_dataset
+
+
+def make_color_dataset(frames):
+    dataset = make_synthetic_dataset(0, rows=16, columns=16, frames=frames)
+    dataset.SamplesPerPixel = 3
+    dataset.PhotometricInterpretation = 'YBR_FULL'
+    dataset.PlanarConfiguration = 0
+    dataset.BitsAllocated = 8
+    dataset.BitsStored = 8
+    dataset.HighBit = 7
+    dataset.PixelData = np.random.RandomState(0).randint(0, 256, 16 * 16 * 3 * frames, dtype='u1').tobytes()
+    return dataset
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_iter_frames_reads_the_frames_of_pixel_array(tmp_path, compressed):
+    dataset = make_synthetic_dataset(0, rows=16, columns=16, frames=5)
+    if compressed:
+        dataset.compress(pydicom.uid.RLELossless)
+    path = str(tmp_path / 'frames.dcm')
+    dataset.save_as(path)
+    header, pixel_data_offset = read_dicom_file(path, pixel_passthrough=True)
+    frames = list(iter_frames(path, header, pixel_data_offset))
+    expected = pydicom.dcmread(path).pixel_array
+    assert len(frames) == 5
+    assert all(np.array_equal(frame, expected[index]) for index, frame in enumerate(frames))
+
+
+def test_write_frames_decodes_ybr_frames_to_rgb(tmp_path):
+    dataset = make_color_dataset(3)
+    dataset.compress(pydicom.uid.RLELossless)
+    path = str(tmp_path / 'color.dcm')
+    dataset.save_as(path)
+    header, pixel_data_offset = read_dicom_file(path, pixel_passthrough=True)
+    out_path = str(tmp_path / 'decoded.dcm')
+    write_frames(header, out_path, iter_frames(path, header, pixel_data_offset), 3)
+
+    written = pydicom.dcmread(out_path)
+    assert written.file_meta.TransferSyntaxUID == pydicom.uid.ExplicitVRLittleEndian
+    assert written.PhotometricInterpretation == 'RGB'
+    assert 'LossyImageCompression' not in written
+    expected = convert_color_space(pydicom.dcmread(path).pixel_array, 'YBR_FULL', 'RGB')
+    assert np.array_equal(written.pixel_array, expected)
+
+
+@pytest.mark.parametrize('transfer_syntax, photometric_interpretation, lossy', [
+    (pydicom.uid.JPEGBaseline8Bit, 'YBR_FULL_422', True),
+    (pydicom.uid.JPEG2000, 'YBR_ICT', True),
+    (pydicom.uid.JPEG2000Lossless, 'YBR_RCT', False),
+    (pydicom.uid.RLELossless, 'RGB', False),
+])
+def test_set_native_encoding(transfer_syntax, photometric_interpretation, lossy):
+    dataset = make_color_dataset(1)
+    dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    dataset.PhotometricInterpretation = photometric_interpretation
+    set_native_encoding(dataset)
+    assert dataset.file_meta.TransferSyntaxUID == pydicom.uid.ExplicitVRLittleEndian
+    assert dataset.PhotometricInterpretation == 'RGB'
+    assert dataset.get('LossyImageCompression') == ('01' if lossy else None)
+
+
+def test_redaction_of_1_bit_pixel_data_read_without_pixels(tmp_path):
+    dataset = make_synthetic_dataset(0, rows=16, columns=16, frames=3)
+    dataset.BitsAllocated = 1
+    dataset.BitsStored = 1
+    dataset.HighBit = 0
+    dataset.PixelData = pack_bits(np.ones(16 * 16 * 3, dtype='u1'))
+    path = str(tmp_path / 'bits.dcm')
+    dataset.save_as(path)
+    header, pixel_data_offset = read_dicom_file(path, pixel_passthrough=True)
+    assert pixel_data_offset is not None
+    out_path = str(tmp_path / 'redacted.dcm')
+    write_dicom_file(header, out_path, path, pixel_data_offset, RedactionProfile('Top', rectangles=[[0, 0, 16, 4]]))
+
+    pixels = pydicom.dcmread(out_path).pixel_array
+    assert pixels.shape == (3, 16, 16)
+    assert not pixels[:, :4].any()
+    assert pixels[:, 4:].all()
+
+
+def test_redaction_keeps_the_byte_order_of_big_endian_files(tmp_path):
+    dataset = make_synthetic_dataset(0, rows=16, columns=16, frames=2)
+    values = np.arange(16 * 16 * 2, dtype='u2').reshape(2, 16, 16)
+    dataset.PixelData = values.astype('>u2').tobytes()
+    dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRBigEndian
+    dataset.is_little_endian = False
+    path = str(tmp_path / 'big_endian.dcm')
+    dataset.save_as(path)
+    read = pydicom.dcmread(path)
+    redact_pixels(read, RedactionProfile('Top', rectangles=[[0, 0, 16, 4]]))
+    out_path = str(tmp_path / 'redacted.dcm')
+    read.save_as(out_path)
+
+    values[:, :4] = 0
+    assert np.array_equal(pydicom.dcmread(out_path).pixel_array, values)
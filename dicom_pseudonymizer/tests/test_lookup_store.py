@@ -0,0 +1,56 @@
+import csv
+import os
+
+import pydicom
+import pytest
+
+from anonymizer import anonymize
+from utils.lookup_store import MemoryLookupStore, add_new_rows, open_lookup_store
+
+
+def read_rows(path):
+    with open(path, newline='') as csvfile:
+        return list(csv.reader(csvfile))[1:]
+
+
+@pytest.mark.parametrize('backend', ['csv', 'sqlite'])
+def test_add_new_rows_keeps_patients_sharing_an_accession(tmp_path, backend):
+    store = open_lookup_store(str(tmp_path / 'lookup'), backend)
+    rows = [['P1', 'N1', '', 'A1'], ['P2', 'N2', '', 'A2'], ['P1', 'N1', 'ACC', 'A3']]
+    add_new_rows(store, rows)
+    # A second worker met the same patients and accession numbers
+    add_new_rows(store, [['P2', 'N2-bis', '', 'A2-bis'], ['P3', 'N3', '', 'A4']])
+    assert list(store.rows()) == rows + [['P3', 'N3', '', 'A4']]
+    assert store.find_row('P2', '') == ['P2', 'N2', '', 'A2']
+    assert store.find_row('P3', 'ACC') is None
+    store.close()
+
+
+def test_memory_store_finds_rows_of_its_base_table(tmp_path):
+    base_store = open_lookup_store(str(tmp_path / 'lookup.csv'))
+    base_store.add(['P1', 'N1', '', 'A1'])
+    base_store.commit()
+    store = MemoryLookupStore(base_store.path, base_store)
+    store.add(['P2', 'N2', '', 'A2'])
+    assert store.find_row('P1', '') == ['P1', 'N1', '', 'A1']
+    assert store.find_row('P2', '') == ['P2', 'N2', '', 'A2']
+    assert store.pending_rows == [['P2', 'N2', '', 'A2']]
+
+
+@pytest.mark.parametrize('accession_number', ['', None])
+def test_parallel_run_writes_the_rows_of_the_serial_run(tmp_path, write_corpus, accession_number):
+    write_corpus(str(tmp_path / 'input'), 12, accession_number)
+    tables = {}
+    for workers in (1, 3):
+        output = tmp_path / 'output_{}'.format(workers)
+        output.mkdir()
+        lookup_path = str(tmp_path / 'lookup_{}.csv'.format(workers))
+        anonymize(str(tmp_path / 'input'), str(output), lookup_path, {}, True, False, workers=workers)
+        rows = read_rows(lookup_path)
+        tables[workers] = sorted((row[0], row[2]) for row in rows)
+        # Every anonymized file can be linked back to its patient
+        new_patients = {row[1] for row in rows}
+        for name in os.listdir(output):
+            assert pydicom.dcmread(str(output / name)).PatientID in new_patients
+    assert len(tables[1]) == 12
+    assert tables[3] == tables[1]
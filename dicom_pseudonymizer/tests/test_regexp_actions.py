@@ -0,0 +1,42 @@
+import pydicom
+
+from utils.simple_dicomanonymizer import (add_actions, anonymize_dataset, compile_anonymization_plan, generate_actions,
+                                          get_regexp_rules, regexp)
+
+COMMENTS = (0x0020, 0x4000)
+
+
+def regexp_actions(find, replace):
+    return generate_actions([COMMENTS], regexp, {'find': find, 'replace': replace})
+
+
+def test_regexp_rules_of_the_same_tag_are_combined():
+    actions = {}
+    add_actions(actions, regexp_actions('Doe', 'X'))
+    add_actions(actions, regexp_actions('ID[0-9]+', 'ID'))
+    add_actions(actions, regexp_actions('Doe', 'X'))
+    assert get_regexp_rules(actions[COMMENTS]) == (('Doe', 'X'), ('ID[0-9]+', 'ID'))
+
+    dataset = pydicom.Dataset()
+    dataset.ImageComments = 'Doe ID1234 Doe'
+    actions[COMMENTS](dataset, COMMENTS)
+    assert dataset.ImageComments == 'X ID X'
+
+
+def test_other_actions_replace_the_regexp_rules():
+    actions = {}
+    add_actions(actions, regexp_actions('Doe', 'X'))
+    add_actions(actions, generate_actions([COMMENTS], 'delete'))
+    assert get_regexp_rules(actions[COMMENTS]) == ()
+
+
+def test_combined_rules_in_a_plan(write_corpus, tmp_path):
+    actions = {}
+    add_actions(actions, regexp_actions('Doe', 'X'))
+    add_actions(actions, regexp_actions('Smith', 'Y'))
+    for scrub_all_text in (False, True):
+        plan = compile_anonymization_plan(actions, scrub_all_text)
+        dataset = pydicom.dcmread(write_corpus(str(tmp_path), 1)[0])
+        dataset.ImageComments = 'Doe and Smith'
+        anonymize_dataset(dataset, plan)
+        assert dataset.ImageComments == 'X and Y'
@@ -0,0 +1,47 @@
+import csv
+
+from anonymizer import anonymize
+from merge_lookup import merge_lookup
+from utils.lookup_store import MemoryLookupStore
+from utils.sharding import get_patient_shard, merge_lookup_shards
+
+
+def make_store(rows):
+    store = MemoryLookupStore()
+    for row in rows:
+        store.add(row)
+    return store
+
+
+def test_merge_keeps_patients_sharing_the_empty_accession():
+    shards = [make_store([['P1', 'N1', '', 'E'], ['P2', 'N2', '', 'E']]),
+              make_store([['P3', 'N3', '', 'E'], ['P1', 'N1', '', 'E'], ['P3', 'N3', 'ACC', 'A3']])]
+    output = MemoryLookupStore()
+    assert merge_lookup_shards(shards, output) == []
+    assert output.pending_rows == [['P1', 'N1', '', 'E'], ['P2', 'N2', '', 'E'], ['P3', 'N3', '', 'E'],
+                                   ['P3', 'N3', 'ACC', 'A3']]
+
+
+def test_merge_reports_conflicting_rows():
+    shards = [make_store([['P1', 'N1', 'ACC1', 'A1'], ['P2', 'N2', 'ACC2', 'A2']]),
+              make_store([['P1', 'N9', 'ACC3', 'A3'], ['P2', 'N2', 'ACC2', 'A9'], ['P4', 'N1', 'ACC4', 'A4'],
+                          ['P5', 'N5', 'ACC5', 'A1']])]
+    conflicts = merge_lookup_shards(shards)
+    assert [(shard_index, row[0]) for shard_index, row, conflict in conflicts] == [(1, 'P1'), (1, 'P2'), (1, 'P4'),
+                                                                                  (1, 'P5')]
+
+
+def test_sharded_runs_merge_into_the_rows_of_a_single_run(tmp_path, write_corpus):
+    paths = write_corpus(str(tmp_path / 'input'), 12, '')
+    shard_paths = []
+    for shard_index in range(2):
+        output = tmp_path / 'output_{}'.format(shard_index)
+        output.mkdir()
+        shard_paths.append(str(tmp_path / 'lookup_{}.csv'.format(shard_index)))
+        anonymize(str(tmp_path / 'input'), str(output), shard_paths[-1], {}, True, False, shard=(shard_index, 2))
+    assert {get_patient_shard('PID{:06d}'.format(patient), 2) for patient in range(len(paths))} == {0, 1}
+
+    assert merge_lookup(shard_paths, str(tmp_path / 'lookup.csv')) == []
+    with open(str(tmp_path / 'lookup.csv'), newline='') as csvfile:
+        rows = list(csv.reader(csvfile))[1:]
+    assert sorted(row[0] for row in rows) == ['PID{:06d}'.format(patient) for patient in range(len(paths))]
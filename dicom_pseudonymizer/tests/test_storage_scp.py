@@ -0,0 +1,56 @@
+import csv
+import os
+import socket
+import threading
+
+import pydicom
+from pynetdicom import AE
+
+from utils.lookup_store import open_lookup_store
+from utils.simple_dicomanonymizer import compile_anonymization_plan
+from utils.storage_scp import AnonymizingStorageSCP, STATUS_SUCCESS
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_storage_scp_stores_instances_sent_on_loopback(tmp_path, write_corpus):
+    paths = write_corpus(str(tmp_path / 'input'), 6, '')
+    lookup_store = open_lookup_store(str(tmp_path / 'lookup.csv'))
+    scp = AnonymizingStorageSCP(str(tmp_path / 'output'), lookup_store, compile_anonymization_plan({}), workers=1)
+    port = get_free_port()
+    server_thread = threading.Thread(target=scp.serve, args=('127.0.0.1', port))
+    server_thread.start()
+    try:
+        datasets = [pydicom.dcmread(path) for path in paths]
+        ae = AE(ae_title='TEST_SCU')
+        ae.add_requested_context(datasets[0].SOPClassUID, datasets[0].file_meta.TransferSyntaxUID)
+        assoc = None
+        # The server is listening once the workers are started
+        for _ in range(100):
+            assoc = ae.associate('127.0.0.1', port, ae_title='DSAIL')
+            if assoc.is_established:
+                break
+            threading.Event().wait(0.1)
+        assert assoc.is_established
+        statuses = [assoc.send_c_store(dataset).Status for dataset in datasets]
+        assoc.release()
+    finally:
+        scp.stop()
+        server_thread.join(60)
+    lookup_store.close()
+
+    assert statuses == [STATUS_SUCCESS] * len(datasets)
+    with open(str(tmp_path / 'lookup.csv'), newline='') as csvfile:
+        rows = list(csv.reader(csvfile))[1:]
+    # Each patient without AccessionNumber keeps its row
+    assert sorted(row[0] for row in rows) == sorted(dataset.PatientID for dataset in datasets)
+    new_patients = {row[1] for row in rows}
+    names = os.listdir(str(tmp_path / 'output'))
+    assert len(names) == len(datasets)
+    for name in names:
+        dataset = pydicom.dcmread(str(tmp_path / 'output' / name))
+        assert dataset.PatientID in new_patients
@@ -0,0 +1,143 @@
+'''
+Anonymization rules compiled once per run.
+
+An AnonymizationPlan is built from the default DICOM profile and the extra rules given with
+--dictionary or -t (cf simple_dicomanonymizer.compile_anonymization_plan). It is immutable and can be
+pickled, so that it can be shared with worker processes.
+
+The plan indexes its rules so that a dataset is traversed only once: individual tags are found in a
+(group, element) index and repeating groups in a small table with one entry per (group mask, element mask).
+A plan can also hold a TextScrubber (cf utils.text_scrubber), applied to every text element after the rules,
+and redaction profiles (cf utils.pixel_redaction), applied to the pixels.
+'''
+
+import functools
+import hashlib
+
+
+def describe_action(action) -> str:
+    '''
+    Describe an action by its qualified name and, for functools.partial objects, its arguments.
+    '''
+    if isinstance(action, functools.partial):
+        return '{}({!r}, {!r})'.format(describe_action(action.func), action.args, sorted(action.keywords.items()))
+    return '{}.{}'.format(getattr(action, '__module__', ''), getattr(action, '__qualname__', repr(action)))
+
+
+class AnonymizationPlan:
+    '''
+    Immutable list of (tag, action) pairs, in the order in which they are applied.
+
+    Parameters
+    ----------
+    anonymization_actions : dict
+        Map tags to actions. Tags are (group, element) tuples or, for repeating groups,
+        (group, element, group mask, element mask) tuples. Actions must be picklable
+        (module-level functions or functools.partial objects).
+    scrubber : TextScrubber
+        If set, find/replace rules applied to every text element of the datasets.
+    redaction_profiles : list
+        RedactionProfile objects, the first one matching a dataset is applied to its pixels.
+    '''
+
+    __slots__ = ('actions', 'private_tags', 'tag_index', 'mask_table', 'scrubber', 'redaction_profiles',
+                 'fingerprint')
+
+    def __init__(self, anonymization_actions: dict, scrubber=None, redaction_profiles: list = None):
+        actions = tuple(anonymization_actions.items())
+        object.__setattr__(self, 'actions', actions)
+        object.__setattr__(self, 'scrubber', scrubber)
+        object.__setattr__(self, 'redaction_profiles', tuple(redaction_profiles or ()))
+        # Only tags with an odd group can be private tags that should be restored after anonymization
+        object.__setattr__(self, 'private_tags', frozenset(tag for tag, action in actions
+                                                           if len(tag) == 2 and tag[0] % 2 == 1))
+
+        # (group << 16 | element) -> (position of the rule, tag, action)
+        tag_index = {}
+        # (group mask, element mask) -> {(masked group, masked element): [(position of the rule, action)]}
+        masks = {}
+        for position, (tag, action) in enumerate(actions):
+            if len(tag) == 2:
+                tag_index[tag[0] << 16 | tag[1]] = (position, tag, action)
+            else:
+                masks.setdefault((tag[2], tag[3]), {}).setdefault((tag[0], tag[1]), []).append((position, action))
+        object.__setattr__(self, 'tag_index', tag_index)
+        object.__setattr__(self, 'mask_table', tuple((group_mask, element_mask, values)
+                                                     for (group_mask, element_mask), values in masks.items()))
+
+        # Hash of the rules, which identifies the profile the files were anonymized with
+        description = '\n'.join('{} {}'.format(tag, describe_action(action)) for tag, action in actions)
+        if scrubber is not None:
+            description += '\nscrub {!r} {!r}'.format(scrubber.rules, sorted(scrubber.tags))
+        for profile in self.redaction_profiles:
+            description += '\nredact {!r}'.format(profile)
+        object.__setattr__(self, 'fingerprint', hashlib.sha256(description.encode()).hexdigest())
+
+    def __setattr__(self, name, value):
+        raise AttributeError('AnonymizationPlan is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('AnonymizationPlan is immutable')
+
+    def match_repeating_groups(self, data_tag: int) -> list:
+        '''
+        Return the (position, action) pairs of the repeating group rules matching a tag.
+        '''
+        group = data_tag >> 16
+        element = data_tag & 0xFFFF
+        matches = []
+        for group_mask, element_mask, values in self.mask_table:
+            matches.extend(values.get((group & group_mask, element & element_mask), ()))
+        return matches
+
+    def find_actions(self, dataset) -> list:
+        '''
+        Traverse the dataset once and return the actions to apply, in the order of the rules.
+
+        Individual tags are looked up among the top level elements. Repeating groups are looked up
+        among all elements, including the elements of nested sequences.
+
+        Parameters
+        ----------
+        dataset : Dataset object of pydicom.dataset module
+            Dataset to be anonymized
+
+        Returns
+        -------
+        matches : list
+            List of (dataset, tag, action) to apply, where tag is the rule's tag for individual tags and
+            the element's tag for repeating groups.
+        '''
+        matches = []
+        self.collect_actions(dataset, matches, True)
+        matches.sort(key=lambda match: match[0])
+        return [(match_dataset, tag, action) for position, match_dataset, tag, action in matches]
+
+    def collect_actions(self, dataset, matches: list, top_level: bool) -> None:
+        '''
+        Append the (position, dataset, tag, action) matches of the dataset to matches.
+        '''
+        for data_tag in list(dataset.keys()):
+            if top_level and data_tag in self.tag_index:
+                position, tag, action = self.tag_index[data_tag]
+                matches.append((position, dataset, tag, action))
+            if self.mask_table:
+                for position, action in self.match_repeating_groups(data_tag):
+                    matches.append((position, dataset, data_tag, action))
+
+            # The raw element is only converted when its VR is unknown (implicit VR) or a sequence
+            VR = dataset.get_item(data_tag).VR
+            if VR is None:
+                VR = dataset[data_tag].VR
+            if VR == 'SQ':
+                for sub_dataset in dataset[data_tag].value:
+                    self.collect_actions(sub_dataset, matches, False)
+
+    def __reduce__(self):
+        return (AnonymizationPlan, (dict(self.actions), self.scrubber, self.redaction_profiles))
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __iter__(self):
+        return iter(self.actions)
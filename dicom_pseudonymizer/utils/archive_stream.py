@@ -0,0 +1,155 @@
+'''
+Anonymization of DICOM files streamed from a zip or tar archive into a tar archive.
+
+The members of the input archive are read one at a time and written, once anonymized, to the output tar
+archive in a single pass: nothing is extracted to disk and only one member is held in memory at a time.
+Tar archives (possibly compressed) are read in stream mode, so the input can also be a pipe.
+
+The names of the folders of the input members may identify the patients (e.g. DOE_JOHN/IM0001): in the
+output archive, each folder is replaced by its number, in the order in which the folders appear. When the
+output archive is written to the standard output, the messages are written to the standard error.
+'''
+
+import contextlib
+import io
+import os
+import posixpath
+import sys
+import tarfile
+import time
+import zipfile
+
+from utils import simple_dicomanonymizer
+from utils.manifest import describe_error
+
+
+def iter_tar_members(tar: tarfile.TarFile):
+    '''
+    Yield the (name, data) of the regular files of a tar archive opened in stream mode.
+    '''
+    for member in tar:
+        if member.isfile():
+            yield member.name, tar.extractfile(member).read()
+
+
+def iter_archive_members(archive_path: str):
+    '''
+    Yield the (name, data) of the regular files of an archive
+
+    Parameters
+    ----------
+    archive_path : str
+        Path to a zip or tar (possibly gz, bz2 or xz compressed) archive, or '-' to read a tar archive
+        from the standard input.
+
+    Returns
+    -------
+    members : generator
+        Name and content (bytes) of each file of the archive, in archive order.
+    '''
+    if archive_path == '-':
+        with tarfile.open(fileobj=sys.stdin.buffer, mode='r|*') as tar:
+            yield from iter_tar_members(tar)
+    elif zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, archive.read(info)
+    else:
+        with tarfile.open(archive_path, mode='r|*') as tar:
+            yield from iter_tar_members(tar)
+
+
+def open_output_tar(output_path: str) -> tarfile.TarFile:
+    '''
+    Open the output tar archive in stream mode: '-' for the standard output, gzip compressed if the path
+    ends with .gz or .tgz.
+    '''
+    if output_path == '-':
+        return tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+    if output_path.endswith('.gz') or output_path.endswith('.tgz'):
+        return tarfile.open(output_path, mode='w|gz')
+    return tarfile.open(output_path, mode='w|')
+
+
+def get_member_name(name: str, folders: dict) -> str:
+    '''
+    Name of an output member: the folder of the input member is replaced by its number in folders (a
+    dictionary folder -> number, updated with the new folders), so that the members of different folders
+    keep distinct names without the names of the folders.
+    '''
+    folder, file_name = posixpath.split(name)
+    if not folder:
+        return file_name
+    number = folders.setdefault(folder, len(folders) + 1)
+    return posixpath.join('{:06d}'.format(number), file_name)
+
+
+def add_tar_member(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    '''
+    Add a regular file with the given content to a tar archive.
+    '''
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def anonymize_archive(input_path: str, output_path: str, lookup_file: str, anonymization_plan,
+                      delete_private_tags: bool, rename_files: bool, pixel_passthrough: bool = False,
+                      quarantine_path: str = None, member_done_callback=None, fan_out_levels: int = 0) -> None:
+    '''
+    Anonymize the DICOM files of an archive and write them to a tar archive
+
+    Parameters
+    ----------
+    input_path : str
+        Path to the input zip or tar archive, or '-' for a tar archive read from the standard input.
+    output_path : str
+        Path to the output tar archive, or '-' to write it to the standard output.
+    lookup_file : str
+        File path to the lookup table.
+    anonymization_plan : AnonymizationPlan
+        Compiled anonymization rules.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to remane output members with pseudo.
+    pixel_passthrough : bool
+        Whether to only parse and anonymize the headers, the pixel data bytes being copied unchanged.
+    quarantine_path : str
+        If set, the members that cannot be anonymized are written to this folder and the run goes on.
+        Otherwise, the error is raised.
+    member_done_callback : function
+        Called with the member name and the error description (or None) once per member.
+    fan_out_levels : int
+        Number of levels of subfolders renamed members are spread into.
+
+    Returns
+    -------
+    None.
+    '''
+    folders = {}
+    # The standard output holds the archive
+    messages = contextlib.redirect_stdout(sys.stderr) if output_path == '-' else contextlib.nullcontext()
+    with open_output_tar(output_path) as output_tar, messages:
+        for name, data in iter_archive_members(input_path):
+            error = None
+            try:
+                in_stream = io.BytesIO(data)
+                out_stream = io.BytesIO()
+                dataset = simple_dicomanonymizer.anonymize_dicom_stream(in_stream, out_stream, lookup_file,
+                                                                        anonymization_plan, delete_private_tags,
+                                                                        pixel_passthrough)
+                out_name = simple_dicomanonymizer.get_output_path(dataset, get_member_name(name, folders),
+                                                                  rename_files, fan_out_levels)
+                add_tar_member(output_tar, out_name, out_stream.getvalue())
+            except Exception as e:
+                if quarantine_path is None:
+                    raise
+                error = describe_error(e)
+                with open(os.path.join(quarantine_path, os.path.basename(name)), 'wb') as quarantine_file:
+                    quarantine_file.write(data)
+            if member_done_callback is not None:
+                member_done_callback(name, error)
@@ -0,0 +1,203 @@
+'''
+Reading and writing of DICOM files for the anonymizer. Files are given as paths or as file-like objects.
+
+In pixel passthrough mode, only the header (every element before the pixel data) is parsed and
+anonymized. The pixel data element is copied byte for byte from the input file to the output file, so it
+is never loaded in memory and compressed or encapsulated pixel data is kept unchanged. The elements
+following the pixel data (e.g. private groups, Digital Signatures Sequence, Data Set Trailing Padding)
+are parsed with the header, so that the anonymization rules apply to them, and written after the copied
+pixel data. Files larger than LARGE_FILE_SIZE (e.g. enhanced multi-frame objects) are always read this
+way, so that the memory used does not depend on their size. When a redaction profile
+(cf utils.pixel_redaction) matches such a file, its frames are redacted one at a time as it is written.
+'''
+
+import os
+import shutil
+
+import pydicom
+
+from utils.frame_io import get_pixel_data_end, pop_trailing_elements, write_trailing_elements
+from utils.pixel_redaction import redact_frames
+
+# Size of the chunks copied from the input file to the output file
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Files larger than this are read without their pixel data, whatever the pixel passthrough mode. Only
+# the pixel data element is copied, their trailing elements are anonymized as in pixel passthrough mode
+LARGE_FILE_SIZE = 256 * 1024 * 1024
+
+# The whole dataset of these transfer syntaxes is compressed, the pixel data cannot be copied as is
+NON_PASSTHROUGH_TRANSFER_SYNTAXES = [
+    pydicom.uid.DeflatedExplicitVRLittleEndian
+]
+
+
+def read_dicom_header(fp) -> tuple:
+    '''
+    Read the elements of a DICOM file before the pixel data and return the dataset and the position of
+    the pixel data element, or None if it cannot be copied as is. The elements following the pixel data
+    element are read and added to the dataset.
+    '''
+    dataset = pydicom.dcmread(fp, force=True, stop_before_pixels=True)
+    # pydicom rewinds the file to the start of the pixel data element when it stops
+    pixel_data_offset = fp.tell()
+
+    file_meta = getattr(dataset, 'file_meta', None)
+    transfer_syntax = file_meta.get('TransferSyntaxUID') if file_meta is not None else None
+    if transfer_syntax in NON_PASSTHROUGH_TRANSFER_SYNTAXES:
+        return dataset, None
+
+    file_size = fp.seek(0, os.SEEK_END)
+    if pixel_data_offset >= file_size:
+        # No pixel data
+        return dataset, None
+    try:
+        tag, end = get_pixel_data_end(fp, pixel_data_offset, dataset.is_implicit_VR, dataset.is_little_endian)
+        if end < file_size:
+            fp.seek(end)
+            trailing = pydicom.filereader.read_dataset(fp, dataset.is_implicit_VR, dataset.is_little_endian)
+            for elem in trailing:
+                dataset.add(elem)
+    except Exception:
+        # The elements around the pixel data cannot be parsed, the whole file is read instead
+        return dataset, None
+    return dataset, pixel_data_offset
+
+
+def read_dicom_file(in_file, pixel_passthrough: bool = False) -> tuple:
+    '''
+    Read a DICOM file, or only its header in pixel passthrough mode.
+
+    Parameters
+    ----------
+    in_file : str or file-like object
+        File path or seekable file-like object to read from
+    pixel_passthrough : bool
+        Stop reading before the pixel data. Files larger than LARGE_FILE_SIZE are always read this way,
+        unless the elements following their pixel data cannot be parsed, then they are read in full.
+
+    Returns
+    -------
+    dataset, pixel_data_offset : tuple
+        The dataset and the position of the pixel data element in the file. The offset is None
+        if the whole file has been read.
+    '''
+    if isinstance(in_file, str) and os.path.getsize(in_file) > LARGE_FILE_SIZE:
+        pixel_passthrough = True
+    if pixel_passthrough:
+        if isinstance(in_file, str):
+            with open(in_file, 'rb') as fp:
+                dataset, pixel_data_offset = read_dicom_header(fp)
+        else:
+            start = in_file.tell()
+            dataset, pixel_data_offset = read_dicom_header(in_file)
+            if pixel_data_offset is None:
+                in_file.seek(start)
+        if pixel_data_offset is not None:
+            return dataset, pixel_data_offset
+
+    return pydicom.dcmread(in_file, force=True), None
+
+
+def copy_file_range(in_file: str, offset: int, length: int, out_file: str) -> None:
+    '''
+    Append length bytes of in_file, starting at offset, to out_file.
+    The copy is done in the kernel with os.copy_file_range when available, the bytes it does not copy are
+    copied through user space (cf copy_stream_range).
+    '''
+    with open(in_file, 'rb', buffering=0) as source, open(out_file, 'ab', buffering=0) as destination:
+        source.seek(offset)
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while length > 0:
+                    copied = os.copy_file_range(source.fileno(), destination.fileno(), min(length, COPY_CHUNK_SIZE))
+                    if copied == 0:
+                        # End of the input file, or nothing copied by the file system
+                        break
+                    length -= copied
+            except OSError:
+                # Not supported by the file systems
+                pass
+        # The rest is copied through user space, which raises if the input file ends in the pixel data
+        copy_stream_range(source, destination, length)
+
+
+def copy_stream_range(source, destination, length: int) -> None:
+    '''
+    Copy length bytes from the current position of source to destination.
+    '''
+    while length > 0:
+        chunk = source.read(min(length, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise ValueError('The input file ends in the pixel data')
+        destination.write(chunk)
+        length -= len(chunk)
+
+
+def get_pixel_data_span(in_file, pixel_data_offset: int, dataset) -> tuple:
+    '''
+    Return the (tag, end) of the pixel data element of in_file at pixel_data_offset (cf get_pixel_data_end).
+    '''
+    if isinstance(in_file, str):
+        with open(in_file, 'rb') as fp:
+            return get_pixel_data_end(fp, pixel_data_offset, dataset.is_implicit_VR, dataset.is_little_endian)
+    return get_pixel_data_end(in_file, pixel_data_offset, dataset.is_implicit_VR, dataset.is_little_endian)
+
+
+def write_dicom_file(dataset: pydicom.Dataset, out_file, in_file=None, pixel_data_offset: int = None,
+                     redaction_profile=None) -> None:
+    '''
+    Write a DICOM file. If the dataset has been read by read_dicom_file in pixel passthrough mode,
+    the pixel data element is copied from the input file, or redacted frame by frame if a redaction profile
+    is given, and followed by the (anonymized) elements read after it.
+
+    Parameters
+    ----------
+    dataset : FileDataset object of pydicom.dataset module
+        Dataset to write
+    out_file : str or file-like object
+        File path or file-like object to write to
+    in_file : str or file-like object
+        File path or file-like object the dataset has been read from
+    pixel_data_offset : int
+        Position of the pixel data element in in_file, as returned by read_dicom_file
+    redaction_profile : RedactionProfile
+        Profile matching the dataset, as returned by anonymize_dataset. It is only used when the pixel data
+        has not been read, the pixel data read with the dataset being redacted by anonymize_dataset.
+
+    Returns
+    -------
+    None.
+    '''
+    if pixel_data_offset is not None and redaction_profile is not None:
+        redact_frames(dataset, redaction_profile, in_file, pixel_data_offset, out_file)
+        return
+    if pixel_data_offset is None:
+        dataset.save_as(out_file, write_like_original=True)
+        return
+    # Only the pixel data element is copied, the elements following it are written from the dataset
+    tag, end = get_pixel_data_span(in_file, pixel_data_offset, dataset)
+    trailing = pop_trailing_elements(dataset, tag)
+    length = end - pixel_data_offset
+    # The header keeps the encoding of the input file, so that the copied bytes can follow it
+    dataset.save_as(out_file, write_like_original=True)
+    if isinstance(in_file, str) and isinstance(out_file, str):
+        copy_file_range(in_file, pixel_data_offset, length, out_file)
+        if len(trailing) > 0:
+            with open(out_file, 'ab') as destination:
+                write_trailing_elements(destination, trailing, dataset)
+        return
+
+    def copy(source, destination):
+        source.seek(pixel_data_offset)
+        copy_stream_range(source, destination, length)
+        write_trailing_elements(destination, trailing, dataset)
+
+    if isinstance(in_file, str):
+        with open(in_file, 'rb') as source:
+            copy(source, out_file)
+    elif isinstance(out_file, str):
+        with open(out_file, 'ab') as destination:
+            copy(in_file, destination)
+    else:
+        copy(in_file, out_file)
@@ -0,0 +1,333 @@
+'''
+Frame by frame access to the pixel data of DICOM files, so that objects with thousands of frames
+(enhanced CT/MR, tomosynthesis) are processed with the memory of a single frame.
+
+The header of the file is read without the pixel data (cf dicom_io.read_dicom_file in pixel passthrough
+mode), which gives the position of the pixel data element. The frames are then read one at a time from
+the file: native frames are read as they are stored, and encapsulated (compressed) frames are read
+fragment by fragment and decoded one at a time. Frames are written back in the native encoding: the
+decoded frames of compressed YBR color images are written as RGB, and those of lossy compressed images
+are flagged with LossyImageCompression (cf set_native_encoding). 1 bit pixel data, whose frames are not
+aligned on bytes, is read at once (cf read_pixel_data).
+'''
+
+import struct
+
+import numpy as np
+import pydicom
+from pydicom.encaps import encapsulate
+from pydicom.pixel_data_handlers.util import convert_color_space, pixel_dtype, reshape_pixel_array
+
+PIXEL_DATA_TAG = 0x7FE00010
+ITEM_TAG = 0xFFFEE000
+SEQUENCE_DELIMITER_TAG = 0xFFFEE0DD
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# VRs whose length is encoded on 4 bytes, after 2 reserved bytes, in explicit VR
+LONG_LENGTH_VRS = (b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT')
+
+# Elements copied to the dataset used to decode a single frame
+PIXEL_MODULE_KEYWORDS = ('SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration', 'Rows', 'Columns',
+                         'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation')
+
+# Lossy compressed transfer syntaxes, whose decoded pixel data is flagged with LossyImageCompression
+LOSSY_TRANSFER_SYNTAXES = (pydicom.uid.JPEGBaseline8Bit, pydicom.uid.JPEGExtended12Bit, pydicom.uid.JPEGLSNearLossless,
+                           pydicom.uid.JPEG2000, pydicom.uid.JPEG2000MC)
+
+# Photometric interpretations whose decoded pixels are YCbCr, converted to RGB (cf to_rgb)
+YBR_INTERPRETATIONS = ('YBR_FULL', 'YBR_FULL_422')
+
+# Photometric interpretations of JPEG 2000 color images, whose decoder already reverses the component
+# transform: the decoded pixels are RGB
+MCT_INTERPRETATIONS = ('YBR_ICT', 'YBR_RCT')
+
+
+def read_tag(fp, little_endian: bool) -> int:
+    group, element = struct.unpack('<HH' if little_endian else '>HH', fp.read(4))
+    return group << 16 | element
+
+
+def read_element_header(fp, implicit_vr: bool, little_endian: bool) -> tuple:
+    '''
+    Read the header of the data element at the current position of fp and return its (tag, length).
+    '''
+    endian = '<' if little_endian else '>'
+    tag = read_tag(fp, little_endian)
+    if implicit_vr:
+        return tag, struct.unpack(endian + 'L', fp.read(4))[0]
+    vr = fp.read(2)
+    if vr in LONG_LENGTH_VRS:
+        fp.read(2)
+        return tag, struct.unpack(endian + 'L', fp.read(4))[0]
+    return tag, struct.unpack(endian + 'H', fp.read(2))[0]
+
+
+def get_pixel_data_end(fp, pixel_data_offset: int, implicit_vr: bool, little_endian: bool) -> tuple:
+    '''
+    Read the header of the pixel data element at pixel_data_offset and return its (tag, end): the end is
+    the position following its value, or the sequence delimiter of its items if it is encapsulated.
+    '''
+    fp.seek(pixel_data_offset)
+    tag, length = read_element_header(fp, implicit_vr, little_endian)
+    if length != UNDEFINED_LENGTH:
+        return tag, fp.tell() + length
+    while True:
+        item_tag = read_tag(fp, little_endian)
+        item_length = struct.unpack('<L' if little_endian else '>L', fp.read(4))[0]
+        if item_tag == SEQUENCE_DELIMITER_TAG:
+            return tag, fp.tell()
+        if item_tag != ITEM_TAG:
+            raise ValueError('Unexpected tag {:08X} in the encapsulated pixel data'.format(item_tag))
+        fp.seek(item_length, 1)
+
+
+def pop_trailing_elements(dataset, pixel_data_tag: int = PIXEL_DATA_TAG) -> pydicom.Dataset:
+    '''
+    Remove the elements following the pixel data (e.g. private groups, Digital Signatures Sequence,
+    Data Set Trailing Padding) from a dataset read without its pixel data and return them, so that they
+    are written after the pixel data (cf write_trailing_elements).
+    '''
+    trailing = pydicom.Dataset()
+    for tag in [tag for tag in dataset.keys() if tag > pixel_data_tag]:
+        trailing.add(dataset[tag])
+        del dataset[tag]
+    return trailing
+
+
+def write_trailing_elements(fp, trailing: pydicom.Dataset, dataset) -> None:
+    '''
+    Write the elements returned by pop_trailing_elements to fp, with the encoding of dataset.
+    '''
+    if len(trailing) == 0:
+        return
+    out = pydicom.filebase.DicomFileLike(fp)
+    out.is_implicit_VR = dataset.is_implicit_VR
+    out.is_little_endian = dataset.is_little_endian
+    pydicom.filewriter.write_dataset(out, trailing)
+
+
+def get_frame_size(dataset) -> int:
+    '''
+    Size in bytes of a native frame of the dataset.
+    '''
+    if dataset.BitsAllocated == 1:
+        raise NotImplementedError('Frame by frame access to 1 bit pixel data is not supported')
+    return dataset.Rows * dataset.Columns * dataset.get('SamplesPerPixel', 1) * dataset.BitsAllocated // 8
+
+
+def to_rgb(pixels: np.ndarray, photometric_interpretation: str) -> np.ndarray:
+    '''
+    Convert the decoded pixels of a color image to RGB.
+    '''
+    if photometric_interpretation in YBR_INTERPRETATIONS:
+        return convert_color_space(pixels, photometric_interpretation, 'RGB')
+    return pixels
+
+
+def set_native_encoding(dataset) -> None:
+    '''
+    Update the header of a compressed dataset whose pixel data is written decoded: the transfer syntax
+    becomes explicit VR little endian, the photometric interpretation of YBR color images becomes RGB
+    (the pixels being converted with to_rgb), and LossyImageCompression is set if the compression was lossy.
+    '''
+    if dataset.file_meta.TransferSyntaxUID in LOSSY_TRANSFER_SYNTAXES:
+        dataset.LossyImageCompression = '01'
+    if dataset.get('PhotometricInterpretation') in YBR_INTERPRETATIONS + MCT_INTERPRETATIONS:
+        dataset.PhotometricInterpretation = 'RGB'
+    dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    dataset.is_implicit_VR = False
+    dataset.is_little_endian = True
+
+
+def get_frame_dataset(dataset) -> pydicom.Dataset:
+    '''
+    Return a dataset with the pixel module of dataset and a single frame, used to decode its frames.
+    '''
+    frame_dataset = pydicom.Dataset()
+    for keyword in PIXEL_MODULE_KEYWORDS:
+        if keyword in dataset:
+            setattr(frame_dataset, keyword, dataset.data_element(keyword).value)
+    frame_dataset.NumberOfFrames = 1
+    frame_dataset.file_meta = pydicom.dataset.FileMetaDataset()
+    frame_dataset.file_meta.TransferSyntaxUID = dataset.file_meta.TransferSyntaxUID
+    frame_dataset.is_little_endian = dataset.is_little_endian
+    frame_dataset.is_implicit_VR = dataset.is_implicit_VR
+    return frame_dataset
+
+
+def list_fragments(fp, little_endian: bool) -> tuple:
+    '''
+    Read the items of encapsulated pixel data, fp being at the start of the first item.
+
+    Returns
+    -------
+    offsets, fragments : tuple
+        The basic offset table, and the (position, length) of each fragment in the file.
+    '''
+    offsets = []
+    fragments = []
+    first_item = True
+    while True:
+        tag = read_tag(fp, little_endian)
+        length = struct.unpack('<L' if little_endian else '>L', fp.read(4))[0]
+        if tag == SEQUENCE_DELIMITER_TAG:
+            return offsets, fragments
+        if tag != ITEM_TAG:
+            raise ValueError('Unexpected tag {:08X} in the encapsulated pixel data'.format(tag))
+        if first_item:
+            offsets = list(struct.unpack(('<' if little_endian else '>') + '{}L'.format(length // 4), fp.read(length)))
+            first_item = False
+        else:
+            fragments.append((fp.tell(), length))
+            fp.seek(length, 1)
+
+
+def group_fragments(offsets: list, fragments: list, nb_frames: int) -> list:
+    '''
+    Return the list of fragments of each frame.
+    '''
+    if nb_frames == 1:
+        return [fragments]
+    if offsets:
+        # The offsets of the frames are counted from the item of the first fragment
+        first_position = fragments[0][0]
+        frames = [[] for offset in offsets]
+        frame_index = 0
+        for position, length in fragments:
+            while frame_index + 1 < len(offsets) and position - first_position >= offsets[frame_index + 1]:
+                frame_index += 1
+            frames[frame_index].append((position, length))
+        return frames
+    if len(fragments) == nb_frames:
+        return [[fragment] for fragment in fragments]
+    raise NotImplementedError('The frames of encapsulated pixel data without basic offset table cannot be '
+                              'separated when they span several fragments')
+
+
+def iter_frames(in_file, dataset, pixel_data_offset: int):
+    '''
+    Read the frames of a file one at a time
+
+    Parameters
+    ----------
+    in_file : str or file-like object
+        File the header of the dataset has been read from.
+    dataset : Dataset object of pydicom.dataset module
+        Header of the file, read without the pixel data.
+    pixel_data_offset : int
+        Position of the pixel data element in in_file, as returned by dicom_io.read_dicom_file.
+
+    Returns
+    -------
+    frames : generator
+        Arrays of each frame, of shape (rows, columns) or (rows, columns, samples) as Dataset.pixel_array.
+    '''
+    # The frame dataset is built now, before the caller changes the dataset
+    frame_dataset = get_frame_dataset(dataset)
+    nb_frames = int(dataset.get('NumberOfFrames', 1) or 1)
+    frame_size = get_frame_size(dataset)
+
+    def generate(fp):
+        fp.seek(pixel_data_offset)
+        tag, length = read_element_header(fp, dataset.is_implicit_VR, dataset.is_little_endian)
+        if tag != PIXEL_DATA_TAG:
+            raise ValueError('No pixel data at position {}'.format(pixel_data_offset))
+        if length != UNDEFINED_LENGTH:
+            start = fp.tell()
+            dtype = pixel_dtype(frame_dataset)
+            for frame_index in range(nb_frames):
+                fp.seek(start + frame_index * frame_size)
+                frame = np.frombuffer(fp.read(frame_size), dtype=dtype)
+                yield reshape_pixel_array(frame_dataset, frame)
+            return
+        offsets, fragments = list_fragments(fp, dataset.is_little_endian)
+        for frame_fragments in group_fragments(offsets, fragments, nb_frames):
+            data = bytearray()
+            for position, length in frame_fragments:
+                fp.seek(position)
+                data += fp.read(length)
+            frame_dataset.PixelData = encapsulate([bytes(data)])
+            yield frame_dataset.pixel_array
+
+    def generate_from_path():
+        with open(in_file, 'rb') as fp:
+            yield from generate(fp)
+
+    return generate_from_path() if isinstance(in_file, str) else generate(in_file)
+
+
+def read_pixel_data(in_file, dataset, pixel_data_offset: int) -> None:
+    '''
+    Read the pixel data element of in_file at pixel_data_offset and add it to dataset, for the pixel data
+    which is not read frame by frame (cf get_frame_size).
+    '''
+    def read(fp):
+        tag, end = get_pixel_data_end(fp, pixel_data_offset, dataset.is_implicit_VR, dataset.is_little_endian)
+        fp.seek(pixel_data_offset)
+        pixel_data = pydicom.filereader.read_dataset(fp, dataset.is_implicit_VR, dataset.is_little_endian,
+                                                     bytelength=end - pixel_data_offset)
+        for element in pixel_data:
+            dataset.add(element)
+
+    if isinstance(in_file, str):
+        with open(in_file, 'rb') as fp:
+            read(fp)
+    else:
+        read(in_file)
+
+
+def write_frames(dataset, out_file, frames, nb_frames: int) -> None:
+    '''
+    Write a dataset whose pixel data is given frame by frame
+
+    The header is written as by dicom_io.write_dicom_file, followed by a native pixel data element in
+    which the frames are written one at a time, then by the elements following the pixel data. A
+    compressed dataset is written with the explicit VR little endian transfer syntax (cf
+    set_native_encoding), its YBR color frames being converted to RGB.
+
+    Parameters
+    ----------
+    dataset : Dataset object of pydicom.dataset module
+        Header of the dataset, without pixel data.
+    out_file : str or file-like object
+        File path or file-like object to write to.
+    frames : iterable
+        Arrays of the frames, as returned by iter_frames.
+    nb_frames : int
+        Number of frames.
+
+    Returns
+    -------
+    None.
+    '''
+    if dataset.file_meta.TransferSyntaxUID.is_compressed:
+        photometric_interpretation = str(dataset.get('PhotometricInterpretation', ''))
+        frames = (to_rgb(frame, photometric_interpretation) for frame in frames)
+        set_native_encoding(dataset)
+    if dataset.get('SamplesPerPixel', 1) > 1:
+        dataset.PlanarConfiguration = 0
+    length = nb_frames * get_frame_size(dataset)
+    endian = '<' if dataset.is_little_endian else '>'
+    element_header = struct.pack(endian + 'HH', PIXEL_DATA_TAG >> 16, PIXEL_DATA_TAG & 0xFFFF)
+    if dataset.is_implicit_VR:
+        element_header += struct.pack(endian + 'L', length + length % 2)
+    else:
+        element_header += (b'OB' if dataset.BitsAllocated <= 8 else b'OW') + struct.pack(endian + 'HL', 0, length + length % 2)
+
+    # The elements following the pixel data are written after it
+    trailing = pop_trailing_elements(dataset)
+
+    def write(fp):
+        fp.write(element_header)
+        for frame in frames:
+            fp.write(np.asarray(frame, dtype=frame.dtype.newbyteorder(endian)).tobytes())
+        if length % 2:
+            fp.write(b'\0')
+        write_trailing_elements(fp, trailing, dataset)
+
+    dataset.save_as(out_file, write_like_original=True)
+    if isinstance(out_file, str):
+        with open(out_file, 'ab') as fp:
+            write(fp)
+    else:
+        write(out_file)
@@ -0,0 +1,187 @@
+'''
+Read-ahead / write-behind pipeline used to anonymize files on a single process.
+
+A pool of reader threads reads and parses the next files while the current one is anonymized, and a pool
+of writer threads writes the anonymized files in the background, so that the waits on the disk or the
+network overlap with the processing of the tags. The anonymization rules run on the calling thread only,
+as the pseudonymization state (UID dictionary and lookup table) is not shared between threads.
+The queues between the stages are bounded, so at most read_queue_depth + write_queue_depth datasets
+are held in memory.
+'''
+
+import collections
+import concurrent.futures
+import os
+import time
+
+from utils import profiling
+from utils import simple_dicomanonymizer
+from utils.anonymization_plan import AnonymizationPlan
+from utils.dicom_io import read_dicom_file, write_dicom_file
+from utils.manifest import describe_error
+
+DEFAULT_QUEUE_DEPTH = 8
+
+
+def read_file(in_file: str, pixel_passthrough: bool) -> tuple:
+    '''
+    Read a file in a reader thread.
+
+    Returns
+    -------
+    dataset, pixel_data_offset, seconds : tuple
+        As returned by read_dicom_file, and the time taken to read the file. The dataset is None if
+        in_file is not a file.
+    '''
+    start = time.perf_counter()
+    if not os.path.isfile(in_file):
+        return None, None, 0.0
+    dataset, pixel_data_offset = read_dicom_file(in_file, pixel_passthrough)
+    return dataset, pixel_data_offset, time.perf_counter() - start
+
+
+def write_file(dataset, out_file: str, in_file: str, pixel_data_offset: int, fan_out_levels: int,
+               redaction_profile=None) -> float:
+    '''
+    Write a file in a writer thread and return the time taken to write it.
+    '''
+    start = time.perf_counter()
+    if fan_out_levels > 0:
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    write_dicom_file(dataset, out_file, in_file, pixel_data_offset, redaction_profile)
+    return time.perf_counter() - start
+
+
+def submit(pool: concurrent.futures.Executor, function, *args) -> concurrent.futures.Future:
+    '''
+    Submit a call to the pool, or if there is no pool, make the call and return its result as a future.
+    '''
+    if pool is not None:
+        return pool.submit(function, *args)
+    future = concurrent.futures.Future()
+    future.set_running_or_notify_cancel()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def anonymize_pipelined(input_files_list: list, output_files_list: list, lookup_file: str,
+                        anonymization_plan: AnonymizationPlan, delete_private_tags: bool, rename_files: bool,
+                        readers: int, writers: int, read_queue_depth: int = DEFAULT_QUEUE_DEPTH,
+                        write_queue_depth: int = DEFAULT_QUEUE_DEPTH, pixel_passthrough: bool = False,
+                        catch_errors: bool = False, file_done_callback=None, fan_out_levels: int = 0) -> None:
+    '''
+    Anonymize files with reader and writer threads.
+
+    Parameters
+    ----------
+    input_files_list : list
+        Paths of the files to anonymize.
+    output_files_list : list
+        Paths of the anonymized files, in the same order as input_files_list.
+    lookup_file : str
+        File path to the lookup table.
+    anonymization_plan : AnonymizationPlan
+        Compiled anonymization rules.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to remane output files with pseudo.
+    readers : int
+        Number of reader threads. If 0, files are read by the calling thread.
+    writers : int
+        Number of writer threads. If 0, files are written by the calling thread.
+    read_queue_depth : int
+        Maximum number of files read ahead of the file being anonymized.
+    write_queue_depth : int
+        Maximum number of anonymized files waiting to be written.
+    pixel_passthrough : bool
+        Whether to copy the pixel data unchanged instead of reading it.
+    catch_errors : bool
+        Whether to go on with the other files when a file cannot be anonymized.
+    file_done_callback : function
+        Called with the input file path and the error description (or None) once per file, in input order,
+        when the file has been written.
+    fan_out_levels : int
+        Number of levels of subfolders renamed files are spread into.
+
+    Returns
+    -------
+    None.
+    '''
+    simple_dicomanonymizer.lookup_path = lookup_file
+    profiler = profiling.profiler
+    reader_pool = concurrent.futures.ThreadPoolExecutor(readers) if readers > 0 else None
+    writer_pool = concurrent.futures.ThreadPoolExecutor(writers) if writers > 0 else None
+    # Without threads, files are read and written one at a time
+    read_queue_depth = max(read_queue_depth, 1) if reader_pool is not None else 1
+    write_queue_depth = write_queue_depth if writer_pool is not None else 0
+
+    # (in_file, out_file, future of read_file)
+    pending_reads = collections.deque()
+    # (in_file, future of write_file or None, error, time spent before writing)
+    pending_writes = collections.deque()
+    files = zip(input_files_list, output_files_list)
+
+    def submit_reads():
+        while len(pending_reads) < read_queue_depth:
+            next_file = next(files, None)
+            if next_file is None:
+                return
+            in_file, out_file = next_file
+            pending_reads.append((in_file, out_file, submit(reader_pool, read_file, in_file, pixel_passthrough)))
+
+    def finish_write():
+        in_file, future, error, seconds = pending_writes.popleft()
+        if future is not None:
+            try:
+                write_seconds = future.result()
+                if profiler is not None:
+                    profiler.add_stage('write', write_seconds)
+                    profiler.add_file(seconds + write_seconds)
+            except Exception as e:
+                if not catch_errors:
+                    raise
+                error = describe_error(e)
+        if file_done_callback is not None:
+            file_done_callback(in_file, error)
+
+    try:
+        submit_reads()
+        while pending_reads:
+            in_file, out_file, read_future = pending_reads.popleft()
+            submit_reads()
+            error = None
+            write_future = None
+            try:
+                dataset, pixel_data_offset, seconds = read_future.result()
+                if dataset is not None:
+                    rules_start = time.perf_counter()
+                    redaction_profile = simple_dicomanonymizer.anonymize_dataset(dataset, anonymization_plan,
+                                                                                 delete_private_tags)
+                    if profiler is not None:
+                        profiler.add_stage('read', seconds)
+                    seconds += time.perf_counter() - rules_start
+                    out_path = simple_dicomanonymizer.get_output_path(dataset, out_file, rename_files, fan_out_levels)
+                    write_future = submit(writer_pool, write_file, dataset, out_path, in_file, pixel_data_offset,
+                                          fan_out_levels, redaction_profile)
+            except Exception as e:
+                if not catch_errors:
+                    raise
+                error = describe_error(e)
+            pending_writes.append((in_file, write_future, error, seconds if write_future is not None else 0.0))
+
+            # Files are reported in input order, once the files before them are written
+            while len(pending_writes) > write_queue_depth or (pending_writes and pending_writes[0][1] is None):
+                finish_write()
+        while pending_writes:
+            finish_write()
+    finally:
+        # On error, the files not read yet are dropped and the files being written are completed
+        for in_file, out_file, future in pending_reads:
+            future.cancel()
+        for pool in (reader_pool, writer_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
@@ -0,0 +1,385 @@
+'''
+Persistent lookup tables used by the P action (replace_and_keep_correspondence).
+
+A lookup table keeps the correspondence between the original and the pseudonymized PatientID and
+AccessionNumber. Each row has the columns:
+'old_patient_id', 'new_patient_id', 'old_accession_number', 'new_accession_number'
+
+Backends:
+- csv: the historical csv file. It is read once, indexed in memory and new rows are appended to the file.
+- sqlite: a SQLite database with indexes on old_patient_id and old_accession_number, and on
+  new_patient_id and new_accession_number for the reverse lookups.
+
+Both backends add rows by batches, can export the table to the csv format and can find the original
+values of pseudonymized ones (re-identification, cf reidentify.py).
+
+A row is identified by its old PatientID and old AccessionNumber: an AccessionNumber may be shared by
+several patients, e.g. the empty one of the files without AccessionNumber (cf add_new_rows).
+'''
+
+import csv
+import os
+import sqlite3
+
+LOOKUP_COLUMNS = ['old_patient_id', 'new_patient_id', 'old_accession_number', 'new_accession_number']
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class LookupStore:
+    '''
+    Base class of the lookup tables.
+
+    Rows are indexed by old patient id and old accession number. When several rows share the same
+    key, the first one added is returned.
+    '''
+
+    path = None
+    backend = None
+
+    def find_patient(self, old_patient_id: str):
+        '''Return the new patient id of old_patient_id, or None if the patient is unknown.'''
+        raise NotImplementedError
+
+    def find_accession(self, old_accession_number: str):
+        '''Return the row (list of 4 str) of old_accession_number, or None if it is unknown.'''
+        raise NotImplementedError
+
+    def find_row(self, old_patient_id: str, old_accession_number: str):
+        '''Return the row (list of 4 str) of a patient and an accession number, or None if it is unknown.'''
+        raise NotImplementedError
+
+    def find_new_patient(self, new_patient_id: str):
+        '''Return the old patient id of new_patient_id, or None if the pseudonym is unknown.'''
+        raise NotImplementedError
+
+    def find_new_accession(self, new_accession_number: str):
+        '''Return the row (list of 4 str) of new_accession_number, or None if the pseudonym is unknown.'''
+        raise NotImplementedError
+
+    def add(self, row: list) -> None:
+        '''Add a row to the table. The row is saved at the next commit.'''
+        raise NotImplementedError
+
+    def rows(self):
+        '''Iterate over all rows of the table, in insertion order.'''
+        raise NotImplementedError
+
+    def commit(self) -> None:
+        '''Save the rows added since the last commit.'''
+        pass
+
+    def close(self) -> None:
+        '''Commit and release the table.'''
+        self.commit()
+
+    def export_csv(self, csv_path: str) -> None:
+        '''
+        Write the whole table to a csv file, with the same format as the csv backend.
+
+        Parameters
+        ----------
+        csv_path : str
+            Path to the csv file to write.
+
+        Returns
+        -------
+        None.
+        '''
+        self.commit()
+        with open(csv_path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, lineterminator='\n')
+            writer.writerow(LOOKUP_COLUMNS)
+            writer.writerows(self.rows())
+
+
+class CsvLookupStore(LookupStore):
+    '''
+    Lookup table stored in a csv file.
+
+    The file is read once and indexed in memory, new rows are appended to the end of the file.
+    '''
+
+    backend = 'csv'
+
+    def __init__(self, path: str, batch_size: int = DEFAULT_BATCH_SIZE, read_only: bool = False):
+        self.path = path
+        self.batch_size = batch_size
+        self.read_only = read_only
+        self.all_rows = []
+        self.patients = {}
+        self.accessions = {}
+        self.keys = {}
+        # Reverse indexes, built on the first reverse lookup
+        self.new_patients = None
+        self.new_accessions = None
+        self.pending_rows = []
+
+        if os.path.exists(path):
+            with open(path, 'r', newline='') as csvfile:
+                reader = csv.reader(csvfile)
+                for row in reader:
+                    if row and row != LOOKUP_COLUMNS:
+                        self.index(row)
+
+    def index(self, row: list) -> None:
+        self.all_rows.append(row)
+        self.patients.setdefault(row[0], row[1])
+        self.accessions.setdefault(row[2], row)
+        self.keys.setdefault((row[0], row[2]), row)
+        if self.new_patients is not None:
+            self.index_reverse(row)
+
+    def index_reverse(self, row: list) -> None:
+        self.new_patients.setdefault(row[1], row[0])
+        self.new_accessions.setdefault(row[3], row)
+
+    def build_reverse_indexes(self) -> None:
+        if self.new_patients is None:
+            self.new_patients = {}
+            self.new_accessions = {}
+            for row in self.all_rows:
+                self.index_reverse(row)
+
+    def find_patient(self, old_patient_id: str):
+        return self.patients.get(old_patient_id)
+
+    def find_accession(self, old_accession_number: str):
+        return self.accessions.get(old_accession_number)
+
+    def find_row(self, old_patient_id: str, old_accession_number: str):
+        return self.keys.get((old_patient_id, old_accession_number))
+
+    def find_new_patient(self, new_patient_id: str):
+        self.build_reverse_indexes()
+        return self.new_patients.get(new_patient_id)
+
+    def find_new_accession(self, new_accession_number: str):
+        self.build_reverse_indexes()
+        return self.new_accessions.get(new_accession_number)
+
+    def add(self, row: list) -> None:
+        if self.read_only:
+            raise ValueError('Lookup table {} is opened in read only mode'.format(self.path))
+        row = [str(value) for value in row]
+        self.index(row)
+        self.pending_rows.append(row)
+        if len(self.pending_rows) >= self.batch_size:
+            self.commit()
+
+    def rows(self):
+        return iter(self.all_rows)
+
+    def commit(self) -> None:
+        if not self.pending_rows:
+            return
+        write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile, lineterminator='\n')
+            if write_header:
+                writer.writerow(LOOKUP_COLUMNS)
+            writer.writerows(self.pending_rows)
+        self.pending_rows = []
+
+
+class SqliteLookupStore(LookupStore):
+    '''
+    Lookup table stored in a SQLite database, indexed on the old and new patient ids and accession numbers.
+    The indexes of the new values are added to existing databases when they are opened with write access.
+    '''
+
+    backend = 'sqlite'
+
+    def __init__(self, path: str, batch_size: int = DEFAULT_BATCH_SIZE, read_only: bool = False):
+        self.path = path
+        self.batch_size = batch_size
+        self.read_only = read_only
+        self.nb_pending_rows = 0
+
+        if read_only:
+            self.connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True, timeout=60)
+        else:
+            self.connection = sqlite3.connect(path, timeout=60)
+            # WAL journal lets worker processes read the table while new rows are committed
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS lookup (id INTEGER PRIMARY KEY, '
+                                    'old_patient_id TEXT, new_patient_id TEXT, '
+                                    'old_accession_number TEXT, new_accession_number TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS lookup_old_patient_id ON lookup (old_patient_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS lookup_old_accession_number '
+                                    'ON lookup (old_accession_number)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS lookup_new_patient_id ON lookup (new_patient_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS lookup_new_accession_number '
+                                    'ON lookup (new_accession_number)')
+            self.connection.commit()
+
+    def find_patient(self, old_patient_id: str):
+        result = self.connection.execute('SELECT new_patient_id FROM lookup WHERE old_patient_id = ? '
+                                         'ORDER BY id LIMIT 1', (old_patient_id,)).fetchone()
+        return None if result is None else result[0]
+
+    def find_accession(self, old_accession_number: str):
+        result = self.connection.execute('SELECT ' + ', '.join(LOOKUP_COLUMNS) + ' FROM lookup '
+                                         'WHERE old_accession_number = ? ORDER BY id LIMIT 1',
+                                         (old_accession_number,)).fetchone()
+        return None if result is None else list(result)
+
+    def find_row(self, old_patient_id: str, old_accession_number: str):
+        result = self.connection.execute('SELECT ' + ', '.join(LOOKUP_COLUMNS) + ' FROM lookup '
+                                         'WHERE old_patient_id = ? AND old_accession_number = ? ORDER BY id LIMIT 1',
+                                         (old_patient_id, old_accession_number)).fetchone()
+        return None if result is None else list(result)
+
+    def find_new_patient(self, new_patient_id: str):
+        result = self.connection.execute('SELECT old_patient_id FROM lookup WHERE new_patient_id = ? '
+                                         'ORDER BY id LIMIT 1', (new_patient_id,)).fetchone()
+        return None if result is None else result[0]
+
+    def find_new_accession(self, new_accession_number: str):
+        result = self.connection.execute('SELECT ' + ', '.join(LOOKUP_COLUMNS) + ' FROM lookup '
+                                         'WHERE new_accession_number = ? ORDER BY id LIMIT 1',
+                                         (new_accession_number,)).fetchone()
+        return None if result is None else list(result)
+
+    def add(self, row: list) -> None:
+        self.connection.execute('INSERT INTO lookup (' + ', '.join(LOOKUP_COLUMNS) + ') VALUES (?, ?, ?, ?)',
+                                [str(value) for value in row])
+        self.nb_pending_rows += 1
+        if self.nb_pending_rows >= self.batch_size:
+            self.commit()
+
+    def rows(self):
+        cursor = self.connection.execute('SELECT ' + ', '.join(LOOKUP_COLUMNS) + ' FROM lookup ORDER BY id')
+        return (list(row) for row in cursor)
+
+    def commit(self) -> None:
+        if self.nb_pending_rows:
+            self.connection.commit()
+            self.nb_pending_rows = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+
+
+class MemoryLookupStore(LookupStore):
+    '''
+    Lookup table kept in memory on top of an optional read-only table.
+
+    Used by worker processes: new rows are not saved but collected in pending_rows so that the
+    parent process can merge them into the persistent table.
+    '''
+
+    def __init__(self, path: str = None, base_store: LookupStore = None):
+        self.path = path
+        self.base_store = base_store
+        self.patients = {}
+        self.accessions = {}
+        self.keys = {}
+        self.pending_rows = []
+
+    def find_patient(self, old_patient_id: str):
+        if old_patient_id in self.patients:
+            return self.patients[old_patient_id]
+        return None if self.base_store is None else self.base_store.find_patient(old_patient_id)
+
+    def find_accession(self, old_accession_number: str):
+        if old_accession_number in self.accessions:
+            return self.accessions[old_accession_number]
+        return None if self.base_store is None else self.base_store.find_accession(old_accession_number)
+
+    def find_row(self, old_patient_id: str, old_accession_number: str):
+        if (old_patient_id, old_accession_number) in self.keys:
+            return self.keys[(old_patient_id, old_accession_number)]
+        return None if self.base_store is None else self.base_store.find_row(old_patient_id, old_accession_number)
+
+    def find_new_patient(self, new_patient_id: str):
+        # The rows of the base table were added first
+        old_patient_id = None if self.base_store is None else self.base_store.find_new_patient(new_patient_id)
+        if old_patient_id is None:
+            old_patient_id = next((row[0] for row in self.pending_rows if row[1] == new_patient_id), None)
+        return old_patient_id
+
+    def find_new_accession(self, new_accession_number: str):
+        row = None if self.base_store is None else self.base_store.find_new_accession(new_accession_number)
+        if row is None:
+            row = next((row for row in self.pending_rows if row[3] == new_accession_number), None)
+        return row
+
+    def add(self, row: list) -> None:
+        row = [str(value) for value in row]
+        if self.find_patient(row[0]) is None:
+            self.patients[row[0]] = row[1]
+        if self.find_accession(row[2]) is None:
+            self.accessions[row[2]] = row
+        if self.find_row(row[0], row[2]) is None:
+            self.keys[(row[0], row[2])] = row
+        self.pending_rows.append(row)
+
+    def rows(self):
+        base_rows = [] if self.base_store is None else self.base_store.rows()
+        yield from base_rows
+        yield from self.pending_rows
+
+    def close(self) -> None:
+        if self.base_store is not None:
+            self.base_store.close()
+
+
+def add_new_rows(store: LookupStore, rows: list) -> None:
+    '''
+    Add to a lookup table the rows of another table (e.g. the rows added by a worker process) that it does
+    not hold yet.
+
+    Several processes may have pseudonymized the same patient and accession number, only the first row
+    of a (old PatientID, old AccessionNumber) pair is kept. The AccessionNumber alone is not a key: the
+    new patients without AccessionNumber all have a row with an empty one.
+
+    Parameters
+    ----------
+    store : LookupStore
+        Table where the rows are added.
+    rows : list
+        Rows (lists of 4 str) to add.
+
+    Returns
+    -------
+    None.
+    '''
+    for row in rows:
+        if store.find_row(row[0], row[2]) is None:
+            store.add(row)
+
+
+LOOKUP_BACKENDS = {
+    'csv': CsvLookupStore,
+    'sqlite': SqliteLookupStore
+}
+
+
+def open_lookup_store(path: str, backend: str = 'csv', batch_size: int = DEFAULT_BATCH_SIZE,
+                      read_only: bool = False) -> LookupStore:
+    '''
+    Open the lookup table stored at path.
+
+    Parameters
+    ----------
+    path : str
+        Path to the lookup table (csv file or SQLite database).
+    backend : str
+        Name of the backend: 'csv' or 'sqlite'. The default is 'csv'.
+    batch_size : int
+        Number of rows added before they are saved. The default is 1000.
+    read_only : bool
+        Open the table without write access. A missing table is then opened as an empty table.
+
+    Returns
+    -------
+    store : LookupStore
+        The opened lookup table.
+    '''
+    if backend not in LOOKUP_BACKENDS:
+        raise ValueError('Unknown lookup backend {}, expected one of {}'.format(backend, list(LOOKUP_BACKENDS)))
+    if read_only and not os.path.exists(path):
+        return MemoryLookupStore(path)
+    return LOOKUP_BACKENDS[backend](path, batch_size=batch_size, read_only=read_only)
@@ -0,0 +1,112 @@
+'''
+Processing manifest of the anonymization runs.
+
+The manifest is a SQLite database which records, for every input file, the state of the file when it
+was processed (size, modification time and optionally a hash of its content), the hash of the rules it
+was anonymized with and the result ('done' or 'failed', with the error). A new run over the same folder
+skips the files which are done and unchanged since, so only new or modified files are anonymized.
+'''
+
+import hashlib
+import os
+import sqlite3
+import time
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def describe_error(error: Exception) -> str:
+    '''
+    Describe an exception raised while anonymizing a file, as recorded in the manifest.
+    '''
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+def get_file_state(path: str, use_content_hash: bool = False) -> dict:
+    '''
+    Get the state of a file used to detect if it changed since the last run
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+    use_content_hash : bool
+        Whether to compute the sha256 of the file content, for file systems where the modification time
+        is not reliable.
+
+    Returns
+    -------
+    state : dict
+        Dictionary with the size, the modification time (ns) and the content hash (or None) of the file.
+    '''
+    stat = os.stat(path)
+    content_hash = None
+    if use_content_hash:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        content_hash = sha.hexdigest()
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "content_hash": content_hash
+    }
+
+
+class Manifest:
+    '''
+    Record of the files processed by the previous runs, identified by their absolute path.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database of the manifest. It is created if it does not exist.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.nb_pending_records = 0
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, '
+                                'mtime INTEGER, content_hash TEXT, profile_hash TEXT, status TEXT, error TEXT, '
+                                'processed_at REAL)')
+        self.connection.commit()
+
+    def is_up_to_date(self, path: str, state: dict, profile_hash: str) -> bool:
+        '''
+        Whether the file has already been anonymized, with the same rules, and did not change since.
+        When the content hash is known, it is used instead of the modification time.
+        '''
+        result = self.connection.execute('SELECT size, mtime, content_hash, profile_hash, status FROM files '
+                                         'WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        if result is None:
+            return False
+        size, mtime, content_hash, previous_profile_hash, status = result
+        if status != STATUS_DONE or previous_profile_hash != profile_hash or size != state["size"]:
+            return False
+        if state["content_hash"] is not None:
+            return content_hash == state["content_hash"]
+        return mtime == state["mtime"]
+
+    def record(self, path: str, state: dict, profile_hash: str, status: str, error: str = None) -> None:
+        '''
+        Record the result of the processing of a file. The record is saved at the next commit.
+        '''
+        self.connection.execute('INSERT OR REPLACE INTO files (path, size, mtime, content_hash, profile_hash, '
+                                'status, error, processed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (os.path.abspath(path), state["size"], state["mtime"], state["content_hash"], profile_hash, status,
+                                 error, time.time()))
+        self.nb_pending_records += 1
+
+    def commit(self) -> None:
+        if self.nb_pending_records:
+            self.connection.commit()
+            self.nb_pending_records = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,266 @@
+'''
+Redaction of the annotations burned in the pixels (e.g. patient names on ultrasound or secondary
+capture images).
+
+Redaction profiles are read from a JSON file (cf load_redaction_profiles) listing, for a modality, a
+manufacturer, a model and/or a geometry, the rectangles (and optionally a mask) of the regions to
+redact. The first profile matching the header of a dataset is applied: its regions are set to zero in
+every frame at once, with NumPy, and the pixel data is written back uncompressed. When only the header
+has been read (pixel passthrough, large files), the frames are redacted one at a time while the file is
+written (cf redact_frames), except 1 bit pixel data which is read and redacted at once. The pixel data of the datasets matching no profile is neither decoded nor
+modified.
+
+Example of profile file:
+
+    [
+        {"name": "Ultrasound A", "modality": "US", "manufacturer": "Vendor", "rows": 600, "columns": 800,
+         "rectangles": [[0, 0, 800, 60]]},
+        {"name": "Screenshots", "modality": ["OT", "SC"], "mask": "screenshot_mask.npy"}
+    ]
+
+Rectangles are [x, y, width, height] in pixels. A mask is a .npy file holding an array of Rows x Columns
+values, whose non-zero values are redacted. Its path is relative to the profile file.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pydicom
+from pydicom.pixel_data_handlers.numpy_handler import pack_bits
+
+from utils.frame_io import (MCT_INTERPRETATIONS, YBR_INTERPRETATIONS, iter_frames, read_pixel_data, set_native_encoding,
+                            to_rgb, write_frames)
+
+
+class RedactionProfile:
+    '''
+    Regions to redact in the pixels of the datasets matching some criteria.
+
+    Parameters
+    ----------
+    name : str
+        Name of the profile, used in the messages.
+    modality : str or list
+        Modality (or modalities) of the datasets, or None to match any.
+    manufacturer : str
+        Text contained in the Manufacturer of the datasets (case insensitive), or None to match any.
+    model : str
+        Text contained in the ManufacturerModelName of the datasets (case insensitive), or None to match any.
+    rows : int
+        Rows of the datasets, or None to match any.
+    columns : int
+        Columns of the datasets, or None to match any.
+    rectangles : list
+        List of [x, y, width, height] regions to redact.
+    mask : numpy.ndarray
+        Array of Rows x Columns values whose non-zero values are redacted, or None.
+    '''
+
+    def __init__(self, name: str, modality=None, manufacturer: str = None, model: str = None, rows: int = None,
+                 columns: int = None, rectangles: list = (), mask: np.ndarray = None):
+        if not rectangles and mask is None:
+            raise ValueError('The redaction profile {} has neither rectangles nor mask'.format(name))
+        self.name = name
+        self.modalities = None if modality is None else ([modality] if isinstance(modality, str) else list(modality))
+        self.manufacturer = manufacturer.lower() if manufacturer is not None else None
+        self.model = model.lower() if model is not None else None
+        self.rows = rows
+        self.columns = columns
+        self.rectangles = [tuple(int(value) for value in rectangle) for rectangle in rectangles]
+        self.mask = mask != 0 if mask is not None else None
+        # (rows, columns) -> boolean mask of the redacted pixels
+        self.masks = {}
+
+    def matches(self, dataset) -> bool:
+        '''
+        Whether the header of the dataset matches the criteria of the profile.
+        '''
+        if self.modalities is not None and dataset.get('Modality') not in self.modalities:
+            return False
+        if self.manufacturer is not None and self.manufacturer not in str(dataset.get('Manufacturer', '')).lower():
+            return False
+        if self.model is not None and self.model not in str(dataset.get('ManufacturerModelName', '')).lower():
+            return False
+        if self.rows is not None and dataset.get('Rows') != self.rows:
+            return False
+        if self.columns is not None and dataset.get('Columns') != self.columns:
+            return False
+        return 'Rows' in dataset and 'Columns' in dataset
+
+    def get_mask(self, rows: int, columns: int) -> np.ndarray:
+        '''
+        Return the boolean mask of the redacted pixels of an image of rows x columns, built once per size.
+        '''
+        mask = self.masks.get((rows, columns))
+        if mask is None:
+            mask = np.zeros((rows, columns), dtype=bool)
+            for x, y, width, height in self.rectangles:
+                # Rectangles are clipped to the image
+                mask[max(y, 0):max(y + height, 0), max(x, 0):max(x + width, 0)] = True
+            if self.mask is not None:
+                if self.mask.shape != (rows, columns):
+                    raise ValueError('The mask of the redaction profile {} is {}, the image is {}'.format(
+                        self.name, self.mask.shape, (rows, columns)))
+                mask |= self.mask
+            self.masks[(rows, columns)] = mask
+        return mask
+
+    def __getstate__(self):
+        # The masks are built again by the worker processes
+        state = dict(self.__dict__)
+        state['masks'] = {}
+        return state
+
+    def __repr__(self):
+        # The mask is described by a hash of its values, so that the plan fingerprint changes with it
+        mask_hash = hashlib.sha256(np.packbits(self.mask).tobytes()).hexdigest() if self.mask is not None else None
+        return 'RedactionProfile({!r}, {!r}, {!r}, {!r}, {!r}, {!r}, {!r}, {!r})'.format(
+            self.name, self.modalities, self.manufacturer, self.model, self.rows, self.columns, self.rectangles,
+            mask_hash)
+
+
+def load_redaction_profiles(profiles_path: str) -> list:
+    '''
+    Read the redaction profiles of a JSON file
+
+    Parameters
+    ----------
+    profiles_path : str
+        Path to the JSON list of profiles (cf the module documentation).
+
+    Returns
+    -------
+    profiles : list
+        The RedactionProfile objects, in the order in which they are matched.
+    '''
+    with open(profiles_path) as profiles_file:
+        data = json.load(profiles_file)
+    profiles = []
+    for index, profile in enumerate(data):
+        profile = dict(profile)
+        mask_path = profile.pop('mask', None)
+        if mask_path is not None:
+            profile['mask'] = np.load(os.path.join(os.path.dirname(profiles_path), mask_path))
+        profile.setdefault('name', 'profile {}'.format(index))
+        profiles.append(RedactionProfile(**profile))
+    return profiles
+
+
+def find_redaction_profile(profiles, dataset):
+    '''
+    Return the first profile matching the dataset, or None.
+    '''
+    for profile in profiles or ():
+        if profile.matches(dataset):
+            return profile
+    return None
+
+
+def redact_pixels(dataset: pydicom.Dataset, profile: RedactionProfile) -> None:
+    '''
+    Set the regions of the profile to zero in every frame of the dataset
+
+    The pixel data is decoded, redacted and written back in the native (uncompressed) encoding: a
+    compressed dataset is written with the explicit VR little endian transfer syntax (cf
+    frame_io.set_native_encoding), and YBR color images are converted to RGB.
+
+    Parameters
+    ----------
+    dataset : Dataset object of pydicom.dataset module
+        Dataset with its pixel data.
+    profile : RedactionProfile
+        Regions to redact.
+
+    Returns
+    -------
+    None.
+    '''
+    if 'PixelData' not in dataset:
+        raise ValueError('The pixel data must be read to apply the redaction profile {}'.format(profile.name))
+
+    pixels = dataset.pixel_array
+    photometric_interpretation = str(dataset.get('PhotometricInterpretation', ''))
+    if photometric_interpretation in YBR_INTERPRETATIONS + MCT_INTERPRETATIONS:
+        pixels = to_rgb(pixels, photometric_interpretation)
+        dataset.PhotometricInterpretation = 'RGB'
+    if not pixels.flags.writeable or not pixels.flags.c_contiguous:
+        pixels = np.ascontiguousarray(pixels).copy()
+
+    rows = dataset.Rows
+    columns = dataset.Columns
+    samples = dataset.get('SamplesPerPixel', 1)
+    # (frames, rows, columns, samples) view, whatever the number of frames and samples
+    frames = pixels.reshape(-1, rows, columns, samples)
+    frames[:, profile.get_mask(rows, columns)] = 0
+
+    if samples > 1:
+        dataset.PlanarConfiguration = 0
+    file_meta = getattr(dataset, 'file_meta', None)
+    transfer_syntax = file_meta.get('TransferSyntaxUID') if file_meta is not None else None
+    compressed = transfer_syntax is not None and transfer_syntax.is_compressed
+    if compressed:
+        set_native_encoding(dataset)
+    if dataset.BitsAllocated == 1:
+        dataset.PixelData = pack_bits(pixels)
+    else:
+        # The pixel data is written in the byte order of the dataset, whatever the one of the decoded array
+        endian = '<' if dataset.is_little_endian else '>'
+        dataset.PixelData = pixels.astype(pixels.dtype.newbyteorder(endian), copy=False).tobytes()
+    if compressed:
+        dataset['PixelData'].VR = 'OB' if dataset.BitsAllocated <= 8 else 'OW'
+        dataset['PixelData'].is_undefined_length = False
+
+
+def redact_frames(dataset: pydicom.Dataset, profile: RedactionProfile, in_file, pixel_data_offset: int,
+                  out_file) -> None:
+    '''
+    Write a dataset whose pixel data has not been read, redacting its frames one at a time
+
+    As redact_pixels, but the frames are read from in_file, redacted and written to out_file one at a
+    time (cf utils.frame_io), so that the memory used does not depend on the number of frames. 1 bit pixel
+    data, which is not read frame by frame, is read and redacted at once with redact_pixels.
+
+    Parameters
+    ----------
+    dataset : Dataset object of pydicom.dataset module
+        Header of the dataset, read without the pixel data.
+    profile : RedactionProfile
+        Regions to redact.
+    in_file : str or file-like object
+        File the header has been read from.
+    pixel_data_offset : int
+        Position of the pixel data element in in_file.
+    out_file : str or file-like object
+        File path or file-like object to write to.
+
+    Returns
+    -------
+    None.
+    '''
+    if dataset.BitsAllocated == 1:
+        read_pixel_data(in_file, dataset, pixel_data_offset)
+        redact_pixels(dataset, profile)
+        dataset.save_as(out_file, write_like_original=True)
+        return
+
+    frames = iter_frames(in_file, dataset, pixel_data_offset)
+    photometric_interpretation = str(dataset.get('PhotometricInterpretation', ''))
+    convert = photometric_interpretation in YBR_INTERPRETATIONS + MCT_INTERPRETATIONS
+    if convert:
+        dataset.PhotometricInterpretation = 'RGB'
+    rows = dataset.Rows
+    columns = dataset.Columns
+    mask = profile.get_mask(rows, columns)
+
+    def redacted_frames():
+        for frame in frames:
+            if convert:
+                frame = to_rgb(frame, photometric_interpretation)
+            if not frame.flags.writeable or not frame.flags.c_contiguous:
+                frame = np.ascontiguousarray(frame).copy()
+            frame.reshape(rows, columns, -1)[mask] = 0
+            yield frame
+
+    write_frames(dataset, out_file, redacted_frames(), int(dataset.get('NumberOfFrames', 1) or 1))
@@ -0,0 +1,120 @@
+'''
+Opt-in timing of the anonymization.
+
+When profiling is enabled (cf enable_profiling), the anonymizer records the cumulative time and number of
+calls of each stage of the processing of a file (read, rules, private_tags, scrub, redact, write) and of each
+action of the rules (replace, delete, replace_and_keep_correspondence, regexp rules...), and a histogram of the
+latencies of the files. When it is disabled, profiler is None and the anonymizer only checks it.
+'''
+
+import bisect
+import json
+
+# Upper bounds (ms) of the buckets of the file latency histogram, the last bucket is unbounded
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+# Profiler of the current process, None when profiling is disabled
+profiler = None
+
+
+def get_action_name(action) -> str:
+    '''
+    Name of an action as reported by the profiler, the name of the function for functools.partial objects.
+    '''
+    action = getattr(action, 'func', action)
+    return getattr(action, '__name__', repr(action))
+
+
+class Profiler:
+    '''
+    Cumulative time and number of calls per stage and per action, and histogram of the file latencies.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        # name -> [number of calls, cumulative time (s)]
+        self.stages = {}
+        self.actions = {}
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        timing = self.stages.setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+
+    def add_action(self, action, seconds: float) -> None:
+        timing = self.actions.setdefault(get_action_name(action), [0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+
+    def add_file(self, seconds: float) -> None:
+        self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS_MS, 1000 * seconds)] += 1
+        self.latency_total += seconds
+        self.latency_max = max(self.latency_max, seconds)
+
+    def pop_state(self) -> tuple:
+        '''
+        Return the recorded timings, in the form accepted by merge, and reset them.
+        Used by the worker processes to send the timings of each file to the parent process.
+        '''
+        state = (self.stages, self.actions, self.latency_counts, self.latency_total, self.latency_max)
+        self.reset()
+        return state
+
+    def merge(self, state: tuple) -> None:
+        '''
+        Add the timings returned by pop_state.
+        '''
+        stages, actions, latency_counts, latency_total, latency_max = state
+        for timings, new_timings in ((self.stages, stages), (self.actions, actions)):
+            for name, (count, seconds) in new_timings.items():
+                timing = timings.setdefault(name, [0, 0.0])
+                timing[0] += count
+                timing[1] += seconds
+        self.latency_counts = [count + new_count for count, new_count in zip(self.latency_counts, latency_counts)]
+        self.latency_total += latency_total
+        self.latency_max = max(self.latency_max, latency_max)
+
+    def to_dict(self) -> dict:
+        '''
+        Report of the timings, as written by dump.
+        '''
+        def describe(timings):
+            return {name: {"count": count, "seconds": seconds, "mean_ms": 1000 * seconds / count}
+                    for name, (count, seconds) in sorted(timings.items(), key=lambda item: -item[1][1])}
+
+        nb_files = sum(self.latency_counts)
+        return {
+            "stages": describe(self.stages),
+            "actions": describe(self.actions),
+            "file_latency": {
+                "count": nb_files,
+                "seconds": self.latency_total,
+                "mean_ms": 1000 * self.latency_total / nb_files if nb_files > 0 else None,
+                "max_ms": 1000 * self.latency_max,
+                "buckets_ms": LATENCY_BUCKETS_MS + [None],
+                "counts": self.latency_counts
+            }
+        }
+
+    def dump(self, path: str) -> None:
+        with open(path, 'w') as profile_file:
+            json.dump(self.to_dict(), profile_file, indent=4)
+
+
+def enable_profiling() -> Profiler:
+    '''
+    Enable profiling in the current process and return the new profiler.
+    '''
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+
+def disable_profiling() -> None:
+    global profiler
+    profiler = None
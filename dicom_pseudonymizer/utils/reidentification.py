@@ -0,0 +1,127 @@
+'''
+Re-identification of pseudonymized PatientIDs and AccessionNumbers with the lookup table of the
+pseudonymizer (cf utils.lookup_store).
+
+The pseudonyms are looked up in the reverse indexes of the table: in memory for the csv backend (built
+once when the first pseudonym is looked up), and with the indexes on new_patient_id and
+new_accession_number for the sqlite backend. Files are processed line by line, so that their size does
+not matter, and a long-lived process can answer queries one line at a time (cf serve).
+'''
+
+import csv
+
+# Columns of the results of reidentify_lines
+RESULT_COLUMNS = ['pseudonym', 'kind', 'old_patient_id', 'old_accession_number']
+
+# Columns added to the rows of a csv file by reidentify_csv
+ADDED_COLUMNS = ['old_patient_id', 'old_accession_number']
+
+# Kinds of pseudonyms: 'auto' looks the pseudonym up as a PatientID, then as an AccessionNumber
+KINDS = ('auto', 'patient', 'accession')
+
+
+class Reidentifier:
+    '''
+    Reverse lookups in a lookup table.
+
+    Parameters
+    ----------
+    store : LookupStore
+        The lookup table the pseudonyms have been written to.
+    kind : str
+        Kind of the pseudonyms: 'patient', 'accession' or 'auto'.
+    '''
+
+    def __init__(self, store, kind: str = 'auto'):
+        if kind not in KINDS:
+            raise ValueError('Unknown kind of pseudonym {}, expected one of {}'.format(kind, list(KINDS)))
+        self.store = store
+        self.kind = kind
+        self.nb_queries = 0
+        self.nb_unknown = 0
+
+    def reidentify(self, pseudonym: str) -> tuple:
+        '''
+        Find the original values of a pseudonym
+
+        Returns
+        -------
+        kind, old_patient_id, old_accession_number : tuple
+            The kind of the pseudonym ('patient', 'accession' or 'unknown') and its original values. The
+            AccessionNumber is empty for a PatientID, both values are empty for an unknown pseudonym.
+        '''
+        pseudonym = pseudonym.strip()
+        self.nb_queries += 1
+        if self.kind != 'accession':
+            old_patient_id = self.store.find_new_patient(pseudonym)
+            if old_patient_id is not None:
+                return 'patient', old_patient_id, ''
+        if self.kind != 'patient':
+            row = self.store.find_new_accession(pseudonym)
+            if row is not None:
+                return 'accession', row[0], row[2]
+        self.nb_unknown += 1
+        return 'unknown', '', ''
+
+
+def reidentify_lines(reidentifier: Reidentifier, lines):
+    '''
+    Re-identify one pseudonym per line and generate the result rows (cf RESULT_COLUMNS). Empty lines
+    are skipped.
+    '''
+    for line in lines:
+        pseudonym = line.strip()
+        if pseudonym:
+            yield [pseudonym, *reidentifier.reidentify(pseudonym)]
+
+
+def reidentify_csv(reidentifier: Reidentifier, input_file, output_file, column: str) -> None:
+    '''
+    Copy a csv file, adding the original values of the pseudonyms of one of its columns
+
+    Parameters
+    ----------
+    reidentifier : Reidentifier
+        Reverse lookups to make.
+    input_file : file-like object
+        Csv file with a header, e.g. the outputs of a model.
+    output_file : file-like object
+        Csv file written with the rows of input_file followed by the columns of ADDED_COLUMNS.
+    column : str
+        Name of the column of the pseudonyms.
+
+    Returns
+    -------
+    None.
+    '''
+    reader = csv.reader(input_file)
+    writer = csv.writer(output_file, lineterminator='\n')
+    header = next(reader, None)
+    if header is None:
+        return
+    if column not in header:
+        raise ValueError('No column {} in the header {}'.format(column, header))
+    index = header.index(column)
+    writer.writerow(header + ADDED_COLUMNS)
+    for row in reader:
+        if index < len(row) and row[index].strip():
+            kind, old_patient_id, old_accession_number = reidentifier.reidentify(row[index])
+            writer.writerow(row + [old_patient_id, old_accession_number])
+        else:
+            writer.writerow(row + ['', ''])
+
+
+def serve(reidentifier: Reidentifier, input_stream, output_stream) -> None:
+    '''
+    Answer queries until the end of input_stream: for each pseudonym read on a line, a csv row
+    (cf RESULT_COLUMNS) is written and flushed, so that another process can query the table
+    without opening it again.
+    '''
+    writer = csv.writer(output_stream, lineterminator='\n')
+    for line in input_stream:
+        pseudonym = line.strip()
+        if pseudonym:
+            writer.writerow([pseudonym, *reidentifier.reidentify(pseudonym)])
+        else:
+            writer.writerow([])
+        output_stream.flush()
@@ -0,0 +1,145 @@
+'''
+Partition of an archive between several nodes, and merge of their lookup tables.
+
+In shard mode, each node anonymizes the files of the patients whose PatientID hashes to its shard
+(cf get_patient_shard), so the nodes own disjoint sets of patients and each one writes its own lookup
+table. The shards of the lookup table are then merged into one table by merge_lookup_shards, which
+flags the conflicting mappings: an original PatientID, or AccessionNumber of a patient, pseudonymized
+differently by two shards, or a pseudonym given to two different original values.
+'''
+
+import hashlib
+
+import pydicom
+
+from utils.lookup_store import LookupStore
+
+
+def parse_shard(shard: str) -> tuple:
+    '''
+    Parse a shard given as "index/count", e.g. "0/4" for the first of 4 shards.
+
+    Returns
+    -------
+    shard_index, nb_shards : tuple
+        Index of the shard (from 0) and number of shards.
+    '''
+    try:
+        shard_index, nb_shards = (int(value) for value in shard.split('/'))
+    except ValueError:
+        raise ValueError('Invalid shard {}, expected index/count, e.g. 0/4'.format(shard))
+    if nb_shards < 1 or not 0 <= shard_index < nb_shards:
+        raise ValueError('Invalid shard {}, the index must be between 0 and count - 1'.format(shard))
+    return shard_index, nb_shards
+
+
+def get_patient_shard(patient_id: str, nb_shards: int) -> int:
+    '''
+    Return the shard of a patient. The hash is stable across processes, machines and Python versions.
+    '''
+    digest = hashlib.sha256(patient_id.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % nb_shards
+
+
+def read_patient_id(path: str) -> str:
+    '''
+    Read the PatientID of a DICOM file, without its pixel data. Files which cannot be read, or without
+    PatientID, have the empty PatientID, so they all belong to the same shard.
+    '''
+    try:
+        dataset = pydicom.dcmread(path, force=True, stop_before_pixels=True, specific_tags=['PatientID'])
+        return str(dataset.get('PatientID', ''))
+    except Exception:
+        return ''
+
+
+def select_shard_files(input_files_list: list, output_files_list: list, shard_index: int, nb_shards: int) -> tuple:
+    '''
+    Keep the files of the patients of a shard
+
+    Parameters
+    ----------
+    input_files_list : list
+        Paths of the input files.
+    output_files_list : list
+        Paths of the output files, in the same order as input_files_list.
+    shard_index : int
+        Index of the shard of this node.
+    nb_shards : int
+        Number of shards.
+
+    Returns
+    -------
+    input_files_list, output_files_list : tuple
+        The input and output paths of the files of the shard.
+    '''
+    selected_files = [(in_file, out_file) for in_file, out_file in zip(input_files_list, output_files_list)
+                      if get_patient_shard(read_patient_id(in_file), nb_shards) == shard_index]
+    return [in_file for in_file, out_file in selected_files], [out_file for in_file, out_file in selected_files]
+
+
+def merge_lookup_shards(shard_stores: list, output_store: LookupStore = None) -> list:
+    '''
+    Merge the shards of a lookup table and check that their mappings agree
+
+    Rows found in several shards are only added once. A row conflicts with the rows before it when:
+    - its old patient id has another new patient id,
+    - its old patient id and old accession number have another row,
+    - its new patient id is the pseudonym of another old patient id,
+    - its new accession number is the pseudonym of another old accession number.
+    The accession numbers are checked per patient, as several patients may share one, e.g. the empty
+    AccessionNumber of the files without it, whose pseudonyms are not checked.
+    Conflicting rows are reported and not added to the merged table.
+
+    Parameters
+    ----------
+    shard_stores : list
+        Lookup tables of the shards, in the order of precedence.
+    output_store : LookupStore
+        Table where the rows are added. If None, the shards are only checked.
+
+    Returns
+    -------
+    conflicts : list
+        List of (shard index, row, description of the conflict).
+    '''
+    patients = {}
+    keys = {}
+    new_patients = {}
+    new_accessions = {}
+    conflicts = []
+
+    for shard_index, store in enumerate(shard_stores):
+        for row in store.rows():
+            old_patient_id, new_patient_id, old_accession_number, new_accession_number = row
+            key = (old_patient_id, old_accession_number)
+            if keys.get(key) == row:
+                # Same row in several shards
+                continue
+
+            conflict = None
+            if patients.get(old_patient_id, new_patient_id) != new_patient_id:
+                conflict = 'PatientID already pseudonymized as {}'.format(patients[old_patient_id])
+            elif key in keys:
+                conflict = 'AccessionNumber of this patient already in row {}'.format(keys[key])
+            elif new_patients.get(new_patient_id, old_patient_id) != old_patient_id:
+                conflict = 'Pseudonym {} already given to PatientID {}'.format(new_patient_id, new_patients[new_patient_id])
+            elif old_accession_number and \
+                    new_accessions.get(new_accession_number, old_accession_number) != old_accession_number:
+                conflict = 'Pseudonym {} already given to AccessionNumber {}'.format(
+                    new_accession_number, new_accessions[new_accession_number])
+            if conflict is not None:
+                conflicts.append((shard_index, row, conflict))
+                continue
+
+            patients[old_patient_id] = new_patient_id
+            keys[key] = row
+            new_patients[new_patient_id] = old_patient_id
+            if old_accession_number:
+                new_accessions[new_accession_number] = old_accession_number
+            if output_store is not None:
+                output_store.add(row)
+
+    if output_store is not None:
+        output_store.commit()
+    return conflicts
@@ -1,7 +1,10 @@
 # This code was taken and adapted from https://github.com/KitwareMedical/dicom-anonymizer
 
+import functools
+import io
 import os
 import re
+import time
 from typing import List, NewType
 
 import pydicom
@@ -9,14 +12,35 @@ from random import randint
 
 from utils.dicom_fields import *
 from utils.format_tag import *
+from utils.lookup_store import open_lookup_store
+from utils.anonymization_plan import AnonymizationPlan
+from utils.text_scrubber import TextScrubber
+from utils.pixel_redaction import find_redaction_profile, redact_pixels
+from utils.dicom_io import read_dicom_file, write_dicom_file
+from utils import profiling
 
 import hashlib
-import csv
-import numpy as np
+import hmac
+import uuid
 
 dictionary = {}
 lookup_path = None
 
+# Lookup table opened by anonymize() or by the worker pool (cf utils.lookup_store).
+# If not set, the csv lookup table at lookup_path is opened on first use.
+lookup_store = None
+
+# Length of the hash of the SOPInstanceUID in the names of renamed files
+RENAME_HASH_LENGTH = 16
+
+# Secret shared by all workers of a parallel run (cf utils.worker_pool), used to derive pseudonyms
+# deterministically
+pseudonym_salt = None
+
+# Site secret (bytes) used to derive the replaced UIDs with an HMAC (cf hmac_uid). When set, the same UID
+# is replaced with the same value in every run and every process, without keeping a dictionary.
+uid_secret = None
+
 
 # Regexp function
 
@@ -38,15 +62,103 @@ def regexp(options: dict):
 
     '''
 
-    def apply_regexp(dataset, tag):
-        '''
-        Apply a regexp to the dataset
-        '''
-        element = dataset.get(tag)
-        if element is not None:
-            element.value = re.sub(options['find'], options['replace'], str(element.value))
+    return functools.partial(apply_regexp, options)
+
+
+def apply_regexp(options, dataset, tag):
+    '''
+    Apply a regexp to the dataset
+    Defined at module level (and bound with functools.partial) so that the action can be pickled.
+    '''
+    element = dataset.get(tag)
+    if element is not None:
+        element.value = re.sub(options['find'], options['replace'], str(element.value))
+
+
+def apply_regexps(rules: tuple, dataset, tag):
+    '''
+    Apply several regexp rules to the dataset, in one pass (cf utils.text_scrubber)
+    Bound with functools.partial by add_actions when several regexp actions are given for the same tag.
+    '''
+    element = dataset.get(tag)
+    if element is not None:
+        element.value = get_text_scrubber(rules).sub(str(element.value))
+
+
+@functools.lru_cache(maxsize=None)
+def get_text_scrubber(rules: tuple) -> TextScrubber:
+    '''
+    Return the TextScrubber of the (find, replace) rules of a tag, compiled once per process.
+    '''
+    return TextScrubber(rules)
+
+
+def get_regexp_rules(action) -> tuple:
+    '''
+    Return the (find, replace) rules of a regexp action, or an empty tuple for the other actions.
+    '''
+    func = getattr(action, 'func', None)
+    if func is apply_regexp:
+        options = action.args[0]
+        return ((options['find'], options['replace']),)
+    if func is apply_regexps:
+        return action.args[0]
+    return ()
 
-    return apply_regexp
+
+def add_actions(anonymization_actions: dict, new_actions: dict) -> None:
+    '''
+    Add actions to a map of actions, as dict.update, except that the regexp rules of a tag which already
+    has regexp rules are added to them instead of replacing them. They are compiled into one regular
+    expression applied in one pass (cf apply_regexps).
+    '''
+    for tag, action in new_actions.items():
+        rules = get_regexp_rules(anonymization_actions.get(tag))
+        new_rules = get_regexp_rules(action)
+        if rules and new_rules:
+            action = functools.partial(apply_regexps, tuple(dict.fromkeys(rules + new_rules)))
+        anonymization_actions[tag] = action
+
+
+# Pseudonym generation
+
+def new_pseudonym(value) -> str:
+    '''
+    Generate the sha256 pseudonym of a value.
+    Without salt, the pseudonym is randomized. When a pseudonym salt is set (parallel runs), the pseudonym
+    is derived from the salt so that every worker produces the same pseudonym for the same value.
+    '''
+    if pseudonym_salt is None:
+        return hashlib.sha256((str(value) + str(os.urandom(32))).encode()).hexdigest()
+    return hashlib.sha256((pseudonym_salt + str(value)).encode()).hexdigest()
+
+
+def new_uid_digits(value: str) -> list:
+    '''
+    Generate one digit for each alphanumeric char of the UID value.
+    Digits are random, or derived from the pseudonym salt when it is set.
+    '''
+    nb_digits = sum(char.isalnum() for char in value)
+    if pseudonym_salt is None:
+        return [str(randint(0, 9)) for _ in range(nb_digits)]
+
+    digits = ''
+    counter = 0
+    while len(digits) < nb_digits:
+        digest = hashlib.sha256((pseudonym_salt + value + str(counter)).encode()).digest()
+        digits += ''.join(str(byte % 10) for byte in digest)
+        counter += 1
+    return list(digits[:nb_digits])
+
+
+def hmac_uid(value: str) -> str:
+    '''
+    Derive a DICOM conformant UID from the HMAC-SHA256 of value keyed with the site secret.
+    The first 128 bits of the HMAC are formatted as a UUID and the UID is built under the
+    2.25 root (UID from UUID, cf DICOM PS3.5 B.2), so it is at most 44 chars long.
+    '''
+    digest = hmac.new(uid_secret, value.encode(), hashlib.sha256).digest()
+    return '2.25.' + str(uuid.UUID(bytes=digest[:16], version=4).int)
 
 
 # Default anonymization functions
@@ -56,9 +168,18 @@ def replace_element_UID(element):
     Keep char value but replace char number with random number
     The replaced value is kept in a dictionary link to the initial element.value in order to automatically
     apply the same replaced value if we have an other UID with the same value
+    If a site secret is set, the UID is replaced by hmac_uid instead and nothing is kept in memory.
     '''
+    if uid_secret is not None:
+        if element.VM > 1:
+            element.value = [hmac_uid(str(value)) if value else value for value in element.value]
+        elif element.value:
+            element.value = hmac_uid(str(element.value))
+        return
+
     if element.value not in dictionary:
-        new_chars = [str(randint(0, 9)) if char.isalnum() else char for char in element.value]
+        digits = iter(new_uid_digits(element.value))
+        new_chars = [next(digits) if char.isalnum() else char for char in element.value]
         dictionary[element.value] = ''.join(new_chars)
     element.value = dictionary.get(element.value)
 
@@ -77,6 +198,10 @@ def replace_element_date_time(element):
     element.value = '00010101010101.000000+0000'
 
 
+# VRs handled by replace_element, other VRs raise NotImplementedError
+REPLACE_ELEMENT_VRS = ('DA', 'TM', 'LO', 'SH', 'PN', 'CS', 'UI', 'UL', 'IS', 'FD', 'FL', 'SS', 'US', 'ST', 'SQ', 'DT')
+
+
 def replace_element(element):
     '''
     Replace element's value according to it's VR:
@@ -108,7 +233,7 @@ def replace_element(element):
         element.value = ''
     elif element.VR == 'SQ':
         for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
+            for sub_element in sub_dataset:
                 replace_element(sub_element)
     elif element.VR == 'DT':
         replace_element_date_time(element)
@@ -126,6 +251,10 @@ def replace(dataset, tag):
         replace_element(element)
 
 
+# VRs handled by empty_element, other VRs raise NotImplementedError
+EMPTY_ELEMENT_VRS = ('SH', 'PN', 'UI', 'LO', 'CS', 'DA', 'TM', 'UL', 'SQ')
+
+
 def empty_element(element):
     '''
     Clean element according to the element's VR:
@@ -145,7 +274,7 @@ def empty_element(element):
         element.value = 0
     elif element.VR == 'SQ':
         for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
+            for sub_element in sub_dataset:
                 empty_element(sub_element)
     else:
         raise NotImplementedError('Not anonymized. VR {} not yet implemented.'.format(element.VR))
@@ -170,7 +299,7 @@ def delete_element(dataset, element):
         replace_element_date(element)
     elif element.VR == 'SQ' and element.value is type(pydicom.Sequence):
         for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
+            for sub_element in sub_dataset:
                 delete_element(sub_dataset, sub_element)
     else:
         del dataset[element.tag]
@@ -242,47 +371,51 @@ def delete_or_empty_or_replace_UID(dataset, tag):
         else:
             empty_element(element)
 
+def get_lookup_store():
+    '''
+    Return the lookup table at lookup_path, opening it with the csv backend if it is not opened yet.
+    Rows are then saved as soon as they are added.
+    '''
+    global lookup_store
+    if lookup_store is None or lookup_store.path != lookup_path:
+        if lookup_store is not None:
+            lookup_store.close()
+        lookup_store = open_lookup_store(lookup_path, batch_size=1)
+    return lookup_store
+
+
 def replace_and_keep_correspondence(dataset, tag):
     '''
     P - addition to pseudonimize the code and keep a lookup table.
     If used, it should be called when tag (0x0010, 0x0020) (PatientID) is encountered.
     It also replaces implicitly the tag (0x0008, 0x0050) (AccessionNumber).
-    A lookup table (csv file) is create with columns: 
+    A lookup table (csv file or SQLite database, cf utils.lookup_store) is create with columns:
     'old_patient_id', 'new_patient_id', 'old_accession_number', 'new_accession_number'
     '''
     if lookup_path is None:
         raise ValueError("Missing path to lookup table to save correspondence")
-    if os.path.exists(lookup_path):
-        with open(lookup_path, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            data = np.array(list(reader))
-    else:
-        data = np.array([['old_patient_id', 'new_patient_id', 'old_accession_number', 'new_accession_number']])
+    store = get_lookup_store()
 
-    data_changed = True
     element = dataset.get(tag)
     if element is not None:
-        new_value_patient_id = hashlib.sha256((str(dataset.PatientID) + str(os.urandom(32))).encode()).hexdigest()
-        new_value_accession_number = hashlib.sha256((str(dataset.AccessionNumber) + str(os.urandom(32))).encode()).hexdigest()
         if element.VR == "LO": # Patient ID
-            if element.value not in data[:,0]: # Patient not in csv
-                data = np.append(data, [[str(dataset.PatientID), new_value_patient_id, str(dataset.AccessionNumber), new_value_accession_number]], axis=0)
-                dataset.PatientID = new_value_patient_id
-                dataset.AccessionNumber = new_value_accession_number
-            else: # Patient in csv
-                if dataset.AccessionNumber in data[:,2]: # AccessNumber in csv
-                    idx = np.argwhere(data[:,2] == str(dataset.AccessionNumber))[0][0]
-                    dataset.AccessionNumber = data[idx,3]
-                    dataset.PatientID = data[idx,1]
-                    data_changed = False
-                else: # AccessNumber not in csv
-                    idx = np.argwhere(data[:,0] == str(dataset.PatientID))[0][0]
-                    data = np.append(data, [[data[idx,0], data[idx,1], str(dataset.AccessionNumber), new_value_accession_number]], axis=0)
-                    dataset.PatientID = data[idx,1]
-                    dataset.AccessionNumber = new_value_accession_number
-
-    if data_changed:
-        np.savetxt(lookup_path, data, delimiter=',', fmt="%s")
+            patient_id = str(dataset.PatientID)
+            accession_number = str(dataset.AccessionNumber)
+            new_value_patient_id = store.find_patient(patient_id)
+            if new_value_patient_id is None: # Patient not in lookup table
+                new_value_patient_id = new_pseudonym(patient_id)
+                new_value_accession_number = new_pseudonym(accession_number)
+                store.add([patient_id, new_value_patient_id, accession_number, new_value_accession_number])
+            else: # Patient in lookup table
+                row = store.find_accession(accession_number)
+                if row is not None: # AccessNumber in lookup table
+                    new_value_patient_id = row[1]
+                    new_value_accession_number = row[3]
+                else: # AccessNumber not in lookup table
+                    new_value_accession_number = new_pseudonym(accession_number)
+                    store.add([patient_id, new_value_patient_id, accession_number, new_value_accession_number])
+            dataset.PatientID = new_value_patient_id
+            dataset.AccessionNumber = new_value_accession_number
 
 # Generation functions
 
@@ -297,11 +430,36 @@ actions_map_name_functions = {
     "delete_or_empty_or_replace": delete_or_empty_or_replace,
     "delete_or_empty_or_replace_UID": delete_or_empty_or_replace_UID,
     "replace_and_keep_correspondance": replace_and_keep_correspondence,
+    "replace_and_keep_correspondence": replace_and_keep_correspondence,
     "keep": keep,
+    "clean": clean,
     "regexp": regexp
 }
 
 
+def get_action(action_name: str, defined_action_map: dict = {}):
+    '''
+    Get the action function from its name
+
+    Parameters
+    ----------
+    action_name : str
+        Name of an action defined in defined_action_map or of a pre-defined action from simpledicomanonymizer
+    defined_action_map : dict
+        Link action name to action function
+
+    Returns
+    -------
+    action : function
+        The action function.
+    '''
+    if action_name in defined_action_map:
+        return defined_action_map[action_name]
+    if action_name in actions_map_name_functions:
+        return actions_map_name_functions[action_name]
+    raise ValueError('Unknown action {}, expected one of {}'.format(action_name, list(actions_map_name_functions)))
+
+
 def generate_actions(tag_list: list, action, options: dict = None) -> dict:
     '''
     Generate a dictionary using list values as tag and assign the same value to all
@@ -355,8 +513,54 @@ def initialize_actions() -> dict:
     return anonymization_actions
 
 
+def compile_anonymization_plan(extra_anonymization_rules: dict = None, scrub_all_text: bool = False,
+                               redaction_profiles: list = None) -> AnonymizationPlan:
+    '''
+    Compile the DICOM standard actions and the extra rules into an anonymization plan.
+    The plan should be compiled once per run and given to anonymize_dataset for every dataset.
+
+    Parameters
+    ----------
+    extra_anonymization_rules : dict
+        Rules added to (or overriding) the DICOM standard actions
+    scrub_all_text : bool
+        If True, the regexp rules are combined into a TextScrubber applied in one pass to every text
+        element of the dataset (and to the elements of their tags), instead of each rule to its own tag.
+    redaction_profiles : list
+        RedactionProfile objects (cf utils.pixel_redaction), the first one matching a dataset is applied
+        to its pixels.
+
+    Returns
+    -------
+    plan : AnonymizationPlan
+        The compiled anonymization plan.
+    '''
+    if isinstance(extra_anonymization_rules, AnonymizationPlan):
+        return extra_anonymization_rules
+    anonymization_actions = initialize_actions()
+    if extra_anonymization_rules is not None:
+        anonymization_actions.update(extra_anonymization_rules)
+    scrubber = None
+    if scrub_all_text:
+        rules = []
+        tags = set()
+        for tag, action in anonymization_actions.items():
+            tag_rules = get_regexp_rules(action)
+            if tag_rules:
+                for rule in tag_rules:
+                    if rule not in rules:
+                        rules.append(rule)
+                if len(tag) == 2:
+                    tags.add(tag[0] << 16 | tag[1])
+                # The element is scrubbed by the scrubber, once
+                anonymization_actions[tag] = keep
+        scrubber = TextScrubber(rules, frozenset(tags))
+    return AnonymizationPlan(anonymization_actions, scrubber, redaction_profiles)
+
+
 def anonymize_dicom_file(in_file: str, out_file: str, lookup_file: str = None, extra_anonymization_rules: dict = None,
-                         delete_private_tags: bool = True, rename_files: bool = False) -> None:
+                         delete_private_tags: bool = True, rename_files: bool = False,
+                         pixel_passthrough: bool = False, fan_out_levels: int = 0) -> None:
     '''
     Anonymize a DICOM file by modifying personal tags
 
@@ -370,10 +574,16 @@ def anonymize_dicom_file(in_file: str, out_file: str, lookup_file: str = None, e
         File path or file-like object to write to
     lookup_file : str
         File path to the lookup table.
-    extra_anonymization_rules : str
-        Add more tag's actions
+    extra_anonymization_rules : dict or AnonymizationPlan
+        Add more tag's actions, or the compiled anonymization plan
     delete_private_tags : bool
         Define if private tags should be delete or not
+    rename_files : bool
+        Whether to remane output files with pseudo.
+    pixel_passthrough : bool
+        Only read and anonymize the header, the pixel data is copied unchanged from in_file (cf utils.dicom_io)
+    fan_out_levels : int
+        Number of levels of subfolders renamed files are spread into (cf get_output_path)
 
     Returns
     -------
@@ -381,22 +591,138 @@ def anonymize_dicom_file(in_file: str, out_file: str, lookup_file: str = None, e
         The generated dictionary with the action to be applied.
     '''
     if (os.path.isfile(in_file)):
-        dataset = pydicom.dcmread(in_file, force=True)
-        
+        start = time.perf_counter()
+        dataset, pixel_data_offset = read_dicom_file(in_file, pixel_passthrough)
+        read_end = time.perf_counter()
+
         global lookup_path
         lookup_path = lookup_file
 
-        anonymize_dataset(dataset, extra_anonymization_rules, delete_private_tags)
+        redaction_profile = anonymize_dataset(dataset, extra_anonymization_rules, delete_private_tags)
+        write_start = time.perf_counter()
 
         # Store modified image
-        if rename_files:
-            start_file_name = out_file.rfind('/')
-            pseudo = str(dataset.PatientID) + '-' + str(dataset.AccessionNumber)
-            num_file = str(len(os.listdir(out_file[:start_file_name])))
-            full_out_path =  out_file[:start_file_name] + num_file + '_' + pseudo
-            dataset.save_as(full_out_path)
-        else:
-            dataset.save_as(out_file)
+        full_out_path = get_output_path(dataset, out_file, rename_files, fan_out_levels)
+        if fan_out_levels > 0:
+            os.makedirs(os.path.dirname(full_out_path), exist_ok=True)
+        write_dicom_file(dataset, full_out_path, in_file, pixel_data_offset, redaction_profile)
+
+        if profiling.profiler is not None:
+            record_file_timings(start, read_end, write_start, time.perf_counter())
+
+
+def get_output_path(dataset: pydicom.Dataset, out_file: str, rename_files: bool, fan_out_levels: int = 0) -> str:
+    '''
+    Return the path where the anonymized dataset is written
+
+    Parameters
+    ----------
+    dataset : Dataset object of pydicom.dataset module
+        The anonymized dataset
+    out_file : str
+        Output file path, used as is if rename_files is not set
+    rename_files : bool
+        Whether to name the file with pseudo: "<PatientID>-<AccessionNumber>_<hash>" in the folder of
+        out_file, where hash is a hash of the (anonymized) SOPInstanceUID, or of the name of out_file
+        if there is none. The name only depends on the dataset, so it does not need a directory listing
+        and is the same whichever process writes the file.
+    fan_out_levels : int
+        If rename_files is set, number of levels of subfolders (named with 2 hexadecimal digits of the
+        hash) the files are spread into, so that a folder does not hold too many files.
+
+    Returns
+    -------
+    full_out_path : str
+        Path of the output file.
+    '''
+    if not rename_files:
+        return out_file
+    instance = str(dataset.get('SOPInstanceUID', '')) or os.path.basename(out_file)
+    instance_hash = hashlib.sha256(instance.encode()).hexdigest()
+    pseudo = str(dataset.PatientID) + '-' + str(dataset.AccessionNumber)
+    file_name = pseudo + '_' + instance_hash[:RENAME_HASH_LENGTH]
+    subfolders = [instance_hash[RENAME_HASH_LENGTH + 2 * level:RENAME_HASH_LENGTH + 2 * level + 2]
+                  for level in range(fan_out_levels)]
+    return os.path.join(os.path.dirname(out_file), *subfolders, file_name)
+
+
+def record_file_timings(start: float, read_end: float, write_start: float, end: float) -> None:
+    '''
+    Record the read and write stages and the latency of a file in the profiler.
+    '''
+    profiling.profiler.add_stage('read', read_end - start)
+    profiling.profiler.add_stage('write', end - write_start)
+    profiling.profiler.add_file(end - start)
+
+
+def anonymize_dicom_stream(in_stream, out_stream, lookup_file: str = None, extra_anonymization_rules=None,
+                           delete_private_tags: bool = True, pixel_passthrough: bool = False) -> pydicom.Dataset:
+    '''
+    Anonymize a DICOM file read from a file-like object and write it to another file-like object
+
+    Parameters
+    ----------
+    in_stream : file-like object
+        Seekable binary file-like object to read from
+    out_stream : file-like object
+        Binary file-like object to write to
+    lookup_file : str
+        File path to the lookup table.
+    extra_anonymization_rules : dict or AnonymizationPlan
+        Add more tag's actions, or the compiled anonymization plan
+    delete_private_tags : bool
+        Define if private tags should be delete or not
+    pixel_passthrough : bool
+        Only read and anonymize the header, the pixel data is copied unchanged from in_stream
+
+    Returns
+    -------
+    dataset : Dataset object of pydicom.dataset module
+        The anonymized dataset (without its pixel data in pixel passthrough mode).
+    '''
+    start = time.perf_counter()
+    dataset, pixel_data_offset = read_dicom_file(in_stream, pixel_passthrough)
+    read_end = time.perf_counter()
+
+    global lookup_path
+    lookup_path = lookup_file
+
+    redaction_profile = anonymize_dataset(dataset, extra_anonymization_rules, delete_private_tags)
+    write_start = time.perf_counter()
+    write_dicom_file(dataset, out_stream, in_stream, pixel_data_offset, redaction_profile)
+
+    if profiling.profiler is not None:
+        record_file_timings(start, read_end, write_start, time.perf_counter())
+    return dataset
+
+
+def anonymize_bytes(data: bytes, lookup_file: str = None, extra_anonymization_rules=None,
+                    delete_private_tags: bool = True, pixel_passthrough: bool = False) -> bytes:
+    '''
+    Anonymize a DICOM file held in memory
+
+    Parameters
+    ----------
+    data : bytes
+        Content of the DICOM file
+    lookup_file : str
+        File path to the lookup table.
+    extra_anonymization_rules : dict or AnonymizationPlan
+        Add more tag's actions, or the compiled anonymization plan
+    delete_private_tags : bool
+        Define if private tags should be delete or not
+    pixel_passthrough : bool
+        Only parse and anonymize the header, the pixel data bytes are copied unchanged
+
+    Returns
+    -------
+    data : bytes
+        Content of the anonymized DICOM file.
+    '''
+    out_stream = io.BytesIO()
+    anonymize_dicom_stream(io.BytesIO(data), out_stream, lookup_file, extra_anonymization_rules,
+                           delete_private_tags, pixel_passthrough)
+    return out_stream.getvalue()
 
 
 def get_private_tag(dataset, tag):
@@ -481,8 +807,8 @@ def get_private_tags(anonymization_actions: dict, dataset: pydicom.Dataset) -> L
     return private_tags
 
 
-def anonymize_dataset(dataset: pydicom.Dataset, extra_anonymization_rules: dict = None,
-                      delete_private_tags: bool = True) -> None:
+def anonymize_dataset(dataset: pydicom.Dataset, extra_anonymization_rules=None,
+                      delete_private_tags: bool = True):
     '''
     Anonymize a pydicom Dataset by using anonymization rules which links an action to a tag
 
@@ -490,45 +816,53 @@ def anonymize_dataset(dataset: pydicom.Dataset, extra_anonymization_rules: dict
     ----------
     dataset : FileDataset object of pydicom.dataset module
         Dataset to be anonymized
-    extra_anonymization_rules : dict
-        Rules to be applied on the dataset
+    extra_anonymization_rules : dict or AnonymizationPlan
+        Rules to be applied on the dataset in addition to the DICOM standard actions,
+        or the plan compiled by compile_anonymization_plan
     delete_private_tags : bool
         Define if private tags should be delete or not
 
     Returns
     -------
-    None.
+    redaction_profile : RedactionProfile
+        The redaction profile matching the dataset (cf utils.pixel_redaction), or None. If the pixel data
+        has not been read, it should be given to write_dicom_file, which redacts the frames.
     '''
-    current_anonymization_actions = initialize_actions()
+    profiler = profiling.profiler
+    if profiler is not None:
+        start = time.perf_counter()
 
-    if extra_anonymization_rules is not None:
-        current_anonymization_actions.update(extra_anonymization_rules)
-
-    private_tags = []
-
-    for tag, action in current_anonymization_actions.items():
+    plan = compile_anonymization_plan(extra_anonymization_rules)
 
-        def range_callback(dataset, data_element):
-            if data_element.tag.group & tag[2] == tag[0] and data_element.tag.element & tag[3] == tag[1]:
-                action(dataset, tag)
+    # The profile is chosen from the header before it is anonymized
+    redaction_profile = find_redaction_profile(plan.redaction_profiles, dataset)
 
-        element = None
+    private_tags = []
 
-        # We are in a repeating group
-        if len(tag) > 2:
-            dataset.walk(range_callback)
-        # Individual Tags
+    # The dataset is traversed once to find the elements matching a rule
+    for match_dataset, tag, action in plan.find_actions(dataset):
+        if profiler is None:
+            action(match_dataset, tag)
         else:
-            action(dataset, tag)
+            action_start = time.perf_counter()
+            action(match_dataset, tag)
+            profiler.add_action(action, time.perf_counter() - action_start)
+
+        # Get private tag to restore it later
+        if match_dataset is dataset and tag in plan.private_tags:
+            element = None
             try:
                 element = dataset.get(tag)
             except:
                 print("Cannot get element from tag: ", tag_to_hex_strings(tag))
 
-            # Get private tag to restore it later
             if element and element.tag.is_private:
                 private_tags.append(get_private_tag(dataset, tag))
 
+    if profiler is not None:
+        rules_end = time.perf_counter()
+        profiler.add_stage('rules', rules_end - start)
+
     # X - Private tags = (0xgggg, 0xeeee) where 0xgggg is odd
     if delete_private_tags:
         dataset.remove_private_tags()
@@ -540,3 +874,22 @@ def anonymize_dataset(dataset: pydicom.Dataset, extra_anonymization_rules: dict
             block = dataset.private_block(creator["tagGroup"], creator["creatorName"], create=True)
             if element is not None:
                 block.add_new(element["offset"], element["element"].VR, element["element"].value)
+
+    if profiler is not None:
+        profiler.add_stage('private_tags', time.perf_counter() - rules_end)
+
+    # The text elements are scrubbed after the rules, in one pass for all the regexp rules
+    if plan.scrubber is not None:
+        scrub_start = time.perf_counter()
+        plan.scrubber.scrub_dataset(dataset)
+        if profiler is not None:
+            profiler.add_stage('scrub', time.perf_counter() - scrub_start)
+
+    # The pixels are only decoded and written back when a redaction profile matches. If the pixel data has
+    # not been read, the frames are redacted one at a time by write_dicom_file
+    if redaction_profile is not None and 'PixelData' in dataset:
+        redact_start = time.perf_counter()
+        redact_pixels(dataset, redaction_profile)
+        if profiler is not None:
+            profiler.add_stage('redact', time.perf_counter() - redact_start)
+    return redaction_profile
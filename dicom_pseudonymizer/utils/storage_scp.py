@@ -0,0 +1,289 @@
+'''
+DICOM storage SCP which anonymizes the instances on receipt (cf storage_scp.py).
+
+The instances pushed by the modalities or the PACS (C-STORE requests) are received by pynetdicom, one
+thread per association, and kept in memory: the original data is never written to the disk. Each
+instance is anonymized with the compiled plan by a pool of worker processes (cf utils.worker_pool) and
+written to the output folder, then the main thread saves its lookup rows and the C-STORE response is
+sent. The response thus tells the sender whether the instance has been anonymized and stored.
+
+At most max_in_flight instances are anonymized at once. When the workers fall behind, the associations
+wait for a free slot, which slows the senders down, and after queue_timeout seconds the instance is
+refused with the status Out of Resources (0xA700), which the senders retry later.
+'''
+
+import concurrent.futures
+import io
+import os
+import queue
+import threading
+import time
+import uuid
+
+import pydicom
+from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, AllStoragePresentationContexts, evt
+from pynetdicom.sop_class import Verification
+
+from utils import simple_dicomanonymizer
+from utils import worker_pool
+from utils.anonymization_plan import AnonymizationPlan
+from utils.dicom_io import read_dicom_file, write_dicom_file
+from utils.lookup_store import add_new_rows
+from utils.manifest import describe_error
+
+DEFAULT_PORT = 11112
+DEFAULT_AE_TITLE = 'DSAIL'
+DEFAULT_QUEUE_TIMEOUT = 30.0
+
+# C-STORE response statuses (cf DICOM PS3.4 B.2.3)
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+
+def encode_received_instance(event) -> bytes:
+    '''
+    Return the instance of a C-STORE request as the content of a DICOM file, without decoding it.
+    '''
+    fp = io.BytesIO()
+    fp.write(b'\0' * 128 + b'DICM')
+    pydicom.filewriter.write_file_meta_info(fp, event.file_meta, enforce_standard=False)
+    fp.write(event.request.DataSet.getvalue())
+    return fp.getvalue()
+
+
+def get_instance_file_name(dataset) -> str:
+    '''
+    Name of the file of an anonymized instance: its (replaced) SOPInstanceUID, or a random name.
+    '''
+    instance_uid = str(dataset.get('SOPInstanceUID', '')).strip()
+    return (instance_uid or uuid.uuid4().hex) + '.dcm'
+
+
+def anonymize_instance_in_worker(data: bytes, output_folder: str, lookup_file: str, delete_private_tags: bool,
+                                 rename_files: bool, fan_out_levels: int = 0) -> tuple:
+    '''
+    Anonymize a received instance in a worker process (cf worker_pool.init_worker) and write it.
+
+    Only the header and the elements following the pixel data are parsed and anonymized, the pixel data
+    element is copied unchanged unless a redaction profile matches (cf dicom_io.read_dicom_file). An
+    instance whose trailing elements cannot be parsed is read in full.
+    The file is written under a temporary name and renamed once complete.
+
+    Returns
+    -------
+    out_path, rows, error : tuple
+        Path of the anonymized file, lookup rows added while anonymizing it, and the description of the
+        error raised (None if the instance has been anonymized).
+    '''
+    out_path = None
+    error = None
+    try:
+        in_stream = io.BytesIO(data)
+        dataset, pixel_data_offset = read_dicom_file(in_stream, pixel_passthrough=True)
+        simple_dicomanonymizer.lookup_path = lookup_file
+        redaction_profile = simple_dicomanonymizer.anonymize_dataset(dataset, worker_pool.worker_plan,
+                                                                     delete_private_tags)
+        out_path = simple_dicomanonymizer.get_output_path(
+            dataset, os.path.join(output_folder, get_instance_file_name(dataset)), rename_files, fan_out_levels)
+        if fan_out_levels > 0:
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        write_dicom_file(dataset, out_path + '.tmp', in_stream, pixel_data_offset, redaction_profile)
+        os.replace(out_path + '.tmp', out_path)
+    except Exception as e:
+        error = describe_error(e)
+    uids, rows, timings = worker_pool.pop_worker_state()
+    return out_path, rows, error
+
+
+class AnonymizingStorageSCP:
+    '''
+    Storage SCP anonymizing the received instances in a pool of worker processes.
+
+    Parameters
+    ----------
+    output_folder : str
+        Folder the anonymized instances are written to.
+    lookup_store : LookupStore
+        Lookup table in which the new rows are saved, or None. It is only used by the main thread.
+    anonymization_plan : AnonymizationPlan
+        Compiled anonymization rules, sent once to each worker.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to name the files with pseudo (cf simple_dicomanonymizer.get_output_path) instead of their
+        SOPInstanceUID.
+    workers : int
+        Number of worker processes.
+    max_in_flight : int
+        Maximum number of instances anonymized at once. The default is 2 * workers.
+    queue_timeout : float
+        Time in seconds an instance waits for a free slot before it is refused.
+    fan_out_levels : int
+        With rename_files, number of levels of subfolders the files are spread into.
+    '''
+
+    def __init__(self, output_folder: str, lookup_store, anonymization_plan: AnonymizationPlan,
+                 delete_private_tags: bool = True, rename_files: bool = False, workers: int = 2,
+                 max_in_flight: int = None, queue_timeout: float = DEFAULT_QUEUE_TIMEOUT, fan_out_levels: int = 0):
+        self.output_folder = output_folder
+        self.lookup_store = lookup_store
+        self.lookup_path = lookup_store.path if lookup_store is not None else None
+        self.anonymization_plan = anonymization_plan
+        self.delete_private_tags = delete_private_tags
+        self.rename_files = rename_files
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.fan_out_levels = fan_out_levels
+        self.in_flight = threading.BoundedSemaphore(max_in_flight or 2 * workers)
+        # (lookup rows, event set once they are saved) of the anonymized instances
+        self.merge_queue = queue.Queue()
+        self.executor = None
+        self.broken_executor = None
+        self.stop_event = threading.Event()
+        self.counts_lock = threading.Lock()
+        self.counts = {"stored": 0, "failed": 0, "refused": 0}
+        # Number of C-STORE requests being handled, their lookup rows are saved before serve returns
+        self.active_stores = 0
+
+    def log(self, message: str) -> None:
+        print('{} {}'.format(time.strftime('%Y-%m-%d %H:%M:%S'), message), flush=True)
+
+    def count(self, result: str) -> None:
+        with self.counts_lock:
+            self.counts[result] += 1
+
+    def handle_store(self, event) -> int:
+        '''
+        Handler of the C-STORE requests, called by the thread of the association.
+        '''
+        with self.counts_lock:
+            if self.stop_event.is_set():
+                self.counts["refused"] += 1
+                return STATUS_OUT_OF_RESOURCES
+            self.active_stores += 1
+        try:
+            return self.store_instance(event)
+        finally:
+            with self.counts_lock:
+                self.active_stores -= 1
+
+    def store_instance(self, event) -> int:
+        '''
+        Anonymize and write a received instance and wait for its lookup rows to be saved.
+        '''
+        data = encode_received_instance(event)
+        if not self.in_flight.acquire(timeout=self.queue_timeout):
+            self.count("refused")
+            self.log('Refused an instance from {}: the workers are busy'.format(event.assoc.requestor.ae_title))
+            return STATUS_OUT_OF_RESOURCES
+        try:
+            executor = self.executor
+            future = executor.submit(anonymize_instance_in_worker, data, self.output_folder, self.lookup_path,
+                                     self.delete_private_tags, self.rename_files, self.fan_out_levels)
+            out_path, rows, error = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # The pool is started again by the main thread, the sender retries later
+            self.broken_executor = executor
+            self.count("refused")
+            return STATUS_OUT_OF_RESOURCES
+        finally:
+            self.in_flight.release()
+        if error is not None:
+            self.count("failed")
+            self.log('Cannot anonymize an instance from {}: {}'.format(event.assoc.requestor.ae_title, error))
+            return STATUS_CANNOT_UNDERSTAND
+
+        # The instance is acknowledged once its lookup rows are saved
+        saved = threading.Event()
+        self.merge_queue.put((rows, saved))
+        saved.wait()
+        self.count("stored")
+        return STATUS_SUCCESS
+
+    def merge_rows(self, timeout: float) -> None:
+        '''
+        Save the lookup rows of the instances anonymized since the last call, waiting at most timeout
+        seconds for the first one, and release their associations.
+        '''
+        try:
+            items = [self.merge_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return
+        while True:
+            try:
+                items.append(self.merge_queue.get_nowait())
+            except queue.Empty:
+                break
+        if self.lookup_store is not None:
+            for rows, saved in items:
+                # Two workers may have met the same patient and accession number, the first row is kept
+                add_new_rows(self.lookup_store, rows)
+            # One commit for all the instances received meanwhile
+            self.lookup_store.commit()
+        for rows, saved in items:
+            saved.set()
+
+    def start_workers(self) -> None:
+        self.executor = worker_pool.start_worker_pool(self.lookup_store, self.anonymization_plan, self.workers)
+        # The workers are started (imports, anonymization plan) before the first instances arrive
+        for future in [self.executor.submit(worker_pool.warm_up_worker) for _ in range(self.workers)]:
+            future.result()
+
+    def serve(self, host: str = '', port: int = DEFAULT_PORT, ae_title: str = DEFAULT_AE_TITLE,
+              max_associations: int = 10) -> None:
+        '''
+        Receive instances until stop is called or the process is interrupted (Ctrl+C)
+
+        Parameters
+        ----------
+        host : str
+            Address to listen on. The default is all the interfaces.
+        port : int
+            TCP port to listen on.
+        ae_title : str
+            AE title of the SCP.
+        max_associations : int
+            Maximum number of simultaneous associations.
+
+        Returns
+        -------
+        None.
+        '''
+        os.makedirs(self.output_folder, exist_ok=True)
+        ae = AE(ae_title=ae_title)
+        ae.maximum_associations = max_associations
+        # The pixel data is not decoded, so every transfer syntax is accepted
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+        ae.add_supported_context(Verification)
+
+        self.start_workers()
+        server = ae.start_server((host, port), block=False, evt_handlers=[(evt.EVT_C_STORE, self.handle_store)])
+        self.log('Listening on port {} as {}'.format(port, ae_title))
+        try:
+            while not self.stop_event.is_set():
+                self.merge_rows(timeout=0.5)
+                if self.broken_executor is not None and self.broken_executor is self.executor:
+                    self.log('A worker process died, restarting the workers')
+                    self.executor.shutdown(wait=False)
+                    self.start_workers()
+                self.broken_executor = None
+        except KeyboardInterrupt:
+            pass
+        finally:
+            with self.counts_lock:
+                self.stop_event.set()
+            server.shutdown()
+            # The instances being anonymized are acknowledged once their lookup rows are saved
+            while self.active_stores > 0:
+                self.merge_rows(timeout=0.1)
+            self.merge_rows(timeout=0)
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.log('{stored} instances stored, {failed} failed, {refused} refused'.format(**self.counts))
+
+    def stop(self) -> None:
+        '''
+        Stop serve, e.g. from a signal handler.
+        '''
+        self.stop_event.set()
@@ -0,0 +1,181 @@
+'''
+Generation of synthetic DICOM corpora, used to benchmark the anonymizer.
+
+The generated files contain the kinds of elements the anonymization rules deal with: identifying tags of
+the default profile, patients and accession numbers pseudonymized through the lookup table (P_TAGS),
+nested sequences, private tags, curve and overlay repeating groups, and single or multi-frame pixel data.
+The content only depends on the parameters and on the seed, so that runs can be compared.
+'''
+
+import os
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian
+
+# Root of the UIDs of the synthetic files
+UID_ROOT = '1.2.826.0.1.3680043.10.1000.'
+
+# SOP Class of the synthetic files (CT Image Storage)
+SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.2'
+
+
+def make_uid(*numbers) -> str:
+    '''
+    Build a deterministic UID from integers.
+    '''
+    return UID_ROOT + '.'.join(str(number) for number in numbers)
+
+
+def make_nested_sequence(depth: int, file_index: int) -> Sequence:
+    '''
+    Build a Referenced Image Sequence nested depth times, each item referencing another instance.
+    '''
+    item = Dataset()
+    item.ReferencedSOPClassUID = SOP_CLASS_UID
+    item.ReferencedSOPInstanceUID = make_uid(9, file_index, depth)
+    if depth > 1:
+        item.SourceImageSequence = make_nested_sequence(depth - 1, file_index)
+    return Sequence([item])
+
+
+def make_synthetic_dataset(file_index: int, nb_patients: int = 100, studies_per_patient: int = 2,
+                           rows: int = 256, columns: int = 256, frames: int = 1, sequence_depth: int = 2,
+                           nb_private_tags: int = 4, nb_curves: int = 2, nb_overlays: int = 1,
+                           random_state: np.random.RandomState = None) -> FileDataset:
+    '''
+    Build a synthetic DICOM dataset
+
+    Parameters
+    ----------
+    file_index : int
+        Index of the file in the corpus. It determines the patient, the study and the UIDs.
+    nb_patients : int
+        Number of distinct patients of the corpus.
+    studies_per_patient : int
+        Number of studies (and accession numbers) of each patient.
+    rows : int
+        Number of rows of the image.
+    columns : int
+        Number of columns of the image.
+    frames : int
+        Number of frames of the pixel data. Above 1, the dataset is a multi-frame image.
+    sequence_depth : int
+        Depth of the nested Referenced Image Sequence, 0 for none.
+    nb_private_tags : int
+        Number of elements of the private block.
+    nb_curves : int
+        Number of curve groups (0x50xx).
+    nb_overlays : int
+        Number of overlay groups (0x60xx).
+    random_state : np.random.RandomState
+        Generator of the pixel values. The default is a generator seeded with file_index.
+
+    Returns
+    -------
+    dataset : FileDataset object of pydicom.dataset module
+        The synthetic dataset, encoded in explicit VR little endian.
+    '''
+    if random_state is None:
+        random_state = np.random.RandomState(file_index)
+    patient = file_index % nb_patients
+    study = (file_index // nb_patients) % studies_per_patient
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SOP_CLASS_UID
+    file_meta.MediaStorageSOPInstanceUID = make_uid(3, file_index)
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = FileDataset(None, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+
+    dataset.SOPClassUID = SOP_CLASS_UID
+    dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dataset.StudyInstanceUID = make_uid(1, patient, study)
+    dataset.SeriesInstanceUID = make_uid(2, patient, study)
+    dataset.FrameOfReferenceUID = make_uid(4, patient, study)
+    dataset.StudyDate = '2021{:02d}{:02d}'.format(study % 12 + 1, patient % 28 + 1)
+    dataset.StudyTime = '120000'
+    dataset.ContentDate = dataset.StudyDate
+    dataset.AccessionNumber = 'ACC{:06d}{:03d}'.format(patient, study)
+    dataset.Modality = 'CT'
+    dataset.Manufacturer = 'Synthetic'
+    dataset.InstitutionName = 'Synthetic Hospital'
+    dataset.ReferringPhysicianName = 'Physician^Referring'
+    dataset.StudyDescription = 'Study {} of patient {}'.format(study, patient)
+    dataset.SeriesDescription = 'Synthetic series'
+    dataset.PatientName = 'Patient^{:06d}'.format(patient)
+    dataset.PatientID = 'PID{:06d}'.format(patient)
+    dataset.PatientBirthDate = '19{:02d}0101'.format(patient % 100)
+    dataset.PatientSex = 'MF'[patient % 2]
+    dataset.StudyID = str(study)
+    dataset.SeriesNumber = 1
+    dataset.InstanceNumber = file_index + 1
+    if sequence_depth > 0:
+        dataset.ReferencedImageSequence = make_nested_sequence(sequence_depth, file_index)
+
+    for curve in range(nb_curves):
+        dataset.add_new((0x5000 + 2 * curve, 0x0005), 'US', 1)
+        dataset.add_new((0x5000 + 2 * curve, 0x0010), 'US', 2)
+        dataset.add_new((0x5000 + 2 * curve, 0x3000), 'OW', bytes(8))
+    for overlay in range(nb_overlays):
+        dataset.add_new((0x6000 + 2 * overlay, 0x0010), 'US', rows)
+        dataset.add_new((0x6000 + 2 * overlay, 0x0011), 'US', columns)
+        dataset.add_new((0x6000 + 2 * overlay, 0x4000), 'LT', 'Overlay comment of patient {}'.format(patient))
+        dataset.add_new((0x6000 + 2 * overlay, 0x3000), 'OW', bytes((rows * columns + 7) // 8))
+
+    if nb_private_tags > 0:
+        block = dataset.private_block(0x0011, 'SYNTHETIC', create=True)
+        for offset in range(nb_private_tags):
+            block.add_new(offset, 'LO', 'Private value {} of patient {}'.format(offset, patient))
+
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 12
+    dataset.HighBit = 11
+    dataset.PixelRepresentation = 0
+    dataset.WindowCenter = 1024
+    dataset.WindowWidth = 2048
+    if frames > 1:
+        dataset.NumberOfFrames = frames
+    dataset.PixelData = random_state.randint(0, 4096, size=rows * columns * frames, dtype='<u2').tobytes()
+    return dataset
+
+
+def generate_corpus(output_folder: str, nb_files: int, frames: int = 1, multi_frame_interval: int = 1,
+                    **kwargs) -> int:
+    '''
+    Write a synthetic corpus to a folder
+
+    Parameters
+    ----------
+    output_folder : str
+        Folder where the files are written. It is created if it does not exist.
+    nb_files : int
+        Number of files of the corpus.
+    frames : int
+        Number of frames of the multi-frame files.
+    multi_frame_interval : int
+        One file out of multi_frame_interval has frames frames, the others a single frame.
+    **kwargs
+        Other parameters of make_synthetic_dataset.
+
+    Returns
+    -------
+    nb_bytes : int
+        Total size of the written files.
+    '''
+    os.makedirs(output_folder, exist_ok=True)
+    nb_bytes = 0
+    for file_index in range(nb_files):
+        path = os.path.join(output_folder, 'synthetic_{:06d}.dcm'.format(file_index))
+        file_frames = frames if file_index % multi_frame_interval == 0 else 1
+        make_synthetic_dataset(file_index, frames=file_frames, **kwargs).save_as(path, write_like_original=False)
+        nb_bytes += os.path.getsize(path)
+    return nb_bytes
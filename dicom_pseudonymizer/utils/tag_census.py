@@ -0,0 +1,260 @@
+'''
+Inventory of the tags found in an archive, used to choose the anonymization profile.
+
+Only the headers of the files are read (the pixel data is skipped). For every tag, the census counts
+its occurrences, the VRs it is encoded with and keeps a few sample values. It also counts the private
+creator blocks, and checks each element against the anonymization plan: the elements which no rule
+covers, and the elements whose rule would raise NotImplementedError because of their VR, are flagged.
+'''
+
+import collections
+import concurrent.futures
+
+import pydicom
+from pydicom.datadict import keyword_for_tag
+
+from utils import simple_dicomanonymizer
+from utils.anonymization_plan import AnonymizationPlan
+from utils.profiling import get_action_name
+
+# VRs whose values are not kept as samples
+BINARY_VRS = ('OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'UN')
+
+# Maximum length of the sample values
+SAMPLE_LENGTH = 64
+
+# Number of files read by a worker process per task
+CHUNK_SIZE = 64
+
+# Action -> VRs it supports, for the actions that raise NotImplementedError for the other VRs
+ACTION_SUPPORTED_VRS = {
+    simple_dicomanonymizer.replace: simple_dicomanonymizer.REPLACE_ELEMENT_VRS,
+    simple_dicomanonymizer.empty_or_replace: simple_dicomanonymizer.REPLACE_ELEMENT_VRS,
+    simple_dicomanonymizer.delete_or_replace: simple_dicomanonymizer.REPLACE_ELEMENT_VRS,
+    simple_dicomanonymizer.delete_or_empty_or_replace: simple_dicomanonymizer.REPLACE_ELEMENT_VRS,
+    simple_dicomanonymizer.empty: simple_dicomanonymizer.EMPTY_ELEMENT_VRS,
+    simple_dicomanonymizer.delete_or_empty: simple_dicomanonymizer.EMPTY_ELEMENT_VRS,
+    simple_dicomanonymizer.delete_or_empty_or_replace_UID: simple_dicomanonymizer.EMPTY_ELEMENT_VRS + ('UI',),
+    simple_dicomanonymizer.clean: ()
+}
+
+# Actions which also cover the elements of the sequences they are applied to
+SEQUENCE_ACTIONS = (
+    simple_dicomanonymizer.replace,
+    simple_dicomanonymizer.empty_or_replace,
+    simple_dicomanonymizer.delete_or_replace,
+    simple_dicomanonymizer.delete_or_empty_or_replace,
+    simple_dicomanonymizer.empty,
+    simple_dicomanonymizer.delete_or_empty,
+    simple_dicomanonymizer.delete_or_empty_or_replace_UID,
+    simple_dicomanonymizer.delete
+)
+
+PATIENT_ID_TAG = 0x00100020
+ACCESSION_NUMBER_TAG = 0x00080050
+
+
+def format_tag(tag: int) -> str:
+    return '({:04X},{:04X})'.format(tag >> 16, tag & 0xFFFF)
+
+
+class TagCensus:
+    '''
+    Counts of the tags, VRs and private creators of a set of files.
+
+    Parameters
+    ----------
+    anonymization_plan : AnonymizationPlan
+        Rules the elements are checked against.
+    nb_samples : int
+        Maximum number of distinct sample values kept per tag, 0 to keep none.
+    '''
+
+    def __init__(self, anonymization_plan: AnonymizationPlan, nb_samples: int = 5):
+        self.anonymization_plan = anonymization_plan
+        self.nb_samples = nb_samples
+        self.nb_files = 0
+        self.unreadable_files = []
+        # tag key -> {"keyword", "private", "count", "vrs", "samples", "rule", "unsupported"}
+        self.tags = {}
+        # "(gggg) creator" -> number of blocks
+        self.private_creators = collections.Counter()
+
+    def find_rule(self, dataset, tag: int, top_level: bool):
+        '''
+        Return the first rule of the plan matching the tag, or None.
+        '''
+        tag_index = self.anonymization_plan.tag_index
+        matches = self.anonymization_plan.match_repeating_groups(tag)
+        if top_level and tag in tag_index:
+            position, rule_tag, action = tag_index[tag]
+            matches.append((position, action))
+        # The AccessionNumber is pseudonymized along with the PatientID
+        if (not matches and top_level and tag == ACCESSION_NUMBER_TAG and PATIENT_ID_TAG in tag_index
+                and tag_index[PATIENT_ID_TAG][2] is simple_dicomanonymizer.replace_and_keep_correspondence):
+            return simple_dicomanonymizer.replace_and_keep_correspondence
+        return min(matches, key=lambda match: match[0])[1] if matches else None
+
+    def add_file(self, path: str) -> None:
+        '''
+        Read the header of a file and add its elements to the census.
+        '''
+        try:
+            dataset = pydicom.dcmread(path, force=True, stop_before_pixels=True)
+            self.add_dataset(dataset, True, None)
+        except Exception as e:
+            self.unreadable_files.append((path, '{}: {}'.format(type(e).__name__, e)))
+            return
+        self.nb_files += 1
+
+    def add_dataset(self, dataset, top_level: bool, parent_action) -> None:
+        for element in dataset:
+            tag = int(element.tag)
+            if element.tag.is_private:
+                if element.tag.is_private_creator:
+                    self.private_creators['({:04X}) {}'.format(element.tag.group, element.value)] += 1
+                    key = format_tag(tag)
+                else:
+                    creator = dataset.get((element.tag.group, element.tag.element >> 8))
+                    key = '({:04X},xx{:02X}) {}'.format(element.tag.group, element.tag.element & 0xFF,
+                                                        creator.value if creator is not None else '')
+            else:
+                key = format_tag(tag)
+
+            action = self.find_rule(dataset, tag, top_level)
+            if action is None and parent_action in SEQUENCE_ACTIONS:
+                action = parent_action
+
+            statistics = self.tags.get(key)
+            if statistics is None:
+                statistics = self.tags[key] = {
+                    "keyword": keyword_for_tag(tag),
+                    "private": element.tag.is_private,
+                    "count": 0,
+                    "vrs": collections.Counter(),
+                    "samples": [],
+                    "rule": None,
+                    "unsupported": 0
+                }
+            statistics["count"] += 1
+            statistics["vrs"][element.VR] += 1
+            if action is not None:
+                statistics["rule"] = get_action_name(action)
+                supported_vrs = ACTION_SUPPORTED_VRS.get(getattr(action, 'func', action))
+                if supported_vrs is not None and element.VR not in supported_vrs:
+                    statistics["unsupported"] += 1
+            if (self.nb_samples > 0 and element.VR not in BINARY_VRS and len(statistics["samples"]) < self.nb_samples):
+                sample = str(element.value)[:SAMPLE_LENGTH]
+                if sample not in statistics["samples"]:
+                    statistics["samples"].append(sample)
+
+            if element.VR == 'SQ':
+                for sub_dataset in element.value:
+                    self.add_dataset(sub_dataset, False, action)
+
+    def merge(self, other: 'TagCensus') -> None:
+        '''
+        Add the counts of another census.
+        '''
+        self.nb_files += other.nb_files
+        self.unreadable_files.extend(other.unreadable_files)
+        self.private_creators.update(other.private_creators)
+        for key, other_statistics in other.tags.items():
+            statistics = self.tags.get(key)
+            if statistics is None:
+                self.tags[key] = other_statistics
+                continue
+            statistics["count"] += other_statistics["count"]
+            statistics["vrs"].update(other_statistics["vrs"])
+            statistics["rule"] = statistics["rule"] or other_statistics["rule"]
+            statistics["unsupported"] += other_statistics["unsupported"]
+            for sample in other_statistics["samples"]:
+                if len(statistics["samples"]) >= self.nb_samples:
+                    break
+                if sample not in statistics["samples"]:
+                    statistics["samples"].append(sample)
+
+    def to_dict(self, delete_private_tags: bool = True) -> dict:
+        '''
+        Summary of the census
+
+        Parameters
+        ----------
+        delete_private_tags : bool
+            Whether the private tags are deleted, in which case they are not reported as uncovered.
+
+        Returns
+        -------
+        summary : dict
+            Number of files, unreadable files, statistics per tag, private creators, uncovered tags and
+            tags with elements whose rule does not support their VR.
+        '''
+        tags = {key: dict(statistics, vrs=dict(statistics["vrs"])) for key, statistics in sorted(self.tags.items())}
+        return {
+            "files": self.nb_files,
+            "unreadable_files": [{"path": path, "error": error} for path, error in self.unreadable_files],
+            "tags": tags,
+            "private_creators": dict(sorted(self.private_creators.items())),
+            "uncovered_tags": [key for key, statistics in tags.items() if statistics["rule"] is None
+                               and not (delete_private_tags and statistics["private"])],
+            "unsupported_tags": {key: {"rule": statistics["rule"], "vrs": statistics["vrs"],
+                                       "count": statistics["unsupported"]}
+                                 for key, statistics in tags.items() if statistics["unsupported"] > 0}
+        }
+
+    def __getstate__(self):
+        # The plan is not sent back by the worker processes
+        state = dict(self.__dict__)
+        state['anonymization_plan'] = None
+        return state
+
+
+def census_files(paths: list, anonymization_plan: AnonymizationPlan, nb_samples: int) -> TagCensus:
+    '''
+    Census of a chunk of files, run in a worker process.
+    '''
+    census = TagCensus(anonymization_plan, nb_samples)
+    for path in paths:
+        census.add_file(path)
+    return census
+
+
+def run_census(paths: list, anonymization_plan: AnonymizationPlan, nb_samples: int = 5, workers: int = 1,
+               chunk_done_callback=None) -> TagCensus:
+    '''
+    Census of the headers of files
+
+    Parameters
+    ----------
+    paths : list
+        Paths of the files.
+    anonymization_plan : AnonymizationPlan
+        Rules the elements are checked against.
+    nb_samples : int
+        Maximum number of distinct sample values kept per tag.
+    workers : int
+        Number of worker processes reading the files.
+    chunk_done_callback : function
+        Called with the number of files of each chunk once it has been read.
+
+    Returns
+    -------
+    census : TagCensus
+        The census of all files.
+    '''
+    census = TagCensus(anonymization_plan, nb_samples)
+    chunks = [paths[start:start + CHUNK_SIZE] for start in range(0, len(paths), CHUNK_SIZE)]
+    if workers <= 1:
+        for chunk in chunks:
+            census.merge(census_files(chunk, anonymization_plan, nb_samples))
+            if chunk_done_callback is not None:
+                chunk_done_callback(len(chunk))
+        return census
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(census_files, chunk, anonymization_plan, nb_samples): len(chunk) for chunk in chunks}
+        for future in concurrent.futures.as_completed(futures):
+            census.merge(future.result())
+            if chunk_done_callback is not None:
+                chunk_done_callback(futures[future])
+    return census
@@ -0,0 +1,118 @@
+'''
+Find/replace rules applied to the text elements in a single pass.
+
+The regexp rules given with --dictionary or -t are compiled into one regular expression, an alternation
+with one group per rule. A text value is scanned once whatever the number of rules: at each position,
+the first rule (in the order of the rules) which matches is applied and the scan resumes after the
+match, so that a replaced text is not matched again by the following rules.
+
+A TextScrubber can be applied to every text element of a dataset, including the elements of nested
+sequences, to remove the site-specific identifiers (names, IDs) wherever they appear.
+'''
+
+import re
+
+import pydicom
+
+# VRs of the elements scrubbed by scrub_dataset
+TEXT_VRS = ('AE', 'CS', 'LO', 'LT', 'PN', 'SH', 'ST', 'UC', 'UR', 'UT')
+
+# Global inline flags at the start of a pattern, e.g. (?i), which are only allowed at the start of the
+# combined pattern and are turned into scoped flags, e.g. (?i:...)
+GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+
+
+def scope_flags(find: str) -> str:
+    match = GLOBAL_FLAGS.match(find)
+    if match is None:
+        return find
+    return '(?{}:{})'.format(match.group(1), find[match.end():])
+
+
+class TextScrubber:
+    '''
+    Immutable set of find/replace rules compiled into one regular expression.
+
+    Parameters
+    ----------
+    rules : list
+        List of (find, replace) pairs, as for re.sub, in the order in which they take precedence.
+    tags : frozenset
+        Tags (group << 16 | element) of the top level elements which are scrubbed whatever their VR.
+    '''
+
+    __slots__ = ('rules', 'tags', 'patterns', 'pattern', 'group_rules')
+
+    def __init__(self, rules: list, tags: frozenset = frozenset()):
+        rules = tuple((find, replace) for find, replace in rules)
+        object.__setattr__(self, 'rules', rules)
+        object.__setattr__(self, 'tags', frozenset(tags))
+        # Each rule is also compiled on its own, to expand its replacement with its own groups
+        patterns = tuple(re.compile(find) for find, replace in rules)
+        object.__setattr__(self, 'patterns', patterns)
+
+        # Outer group of each rule in the combined pattern -> index of the rule
+        group_rules = {}
+        branches = []
+        group = 1
+        for index, pattern in enumerate(patterns):
+            group_rules[group] = index
+            branches.append('({})'.format(scope_flags(pattern.pattern)))
+            group += 1 + pattern.groups
+        object.__setattr__(self, 'group_rules', group_rules)
+        try:
+            pattern = re.compile('|'.join(branches)) if branches else None
+        except re.error as e:
+            raise ValueError('The regexp rules cannot be combined ({}): they must not use backreferences '
+                             'or the same group names'.format(e))
+        object.__setattr__(self, 'pattern', pattern)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('TextScrubber is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('TextScrubber is immutable')
+
+    def replace_match(self, match) -> str:
+        # The outer group of the matching rule is the last group closed by the match
+        index = self.group_rules[match.lastindex]
+        find, replace = self.rules[index]
+        # The rule is matched again at the same position to expand the replacement with its own groups
+        return self.patterns[index].match(match.string, match.start()).expand(replace)
+
+    def sub(self, text: str) -> str:
+        '''
+        Apply all the rules to a text in one pass.
+        '''
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self.replace_match, text)
+
+    def scrub_element(self, element) -> None:
+        value = element.value
+        if value is None or value == '':
+            return
+        if isinstance(value, pydicom.multival.MultiValue):
+            element.value = [self.sub(str(item)) for item in value]
+        else:
+            element.value = self.sub(str(value))
+
+    def scrub_dataset(self, dataset, top_level: bool = True) -> None:
+        '''
+        Apply the rules to every text element of the dataset and of its sequences, and to the top level
+        elements of self.tags.
+        '''
+        if self.pattern is None:
+            return
+        for element in dataset:
+            if element.VR == 'SQ':
+                for sub_dataset in element.value:
+                    self.scrub_dataset(sub_dataset, False)
+            elif element.VR in TEXT_VRS or (top_level and int(element.tag) in self.tags):
+                self.scrub_element(element)
+
+    def __reduce__(self):
+        return (TextScrubber, (self.rules, self.tags))
+
+    def __len__(self):
+        return len(self.rules)
@@ -0,0 +1,335 @@
+'''
+Verification of anonymized files.
+
+The anonymized files are read without their pixel data (the large values are only read when they are
+checked, and the pixel data is never read) and their elements, those following the pixel data included,
+are checked against the anonymization plan: the elements matched by a rule must hold the value this rule writes (e.g. no element
+for X, 'Anonymized' for a LO with D, '' for a PN with Z), and the private tags must have been deleted.
+The text elements are also searched for residual identifiers: the original PatientIDs and
+AccessionNumbers of the lookup table, and any other term (e.g. patient names) given by the user. All the
+terms are compiled into a single regular expression (a trie of the terms), so that each value is
+scanned once whatever the number of terms.
+'''
+
+import concurrent.futures
+import re
+
+import pydicom
+
+from utils import simple_dicomanonymizer
+from utils.anonymization_plan import AnonymizationPlan
+from utils.profiling import get_action_name
+
+# VRs of the elements searched for residual identifiers
+TEXT_VRS = ('AE', 'CS', 'LO', 'LT', 'PN', 'SH', 'ST', 'UC', 'UR', 'UT')
+
+# Terms shorter than this are not searched, as they would match by chance
+MIN_TERM_LENGTH = 3
+
+# Number of files checked by a worker process per task
+CHUNK_SIZE = 64
+
+# Values larger than this (in bytes) are only read from the file when they are checked
+DEFER_SIZE = 1024
+
+# Pixel data elements, which are not checked
+PIXEL_DATA_TAGS = (0x7FE00008, 0x7FE00009, 0x7FE00010)
+
+# Values written by replace_element and empty_element, per VR
+REPLACED_VALUES = {
+    'DA': '00010101',
+    'TM': '000000.00',
+    'LO': 'Anonymized',
+    'SH': 'Anonymized',
+    'PN': 'Anonymized',
+    'CS': 'Anonymized',
+    'IS': 0,
+    'FD': 0,
+    'FL': 0,
+    'SS': 0,
+    'US': 0,
+    'ST': '',
+    'DT': '00010101010101.000000+0000'
+}
+EMPTIED_VALUES = {
+    'SH': '',
+    'PN': '',
+    'UI': '',
+    'LO': '',
+    'CS': '',
+    'DA': '00010101',
+    'TM': '000000.00',
+    'UL': 0
+}
+
+REPLACE_ACTIONS = (
+    simple_dicomanonymizer.replace,
+    simple_dicomanonymizer.empty_or_replace,
+    simple_dicomanonymizer.delete_or_replace,
+    simple_dicomanonymizer.delete_or_empty_or_replace
+)
+EMPTY_ACTIONS = (
+    simple_dicomanonymizer.empty,
+    simple_dicomanonymizer.delete_or_empty
+)
+
+# State of the worker processes, set by init_worker
+worker_verifier = None
+
+
+def build_trie_pattern(terms) -> str:
+    '''
+    Build a regular expression matching any of the terms, as a trie so that the common prefixes of the
+    terms are only matched once.
+    '''
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        # The empty key marks the end of a term
+        node[''] = {}
+
+    def to_pattern(node):
+        branches = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    return to_pattern(trie)
+
+
+def compile_terms(terms: dict, min_term_length: int = MIN_TERM_LENGTH):
+    '''
+    Compile the terms searched in the text elements
+
+    Parameters
+    ----------
+    terms : dict
+        Map each term to its kind (e.g. 'PatientID'), reported instead of the term itself.
+    min_term_length : int
+        Terms shorter than this are ignored.
+
+    Returns
+    -------
+    pattern, kinds : tuple
+        Case insensitive regular expression matching the terms as whole words (or None if there is no
+        term), and the map of the lower case terms to their kind.
+    '''
+    kinds = {}
+    for term, kind in terms.items():
+        term = term.strip().lower()
+        if len(term) >= min_term_length:
+            kinds.setdefault(term, kind)
+    if not kinds:
+        return None, kinds
+    pattern = re.compile(r'(?<![0-9a-z])' + build_trie_pattern(sorted(kinds)) + r'(?![0-9a-z])', re.IGNORECASE)
+    return pattern, kinds
+
+
+def has_value(element, expected) -> bool:
+    '''
+    Whether the element holds the expected value written by an action.
+    '''
+    value = element.value
+    if expected == '':
+        return value is None or value == '' or (isinstance(value, (list, pydicom.multival.MultiValue)) and not value)
+    if isinstance(expected, int):
+        return value == expected
+    return str(value) == expected
+
+
+class Verifier:
+    '''
+    Checks of the anonymized datasets.
+
+    Parameters
+    ----------
+    anonymization_plan : AnonymizationPlan
+        Rules the files have been anonymized with.
+    delete_private_tags : bool
+        Whether the private tags should have been deleted.
+    terms : dict
+        Terms searched in the text elements, mapped to their kind.
+    new_patient_ids : set
+        Pseudonymized PatientIDs of the lookup table, or None to skip the check of the P action.
+    new_accession_numbers : set
+        Pseudonymized AccessionNumbers of the lookup table.
+    hmac_uids : bool
+        Whether the UIDs should have been replaced with hmac_uid (2.25 UIDs).
+    min_term_length : int
+        Terms shorter than this are not searched.
+    '''
+
+    def __init__(self, anonymization_plan: AnonymizationPlan, delete_private_tags: bool = True, terms: dict = None,
+                 new_patient_ids: set = None, new_accession_numbers: set = None, hmac_uids: bool = False,
+                 min_term_length: int = MIN_TERM_LENGTH):
+        self.anonymization_plan = anonymization_plan
+        self.delete_private_tags = delete_private_tags
+        self.pattern, self.kinds = compile_terms(terms or {}, min_term_length)
+        self.new_patient_ids = new_patient_ids
+        self.new_accession_numbers = new_accession_numbers
+        self.hmac_uids = hmac_uids
+        # Private groups of the private tags kept by the rules, whose creators are kept too
+        self.kept_private_groups = {tag[0] for tag in anonymization_plan.private_tags}
+
+    def check_uid(self, element):
+        if self.hmac_uids and element.value:
+            values = element.value if element.VM > 1 else [element.value]
+            if any(value and not str(value).startswith('2.25.') for value in values):
+                return 'UID not replaced'
+        return None
+
+    def check_element(self, dataset, tag, action):
+        '''
+        Return the description of the violation of the rule by the element, or None.
+        '''
+        element = dataset.get(tag)
+        if element is None:
+            return None
+        action = getattr(action, 'func', action)
+        if action is simple_dicomanonymizer.delete:
+            # Dates are replaced instead of deleted
+            if element.VR == 'DA' and has_value(element, REPLACED_VALUES['DA']):
+                return None
+            return 'not deleted'
+        if action in REPLACE_ACTIONS or action in EMPTY_ACTIONS:
+            if element.VR == 'SQ':
+                for sub_dataset in element.value:
+                    for sub_element in sub_dataset:
+                        violation = self.check_element(sub_dataset, sub_element.tag, action)
+                        if violation is not None:
+                            return violation
+                return None
+            if element.VR == 'UI':
+                return self.check_uid(element) if action in REPLACE_ACTIONS else \
+                    (None if has_value(element, '') else 'not emptied')
+            expected_values = REPLACED_VALUES if action in REPLACE_ACTIONS else EMPTIED_VALUES
+            if element.VR in expected_values and not has_value(element, expected_values[element.VR]):
+                return 'not replaced' if action in REPLACE_ACTIONS else 'not emptied'
+            return None
+        if action is simple_dicomanonymizer.replace_UID:
+            return self.check_uid(element)
+        if action is simple_dicomanonymizer.delete_or_empty_or_replace_UID:
+            if element.VR == 'UI':
+                return self.check_uid(element)
+            return self.check_element(dataset, tag, simple_dicomanonymizer.empty)
+        if action is simple_dicomanonymizer.replace_and_keep_correspondence and self.new_patient_ids is not None:
+            if str(element.value) not in self.new_patient_ids:
+                return 'PatientID not in the lookup table'
+            if str(dataset.get('AccessionNumber', '')) not in self.new_accession_numbers:
+                return 'AccessionNumber not in the lookup table'
+        return None
+
+    def search_terms(self, dataset, violations: list) -> None:
+        '''
+        Search the text elements of the dataset, and of its sequences, for the terms.
+        '''
+        for element in dataset:
+            if element.VR == 'SQ':
+                for sub_dataset in element.value:
+                    self.search_terms(sub_dataset, violations)
+            elif element.VR in TEXT_VRS and element.value:
+                match = self.pattern.search(str(element.value))
+                if match is not None:
+                    violations.append((element.tag, 'contains an original {}'.format(self.kinds[match.group(0).lower()])))
+
+    def check_private_tags(self, dataset, violations: list, top_level: bool) -> None:
+        for element in dataset:
+            if element.tag.is_private:
+                kept = top_level and (int(element.tag) in self.anonymization_plan.tag_index or
+                                      (element.tag.is_private_creator and element.tag.group in self.kept_private_groups))
+                if not kept:
+                    violations.append((element.tag, 'private tag not deleted'))
+            elif element.VR == 'SQ':
+                for sub_dataset in element.value:
+                    self.check_private_tags(sub_dataset, violations, False)
+
+    def check_dataset(self, dataset) -> list:
+        '''
+        Check an anonymized dataset
+
+        Returns
+        -------
+        violations : list
+            List of (tag, description) of the elements that are not anonymized.
+        '''
+        violations = []
+        for match_dataset, tag, action in self.anonymization_plan.find_actions(dataset):
+            violation = self.check_element(match_dataset, tag, action)
+            if violation is not None:
+                violations.append((pydicom.tag.Tag(tag), '{} ({})'.format(violation, get_action_name(action))))
+        if self.delete_private_tags:
+            self.check_private_tags(dataset, violations, True)
+        if self.pattern is not None:
+            self.search_terms(dataset, violations)
+        return violations
+
+    def check_file(self, path: str) -> list:
+        '''
+        Read the elements of a file, except its pixel data, and check them, as check_dataset. A file that
+        cannot be read is reported as a violation with no tag.
+        '''
+        try:
+            dataset = pydicom.dcmread(path, force=True, defer_size=DEFER_SIZE)
+            # Deleting the deferred pixel data does not read it
+            for tag in PIXEL_DATA_TAGS:
+                if tag in dataset:
+                    del dataset[tag]
+            return self.check_dataset(dataset)
+        except Exception as e:
+            return [(None, 'unreadable file: {}: {}'.format(type(e).__name__, e))]
+
+
+def init_worker(verifier: Verifier) -> None:
+    global worker_verifier
+    worker_verifier = verifier
+
+
+def verify_files_in_worker(paths: list) -> list:
+    '''
+    Check a chunk of files in a worker process and return the (path, tag, description) of the violations.
+    '''
+    return [(path, tag, description) for path in paths for tag, description in worker_verifier.check_file(path)]
+
+
+def verify_files(paths: list, verifier: Verifier, workers: int = 1, chunk_done_callback=None) -> list:
+    '''
+    Check anonymized files
+
+    Parameters
+    ----------
+    paths : list
+        Paths of the anonymized files.
+    verifier : Verifier
+        Checks to run, sent once to each worker process.
+    workers : int
+        Number of worker processes.
+    chunk_done_callback : function
+        Called with the number of files of each chunk once it has been checked.
+
+    Returns
+    -------
+    violations : list
+        List of (path, tag, description) of the elements that are not anonymized, in the order of paths.
+    '''
+    chunks = [paths[start:start + CHUNK_SIZE] for start in range(0, len(paths), CHUNK_SIZE)]
+    violations = []
+    if workers <= 1:
+        init_worker(verifier)
+        for chunk in chunks:
+            violations.extend(verify_files_in_worker(chunk))
+            if chunk_done_callback is not None:
+                chunk_done_callback(len(chunk))
+        return violations
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                initargs=(verifier,)) as executor:
+        for chunk, chunk_violations in zip(chunks, executor.map(verify_files_in_worker, chunks)):
+            violations.extend(chunk_violations)
+            if chunk_done_callback is not None:
+                chunk_done_callback(len(chunk))
+    return violations
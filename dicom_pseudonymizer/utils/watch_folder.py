@@ -0,0 +1,108 @@
+'''
+Watch-folder mode of the anonymizer (cf anonymizer.watch): a long-running process picks up the files
+arriving in an inbox folder and anonymizes them by micro-batches, with the rules compiled and the worker
+processes started once.
+
+A file is picked up once it is complete, i.e. when its size and modification time have not changed
+between two scans of the inbox and for settle_seconds. Files whose name starts with '.' or '~' or ends
+with .part or .tmp are being copied and are ignored. Once anonymized, an input file is moved to the
+done folder, or to the failed folder, keeping its path relative to the inbox.
+'''
+
+import os
+import shutil
+import time
+
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_BATCH_SIZE = 256
+
+# Names of the files being written to the inbox
+TEMPORARY_PREFIXES = ('.', '~')
+TEMPORARY_SUFFIXES = ('.part', '.tmp')
+
+
+def is_temporary(name: str) -> bool:
+    return name.startswith(TEMPORARY_PREFIXES) or name.endswith(TEMPORARY_SUFFIXES)
+
+
+def iter_inbox_files(inbox_path: str):
+    '''
+    Generate the paths of the files of the inbox folder and its subfolders, except the temporary ones.
+    '''
+    for root, dirs, files in os.walk(inbox_path):
+        dirs[:] = [name for name in dirs if not is_temporary(name)]
+        for name in files:
+            if not is_temporary(name):
+                yield os.path.join(root, name)
+
+
+class InboxScanner:
+    '''
+    Detect the complete files of an inbox folder.
+
+    Parameters
+    ----------
+    inbox_path : str
+        Folder the new files are copied to.
+    settle_seconds : float
+        Minimum time since the last modification of a file before it is picked up.
+    '''
+
+    def __init__(self, inbox_path: str, settle_seconds: float = DEFAULT_SETTLE_SECONDS):
+        self.inbox_path = inbox_path
+        self.settle_seconds = settle_seconds
+        # path -> (size, modification time) at the last scan
+        self.file_states = {}
+
+    def scan(self) -> list:
+        '''
+        Scan the inbox and return the sorted paths of the files which are complete.
+        '''
+        now = time.time()
+        file_states = {}
+        ready_files = []
+        for path in iter_inbox_files(self.inbox_path):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Moved or deleted since it was listed
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            file_states[path] = state
+            if self.file_states.get(path) == state and now - stat.st_mtime >= self.settle_seconds:
+                ready_files.append(path)
+        self.file_states = file_states
+        return sorted(ready_files)
+
+
+def get_relative_path(path: str, inbox_path: str, folder: str) -> str:
+    '''
+    Return the path in folder of a file of the inbox, keeping its subfolders.
+    '''
+    return os.path.join(folder, os.path.relpath(path, inbox_path))
+
+
+def move_file(path: str, inbox_path: str, folder: str) -> str:
+    '''
+    Move a file of the inbox to folder, keeping its subfolders, and remove the subfolders of the inbox
+    left empty. A file with the same path in folder is replaced.
+
+    Returns
+    -------
+    new_path : str
+        Path of the moved file.
+    '''
+    new_path = get_relative_path(path, inbox_path, folder)
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    shutil.move(path, new_path)
+    parent = os.path.dirname(os.path.abspath(path))
+    inbox_path = os.path.abspath(inbox_path)
+    while parent != inbox_path and parent.startswith(inbox_path + os.sep):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            # Not empty
+            break
+        parent = os.path.dirname(parent)
+    return new_path
@@ -0,0 +1,237 @@
+'''
+Process pool used to pseudonymize several DICOM files in parallel.
+
+Each worker keeps its own copy of the pseudonymization state (UID dictionary and lookup table).
+All the workers of a run share the same pseudonym salt, so the same PatientID, AccessionNumber or UID
+is given the same pseudonym whichever worker handles it. The parent process merges the new UIDs and
+lookup rows of each file in input order, so the lookup table is the same as after a serial run.
+A pool can also be kept running between batches of files (cf start_worker_pool).
+'''
+
+import collections
+import concurrent.futures
+import os
+
+from utils import profiling
+from utils import simple_dicomanonymizer
+from utils.anonymization_plan import AnonymizationPlan
+from utils.lookup_store import MemoryLookupStore, add_new_rows, open_lookup_store
+from utils.manifest import describe_error
+
+worker_plan = None
+
+
+def init_worker(lookup_path: str, lookup_backend: str, salt: str, anonymization_plan: AnonymizationPlan,
+                uid_secret: bytes = None, profiling_enabled: bool = False) -> None:
+    '''
+    Initialize the pseudonymization state of a worker process.
+
+    Parameters
+    ----------
+    lookup_path : str
+        Path to the lookup table, opened in read only mode.
+    lookup_backend : str
+        Backend of the lookup table (cf utils.lookup_store).
+    salt : str
+        Pseudonym salt shared by all workers of the run.
+    anonymization_plan : AnonymizationPlan
+        Compiled anonymization rules.
+    uid_secret : bytes
+        Site secret used to derive the replaced UIDs, or None.
+    profiling_enabled : bool
+        Whether to record the timings of the anonymization (cf utils.profiling).
+
+    Returns
+    -------
+    None.
+    '''
+    global worker_plan
+    worker_plan = anonymization_plan
+    simple_dicomanonymizer.pseudonym_salt = salt
+    simple_dicomanonymizer.uid_secret = uid_secret
+    if profiling_enabled:
+        profiling.enable_profiling()
+    else:
+        profiling.disable_profiling()
+    # A forked worker inherits the table opened by the parent process, which must not be used here
+    simple_dicomanonymizer.lookup_store = None
+    if lookup_path is not None:
+        simple_dicomanonymizer.lookup_path = lookup_path
+        simple_dicomanonymizer.lookup_store = MemoryLookupStore(
+            lookup_path, open_lookup_store(lookup_path, lookup_backend, read_only=True))
+
+
+def anonymize_file_in_worker(in_file: str, out_file: str, lookup_file: str, delete_private_tags: bool,
+                             rename_files: bool, pixel_passthrough: bool, catch_errors: bool,
+                             fan_out_levels: int = 0) -> tuple:
+    '''
+    Anonymize one file in a worker process.
+
+    Returns
+    -------
+    uids, rows, error, timings : tuple
+        UIDs replaced and lookup rows added while anonymizing the file, the description of the error
+        raised if catch_errors is set (None if the file has been anonymized), and the timings of the
+        file if profiling is enabled (None otherwise).
+    '''
+    error = None
+    try:
+        simple_dicomanonymizer.anonymize_dicom_file(in_file, out_file, lookup_file, worker_plan,
+                                                    delete_private_tags, rename_files, pixel_passthrough,
+                                                    fan_out_levels)
+    except Exception as e:
+        if not catch_errors:
+            raise
+        error = describe_error(e)
+    uids, rows, timings = pop_worker_state()
+    return uids, rows, error, timings
+
+
+def pop_worker_state() -> tuple:
+    '''
+    Return and clear the pseudonymization state added in a worker process since the last call.
+
+    Returns
+    -------
+    uids, rows, timings : tuple
+        UIDs replaced, lookup rows added and timings (None if profiling is disabled).
+    '''
+    uids = dict(simple_dicomanonymizer.dictionary)
+    simple_dicomanonymizer.dictionary.clear()
+    rows = []
+    if simple_dicomanonymizer.lookup_store is not None:
+        rows = simple_dicomanonymizer.lookup_store.pending_rows
+        simple_dicomanonymizer.lookup_store.pending_rows = []
+    timings = None
+    if profiling.profiler is not None:
+        timings = profiling.profiler.pop_state()
+    return uids, rows, timings
+
+
+def start_worker_pool(lookup_store, anonymization_plan: AnonymizationPlan,
+                      workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    '''
+    Start a pool of worker processes sharing a new pseudonym salt.
+
+    The pool can be used by several calls to anonymize_in_pool, e.g. by a long-running process, so that
+    the workers are started and receive the anonymization plan only once. The rows added to the lookup
+    table after the pool is started are not read by the workers, which is consistent as long as the pool
+    is used: a value is always given the same pseudonym with the same salt.
+
+    Parameters
+    ----------
+    lookup_store : LookupStore
+        Lookup table of the run, or None. It is saved, then opened in read only mode by the workers.
+    anonymization_plan : AnonymizationPlan
+        Compiled anonymization rules, sent once to each worker.
+    workers : int
+        Number of worker processes.
+
+    Returns
+    -------
+    executor : concurrent.futures.ProcessPoolExecutor
+        The pool, to be shut down by the caller.
+    '''
+    lookup_path = None
+    lookup_backend = None
+    if lookup_store is not None:
+        # Workers read the rows that are already saved
+        lookup_store.commit()
+        lookup_path = lookup_store.path
+        lookup_backend = lookup_store.backend
+    salt = os.urandom(32).hex()
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                  initargs=(lookup_path, lookup_backend, salt, anonymization_plan,
+                                                            simple_dicomanonymizer.uid_secret,
+                                                            profiling.profiler is not None))
+
+
+def warm_up_worker() -> int:
+    '''
+    Do nothing in a worker process, used to start the workers before the first files.
+    '''
+    return os.getpid()
+
+
+def anonymize_in_pool(input_files_list: list, output_files_list: list, lookup_store, anonymization_plan: AnonymizationPlan,
+                      delete_private_tags: bool, rename_files: bool, workers: int, pixel_passthrough: bool = False,
+                      catch_errors: bool = False, max_in_flight: int = None, file_done_callback=None,
+                      fan_out_levels: int = 0, executor: concurrent.futures.ProcessPoolExecutor = None) -> None:
+    '''
+    Anonymize files with a pool of worker processes.
+
+    Parameters
+    ----------
+    input_files_list : list
+        Paths of the files to anonymize.
+    output_files_list : list
+        Paths of the anonymized files, in the same order as input_files_list.
+    lookup_store : LookupStore
+        Lookup table in which the new rows are merged, or None.
+    anonymization_plan : AnonymizationPlan
+        Compiled anonymization rules, sent once to each worker.
+    delete_private_tags : bool
+        Whether to delete private tags.
+    rename_files : bool
+        Whether to remane output files with pseudo.
+    workers : int
+        Number of worker processes.
+    pixel_passthrough : bool
+        Whether to copy the pixel data unchanged instead of reading it.
+    catch_errors : bool
+        Whether to go on with the other files when a file cannot be anonymized.
+    max_in_flight : int
+        Maximum number of files submitted to the pool and not yet merged. The default is 4 * workers.
+    file_done_callback : function
+        Called with the input file path and the error description (or None) once per file, in input order,
+        when the file has been merged.
+    fan_out_levels : int
+        Number of levels of subfolders renamed files are spread into.
+    executor : concurrent.futures.ProcessPoolExecutor
+        Pool started by start_worker_pool with the same lookup table and plan, which is left running. If
+        None, a pool of worker processes is started for these files only.
+
+    Returns
+    -------
+    None.
+    '''
+    if max_in_flight is None:
+        max_in_flight = 4 * workers
+
+    lookup_path = None
+    if lookup_store is not None:
+        # Workers read the rows that are already saved
+        lookup_store.commit()
+        lookup_path = lookup_store.path
+
+    def merge(in_file, future):
+        uids, rows, error, timings = future.result()
+        simple_dicomanonymizer.dictionary.update(uids)
+        if timings is not None:
+            profiling.profiler.merge(timings)
+        # Two workers may have met the same patient and accession number, the first row is kept
+        add_new_rows(lookup_store, rows)
+        if file_done_callback is not None:
+            file_done_callback(in_file, error)
+
+    def run(executor):
+        in_flight = collections.deque()
+        try:
+            for in_file, out_file in zip(input_files_list, output_files_list):
+                in_flight.append((in_file, executor.submit(anonymize_file_in_worker, in_file, out_file, lookup_path,
+                                                           delete_private_tags, rename_files, pixel_passthrough,
+                                                           catch_errors, fan_out_levels)))
+                if len(in_flight) >= max_in_flight:
+                    merge(*in_flight.popleft())
+            while in_flight:
+                merge(*in_flight.popleft())
+        finally:
+            # On error, the files not started yet are dropped
+            for in_file, future in in_flight:
+                future.cancel()
+
+    if executor is not None:
+        run(executor)
+        return
+    with start_worker_pool(lookup_store, anonymization_plan, workers) as executor:
+        run(executor)
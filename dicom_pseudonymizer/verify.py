@@ -0,0 +1,108 @@
+'''
+Verification of the output of the anonymizer (cf utils.verification): the headers of the anonymized
+files are checked against the anonymization rules and searched for the original identifiers.
+The violations are written to a JSON report and the command exits with status 1 if there is any.
+'''
+
+import argparse
+import json
+import sys
+
+import tqdm
+
+from anonymizer import read_actions_dictionary
+from tag_census import list_files
+from utils.lookup_store import open_lookup_store
+from utils.simple_dicomanonymizer import compile_anonymization_plan
+from utils.tag_census import format_tag
+from utils.verification import MIN_TERM_LENGTH, Verifier, verify_files
+
+
+def read_terms(lookup_path: str = None, lookup_backend: str = 'csv', terms_path: str = None) -> tuple:
+    '''
+    Read the terms searched in the anonymized files
+
+    Parameters
+    ----------
+    lookup_path : str
+        Path to the lookup table: its original PatientIDs and AccessionNumbers are searched.
+    lookup_backend : str
+        Backend of the lookup table: 'csv' or 'sqlite'.
+    terms_path : str
+        Path to a text file with one term (e.g. a patient name) per line.
+
+    Returns
+    -------
+    terms, new_patient_ids, new_accession_numbers : tuple
+        The terms mapped to their kind, and the pseudonymized PatientIDs and AccessionNumbers of the lookup
+        table (None without lookup table).
+    '''
+    terms = {}
+    new_patient_ids = None
+    new_accession_numbers = None
+    if lookup_path is not None:
+        new_patient_ids = set()
+        new_accession_numbers = set()
+        store = open_lookup_store(lookup_path, lookup_backend, read_only=True)
+        try:
+            for old_patient_id, new_patient_id, old_accession_number, new_accession_number in store.rows():
+                terms.setdefault(old_patient_id, 'PatientID')
+                terms.setdefault(old_accession_number, 'AccessionNumber')
+                new_patient_ids.add(new_patient_id)
+                new_accession_numbers.add(new_accession_number)
+        finally:
+            store.close()
+    if terms_path is not None:
+        with open(terms_path) as terms_file:
+            for line in terms_file:
+                if line.strip():
+                    terms.setdefault(line.strip(), 'term')
+    return terms, new_patient_ids, new_accession_numbers
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description='Check that anonymized DICOM files hold no residual identifier')
+    parser.add_argument('input', help='Path to the anonymized dicom file or directory (subdirectories included)')
+    parser.add_argument('report', help='Path to the JSON file where the violations are written')
+    parser.add_argument('--lookup', action='store', help='Path to the lookup table of the run: the original PatientIDs and AccessionNumbers are searched, and the pseudonymized ones are checked')
+    parser.add_argument('--lookupBackend', action='store', choices=['csv', 'sqlite'], default='csv', help='Storage of the lookup table: csv file or SQLite database')
+    parser.add_argument('--terms', action='store', help='Text file with other terms to search (e.g. patient names), one per line')
+    parser.add_argument('--minTermLength', action='store', type=int, default=MIN_TERM_LENGTH, help='Terms shorter than this are not searched')
+    parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that was added to the original one, as for the anonymizer')
+    parser.add_argument('--keepPrivateTags', action='store_true', dest='keepPrivateTags', help='If used, private tags are not reported')
+    parser.set_defaults(keepPrivateTags=False)
+    parser.add_argument('--hmacUids', action='store_true', dest='hmacUids', help='If used, the UIDs are checked to be 2.25 UIDs, as written with --uidSecretFile')
+    parser.set_defaults(hmacUids=False)
+    parser.add_argument('--workers', action='store', type=int, default=1, help='Number of processes checking the files in parallel')
+    args = parser.parse_args()
+
+    anonymization_actions = {}
+    if args.dictionary:
+        anonymization_actions = read_actions_dictionary(args.dictionary)
+    terms, new_patient_ids, new_accession_numbers = read_terms(args.lookup, args.lookupBackend, args.terms)
+    verifier = Verifier(compile_anonymization_plan(anonymization_actions), not args.keepPrivateTags, terms,
+                        new_patient_ids, new_accession_numbers, args.hmacUids, args.minTermLength)
+
+    paths = list_files(args.input)
+    progress_bar = tqdm.tqdm(total=len(paths))
+    violations = verify_files(paths, verifier, args.workers, chunk_done_callback=progress_bar.update)
+    progress_bar.close()
+
+    report = {
+        "files": len(paths),
+        "files_with_violations": len({path for path, tag, description in violations}),
+        "violations": [{"path": path, "tag": format_tag(int(tag)) if tag is not None else None, "violation": description}
+                       for path, tag, description in violations]
+    }
+    with open(args.report, 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+
+    for violation in report["violations"][:20]:
+        print('{}: {} {}'.format(violation["path"], violation["tag"], violation["violation"]))
+    print('{} violations in {} of {} files'.format(len(violations), report["files_with_violations"], len(paths)))
+    if violations:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ from fastai.vision.all import *
 from fastai.callback.all import WeightedDL
 from dsail.federated_learning import *
 from dsail.utils import *
+from dsail.shards import *
 import os
 
 @call_parse
@@ -24,7 +25,8 @@ def main(
     db: Param("Pass the used database", str)='cancer_database',
     res_loc: Param("Pass the path where the results will be stored", str)='results',
     hospital: Param("Pass the hospital number", str)='H0',
-    resize: Param("Pass the size of the image (square resize)", int)=50
+    resize: Param("Pass the size of the image (square resize)", int)=50,
+    packed: Param("Read the images from the shards of the data path (cf dicom_converter/utils/shard_dataset.py)", bool_arg)=False
 ): 
 
     print('Binary classifier')
@@ -44,11 +46,19 @@ def main(
     data_path = Path(data_path) 
     
 
-    dblock = DataBlock(blocks=(ImageBlock, CategoryBlock),
-        get_items = get_image_files,
-        get_y = parent_label,
-        item_tfms = [Resize(resize)],
-        splitter = GrandparentSplitter())
+    if packed:
+        dblock = DataBlock(blocks=(ImageBlock, CategoryBlock),
+            get_items = get_shard_items,
+            get_x = get_shard_image,
+            get_y = get_shard_label,
+            item_tfms = [Resize(resize)],
+            splitter = ShardSplitter())
+    else:
+        dblock = DataBlock(blocks=(ImageBlock, CategoryBlock),
+            get_items = get_image_files,
+            get_y = parent_label,
+            item_tfms = [Resize(resize)],
+            splitter = GrandparentSplitter())
 
 
     ds = dblock.datasets(data_path)
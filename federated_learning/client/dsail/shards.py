@@ -0,0 +1,131 @@
+import csv
+import os
+import numpy as np
+
+# Layout of the shard datasets written by dicom_converter/utils/shard_dataset.py
+INDEX_FILE = 'index.csv'
+SHARD_FILE = 'shard_{:05d}.npy'
+
+
+class ShardDataset():
+    '''
+    Images of a packed shard dataset, read from the memory-mapped shards without copy
+
+    Parameters
+    ----------
+    path: str
+        folder of the shard dataset (shard_00000.npy, ..., index.csv)
+
+    '''
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(os.path.join(self.path, INDEX_FILE), 'r', newline='') as index_file:
+            reader = csv.DictReader(index_file)
+            rows = list(reader)
+            self.columns = reader.fieldnames or []
+        self.names = [row['name'] for row in rows]
+        self.labels = [row['label'] for row in rows]
+        self.splits = [row['split'] for row in rows]
+        self.dtypes = [np.dtype(row['dtype']) for row in rows]
+        self.shard_numbers = np.array([int(row['shard']) for row in rows], dtype=np.int64)
+        self.offsets = np.array([int(row['offset']) for row in rows], dtype=np.int64)
+        self.shapes = [(int(row['rows']), int(row['columns'])) if row['channels'] == '1'
+                       else (int(row['rows']), int(row['columns']), int(row['channels'])) for row in rows]
+        # Metadata columns added after the columns of the layout
+        self.metadata = {column: [row[column] for row in rows] for column in self.columns[9:]}
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        # The shards are mapped again by each process instead of being pickled
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_shard(self, number):
+        shard = self.shards.get(number)
+        if shard is None:
+            shard = np.load(os.path.join(self.path, SHARD_FILE.format(number)), mmap_mode='r')
+            self.shards[number] = shard
+        return shard
+
+    def get_image(self, i):
+        '''
+        Return the image i as a read-only view of its shard, the pixels are read from the disk on access
+        '''
+        dtype = self.dtypes[i]
+        shape = self.shapes[i]
+        offset = self.offsets[i]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self.get_shard(self.shard_numbers[i])[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def get_items(self):
+        return [ShardItem(self, i) for i in range(len(self))]
+
+
+class ShardItem():
+    '''
+    Image of a ShardDataset, used as item of the DataBlocks (cf get_shard_items)
+    '''
+    __slots__ = ('dataset', 'index')
+
+    def __init__(self, dataset, index):
+        self.dataset = dataset
+        self.index = index
+
+    @property
+    def name(self): return self.dataset.names[self.index]
+
+    @property
+    def label(self): return self.dataset.labels[self.index]
+
+    @property
+    def split(self): return self.dataset.splits[self.index]
+
+    def image(self): return self.dataset.get_image(self.index)
+
+    def __repr__(self): return f'ShardItem({self.dataset.path}, {self.name})'
+
+
+def get_shard_items(path):
+    '''
+    get_items of a DataBlock reading a shard dataset instead of image files, e.g.
+    DataBlock(blocks=(ImageBlock, CategoryBlock), get_items=get_shard_items, get_x=get_shard_image,
+    get_y=get_shard_label, splitter=ShardSplitter())
+    '''
+    return ShardDataset(path).get_items()
+
+
+def get_shard_image(item):
+    '''
+    Return the image of an item as an RGB array of 8 bits, as the image files are opened by PILImage.create
+    '''
+    img = item.image()
+    if img.dtype != np.uint8:
+        # Values above 255 are clipped, as PIL does when converting 16 bits images to RGB
+        img = np.minimum(img, 255).astype(np.uint8)
+    if img.ndim == 2:
+        img = img[:, :, None]
+    if img.shape[2] == 1:
+        img = np.repeat(img, 3, axis=2)
+    elif img.shape[2] == 4:
+        img = np.ascontiguousarray(img[:, :, :3])
+    return img
+
+
+def get_shard_label(item):
+    return item.label
+
+
+def ShardSplitter(train_name='train', valid_name='valid'):
+    '''
+    Split the items with the split column of the index, as GrandparentSplitter does with the folders
+    '''
+    def _inner(items):
+        train = [i for i, item in enumerate(items) if item.split == train_name]
+        valid = [i for i, item in enumerate(items) if item.split == valid_name]
+        return train, valid
+    return _inner